@@ -0,0 +1,264 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Runs the API under the gevent WSGI server against the fake zabbix and
+mongodb of the tests, drives a mix of calls on instances of a given size
+and writes, per endpoint, the requests per second, p50/p95/p99 latencies
+and zabbix and mongodb calls per request as JSON:
+
+    $ PYTHONPATH=. python benchmarks/api.py --instances 20 --urls 50 --output before.json
+
+Backend calls are measured in a first pass, sending each call of the mix
+alone, and latencies in a second one with ``--concurrency`` clients.
+"""
+
+from gevent import monkey
+monkey.patch_all()  # noqa
+
+import argparse
+import collections
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import gevent
+import mock
+import requests
+
+from gevent.pywsgi import WSGIServer
+
+from tests.fakemongo import FakeMongo
+from tests.fakezabbix import FakeZabbix
+
+
+DEFAULT_MIX = ("list-urls=30,add-url=15,remove-url=15,add-watcher=10,remove-watcher=10,"
+               "list-watchers=5,list-groups=5,list-service-groups=5,new=3,remove=2")
+
+# endpoints whose zabbix objects are deleted after the response
+BACKGROUND = ("remove",)
+
+
+class Bench(object):
+
+    def __init__(self, args, url):
+        self.args = args
+        self.url = url
+        self.random = random.Random(args.seed)
+        self.instances = ["bench-{}".format(i) for i in range(args.instances)]
+        self.extra_urls = collections.defaultdict(list)
+        self.extra_watchers = collections.defaultdict(list)
+        self.created = []
+        self.counter = 0
+
+    def setup(self, session):
+        for name in self.instances:
+            session.post(self.url + "/resources", data={"name": name}).raise_for_status()
+            for i in range(self.args.urls):
+                self._post(session, "/resources/{}/url".format(name),
+                           {"url": "http://{}.example.com/{}".format(name, i), "comment": "bench"})
+            for i in range(self.args.watchers):
+                self._post(session, "/resources/{}/watcher".format(name),
+                           {"watcher": "w{}@{}.example.com".format(i, name)})
+
+    def _post(self, session, path, data):
+        session.post(self.url + path, data=json.dumps(data)).raise_for_status()
+
+    def request(self, session, op):
+        """
+        Sends one call of the mix and returns the endpoint it hit, with the
+        response.
+        """
+        self.counter += 1
+        name = self.random.choice(self.instances)
+        path = "/resources/{}".format(name)
+        if op == "add-url" or (op == "remove-url" and not self.extra_urls[name]):
+            url = "http://{}.example.com/extra/{}".format(name, self.counter)
+            resp = session.post(self.url + path + "/url", data=json.dumps({"url": url}))
+            self.extra_urls[name].append(url)
+            return "add-url", resp
+        if op == "remove-url":
+            url = self.extra_urls[name].pop()
+            return op, session.delete(self.url + path + "/url", data=json.dumps({"url": url}))
+        if op == "add-watcher" or (op == "remove-watcher" and not self.extra_watchers[name]):
+            email = "extra{}@{}.example.com".format(self.counter, name)
+            resp = session.post(self.url + path + "/watcher", data=json.dumps({"watcher": email}))
+            self.extra_watchers[name].append(email)
+            return "add-watcher", resp
+        if op == "remove-watcher":
+            email = self.extra_watchers[name].pop()
+            return op, session.delete(self.url + path + "/watcher/" + email)
+        if op == "new" or (op == "remove" and not self.created):
+            # fresh instances, removed by the following remove calls
+            new_name = "bench-new-{}".format(self.counter)
+            resp = session.post(self.url + "/resources", data={"name": new_name})
+            self.created.append(new_name)
+            return "new", resp
+        if op == "remove":
+            return op, session.delete(self.url + "/resources/" + self.created.pop(0))
+        paths = {"list-urls": "/url", "list-watchers": "/watcher", "list-groups": "/groups",
+                 "list-service-groups": "/servicegroups"}
+        return op, session.get(self.url + path + paths[op])
+
+
+def parse_mix(mix):
+    weights = []
+    for entry in mix.split(","):
+        op, _, weight = entry.partition("=")
+        weights.append((op.strip(), int(weight)))
+    return weights
+
+
+def choose(rand, weights):
+    n = rand.uniform(0, sum(w for _, w in weights))
+    for op, weight in weights:
+        n -= weight
+        if n <= 0:
+            return op
+    return weights[-1][0]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1)]
+
+
+def measure_calls(bench, weights, zabbix, mongo, rounds):
+    """
+    Sends each call of the mix ``rounds`` times, alone, returning the
+    zabbix and mongodb calls per request of each endpoint.
+    """
+    session = requests.Session()
+    counts = collections.defaultdict(lambda: [0, collections.Counter(), collections.Counter()])
+    ops = [op for op, _ in weights]
+    for _ in range(rounds):
+        for op in ops:
+            zabbix_before, mongo_before = zabbix.calls.copy(), mongo.calls.copy()
+            endpoint, resp = bench.request(session, op)
+            resp.raise_for_status()
+            if endpoint in BACKGROUND:
+                gevent.sleep(0.1)
+            count = counts[endpoint]
+            count[0] += 1
+            count[1].update(zabbix.calls - zabbix_before)
+            count[2].update(mongo.calls - mongo_before)
+    result = {}
+    for endpoint, (n, zabbix_calls, mongo_calls) in counts.items():
+        result[endpoint] = {
+            "zabbix_calls": sum(zabbix_calls.values()) / float(n),
+            "zabbix_methods": dict((k, v / float(n)) for k, v in zabbix_calls.items()),
+            "mongo_commands": sum(mongo_calls.values()) / float(n),
+            "mongo_methods": dict((k, v / float(n)) for k, v in mongo_calls.items()),
+        }
+    return result
+
+
+def measure_latency(bench, weights, concurrency, total):
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    sent = [0]
+
+    def client():
+        session = requests.Session()
+        rand = random.Random(bench.random.random())
+        while sent[0] < total:
+            sent[0] += 1
+            started = time.time()
+            endpoint, resp = bench.request(session, choose(rand, weights))
+            latencies[endpoint].append(time.time() - started)
+            if resp.status_code >= 400:
+                errors[endpoint] += 1
+
+    started = time.time()
+    gevent.joinall([gevent.spawn(client) for _ in range(concurrency)])
+    elapsed = time.time() - started
+    result = {}
+    for endpoint, values in latencies.items():
+        result[endpoint] = {
+            "requests": len(values),
+            "errors": errors[endpoint],
+            "rps": len(values) / elapsed,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+    count = sum(len(v) for v in latencies.values())
+    return {"requests": count, "errors": sum(errors.values()), "elapsed": elapsed,
+            "rps": count / elapsed}, result
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).strip().decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--instances", type=int, default=10)
+    parser.add_argument("--urls", type=int, default=10, help="urls per instance")
+    parser.add_argument("--watchers", type=int, default=5, help="watchers per instance")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="calls of each kind sent alone to count backend calls")
+    parser.add_argument("--zabbix-latency", type=float, default=5, help="milliseconds")
+    parser.add_argument("--zabbix-capacity", type=int, default=None)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="JSON file, stdout by default")
+    args = parser.parse_args(argv)
+    weights = parse_mix(args.mix)
+
+    zabbix = FakeZabbix(latency=args.zabbix_latency / 1000.0, capacity=args.zabbix_capacity,
+                        seed=args.seed)
+    os.environ.update({
+        "ZABBIX_URL": zabbix.start(),
+        "ZABBIX_USER": "bench",
+        "ZABBIX_PASSWORD": "bench",
+        "ZABBIX_HOST": "bench",
+        "ZABBIX_HOST_GROUP": zabbix.add("hostgroup", name="hcaas"),
+        "MONGODB_DATABASE": "hcaas-bench",
+    })
+    os.environ.pop("API_USERNAME", None)
+    mongo = FakeMongo()
+    with mock.patch("healthcheck.storage.MongoStorage.conn", lambda self: mongo):
+        from healthcheck import api
+        server = WSGIServer(("127.0.0.1", 0), api.app, log=None)
+        server.start()
+        bench = Bench(args, "http://127.0.0.1:{}".format(server.server_port))
+        bench.setup(requests.Session())
+        calls = measure_calls(bench, weights, zabbix, mongo, args.rounds)
+        total, endpoints = measure_latency(bench, weights, args.concurrency, args.requests)
+        server.stop()
+    zabbix.stop()
+
+    for endpoint, stats in endpoints.items():
+        stats.update(calls.get(endpoint, {}))
+    result = {
+        "commit": commit(),
+        "config": vars(args),
+        "total": total,
+        "endpoints": endpoints,
+    }
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    sys.stderr.write("{:20} {:>8} {:>9} {:>8} {:>8} {:>8} {:>7} {:>7}\n".format(
+        "endpoint", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "zabbix", "mongo"))
+    for endpoint, stats in sorted(endpoints.items()):
+        sys.stderr.write("{:20} {:8} {:9.1f} {:8.1f} {:8.1f} {:8.1f} {:7.1f} {:7.1f}\n".format(
+            endpoint, stats["requests"], stats["rps"], stats["p50_ms"], stats["p95_ms"],
+            stats["p99_ms"], stats.get("zabbix_calls", 0), stats.get("mongo_commands", 0)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
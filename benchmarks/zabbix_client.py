@@ -0,0 +1,53 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Compares the zabbix client with pyzabbix, a test requirement, against
+the fake zabbix of tests/fakezabbix.py answering after a fixed latency.
+Each simulated API request builds a new client, logs in and makes a few
+get calls, as the API does.
+
+    $ PYTHONPATH=. python benchmarks/zabbix_client.py [requests] [latency-ms]
+"""
+
+import sys
+import time
+
+from pyzabbix import ZabbixAPI
+
+from healthcheck.backends import client
+from healthcheck.backends.client import ZabbixClient
+from tests.fakezabbix import FakeZabbix
+
+CALLS_PER_REQUEST = 3
+
+
+def run(name, factory, requests, zabbix):
+    zabbix.calls.clear()
+    started = time.time()
+    for _ in range(requests):
+        zapi = factory()
+        zapi.login("user", "pass")
+        for _ in range(CALLS_PER_REQUEST):
+            zapi.host.get(output=["hostid", "host"])
+    elapsed = time.time() - started
+    print("{:10} {:8.1f} req/s {:6.2f} ms/req {:6} zabbix calls".format(
+        name, requests / elapsed, elapsed * 1000 / requests, sum(zabbix.calls.values())))
+
+
+def main(args):
+    requests = int(args[0]) if args else 500
+    zabbix = FakeZabbix(latency=float(args[1]) / 1000 if len(args) > 1 else 0.002)
+    for i in range(50):
+        zabbix.add("host", host="host {}".format(i))
+    url = zabbix.start()
+    run("pyzabbix", lambda: ZabbixAPI(url), requests, zabbix)
+    run("client", lambda: ZabbixClient(url), requests, zabbix)
+    for session in client._sessions.values():
+        session.close()
+    zabbix.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -10,11 +10,23 @@ from raven.contrib.flask import Sentry
 
 from healthcheck import admin as hadmin
 from healthcheck import auth
-from healthcheck.storage import ItemNotFoundError
-from healthcheck.backends import GroupNotInInstanceError, GroupNotExists
-
-import json
+from healthcheck import logs
+from healthcheck import metrics
+from healthcheck import profiling
+from healthcheck import timing
+from healthcheck.backends.breaker import CircuitOpenError
+from healthcheck.storage import ItemNotFoundError, HealthCheckNotFoundError
+from healthcheck.backends import (GroupNotInInstanceError, GroupNotExists,
+                                  InvalidCloneError, InvalidIntervalError,
+                                  RemovalPendingError)
+
+import datetime
+import gzip
+import hashlib
 import inspect
+import io
+import json
+import math
 import os
 import logging
 
@@ -26,12 +38,12 @@ if app.debug:
     handler.setLevel(logging.DEBUG)
 else:
     handler.setLevel(logging.WARN)
-app.logger.addHandler(handler)
+app.logger.addHandler(logs.queued(handler))
 
 SENTRY_DSN = os.environ.get("SENTRY_DSN")
 if SENTRY_DSN:
     app.config['SENTRY_DSN'] = SENTRY_DSN
-    sentry = Sentry(app)
+    sentry = Sentry(app, client_cls=logs.SentryClient)
 
 admin = Admin(app, name="Tsuru healthcheck service")
 admin.add_view(
@@ -39,12 +51,32 @@ admin.add_view(
 admin.add_view(hadmin.UrlAdmin(name='urls', endpoint='urls'))
 admin.add_view(hadmin.WatcherAdmin(name='watchers', endpoint='watchers'))
 
+profiling.install(app)
+timing.install(app)
+metrics.install(app)
+
 
 @app.errorhandler(404)
 def page_not_found(e):
     return "", 404
 
 
+@app.errorhandler(CircuitOpenError)
+def zabbix_unavailable(e):
+    return "zabbix is unavailable", 503, {"Retry-After": str(int(math.ceil(e.args[1])))}
+
+
+def snapshot_headers(manager):
+    """
+    Marks a response served from a snapshot while zabbix is unavailable.
+    """
+    updated_at = getattr(manager, "snapshot_updated_at", None)
+    if updated_at is None:
+        return {}
+    age = (datetime.datetime.utcnow() - updated_at).total_seconds()
+    return {"Age": str(max(0, int(age))), "Warning": '110 - "Response is Stale"'}
+
+
 def get_manager():
     from healthcheck.backends import Zabbix
     managers = {
@@ -66,7 +98,10 @@ def add_url(name):
     if "url" not in data:
         return "url is required", 400
     data["name"] = name
-    get_manager().add_url(**data)
+    try:
+        get_manager().add_url(**data)
+    except InvalidIntervalError as e:
+        return str(e), 400
     return "", 201
 
 
@@ -89,11 +124,54 @@ def remove_url(name):
 @app.route("/resources/<name>/url", methods=["GET"])
 @auth.required
 def list_urls(name):
-    urls = get_manager().list_urls(name)
+    manager = get_manager()
+    urls = manager.list_urls(name)
     table_urls = [["Url", "Comment"]]
     table_urls.extend(urls)
-    table = AsciiTable(table_urls)
-    return table.table, 200
+    with timing.measure("render"):
+        table = AsciiTable(table_urls).table
+    return table, 200, snapshot_headers(manager)
+
+
+@app.route("/resources/<name>/failed-url/<scenario>/<step>", methods=["GET"])
+@auth.required
+def failed_url(name, scenario, step):
+    try:
+        url = get_manager().failed_url(name, scenario, step)
+    except HealthCheckNotFoundError:
+        return "instance not found", 404
+    if not url:
+        return "step not found", 404
+    return url, 200
+
+
+@app.route("/resources/<name>/discovery", methods=["GET"])
+@auth.required
+def discovery(name):
+    try:
+        data = get_manager().discovery(name)
+    except HealthCheckNotFoundError:
+        return "instance not found", 404
+    with timing.measure("render"):
+        body = json.dumps({"data": data})
+    return body, 200, {"Content-Type": "application/json"}
+
+
+@app.route("/resources/<name>/clone", methods=["POST"])
+@auth.required
+def clone(name):
+    if not request.data:
+        return "source is required", 400
+    data = json.loads(request.data)
+    if "source" not in data:
+        return "source is required", 400
+    try:
+        get_manager().clone(name, data["source"])
+    except HealthCheckNotFoundError:
+        return "instance not found", 404
+    except InvalidCloneError as e:
+        return str(e), 400
+    return "", 201
 
 
 @app.route("/resources/<name>/watcher", methods=["POST"])
@@ -135,26 +213,34 @@ def remove_watcher(name, watcher):
 @auth.required
 def list_watchers(name):
     watchers = get_manager().list_watchers(name)
-    return json.dumps(watchers), 200
+    with timing.measure("render"):
+        body = json.dumps(watchers)
+    return body, 200
 
 
 @app.route("/resources/<name>/servicegroups", methods=["GET"])
 @auth.required
 def list_service_groups(name):
     keyword = request.args.get('keyword')
+    manager = get_manager()
     if keyword:
-        groups = get_manager().list_service_groups(keyword)
+        groups = manager.list_service_groups(keyword)
     else:
-        groups = get_manager().list_service_groups()
+        groups = manager.list_service_groups()
 
-    return json.dumps(groups), 200
+    with timing.measure("render"):
+        body = json.dumps(groups)
+    return body, 200, snapshot_headers(manager)
 
 
 @app.route("/resources/<name>/groups", methods=["GET"])
 @auth.required
 def list_groups(name):
-    groups = get_manager().list_groups(name)
-    return json.dumps(groups), 200
+    manager = get_manager()
+    groups = manager.list_groups(name)
+    with timing.measure("render"):
+        body = json.dumps(groups)
+    return body, 200, snapshot_headers(manager)
 
 
 @app.route("/resources/<name>/groups", methods=["POST"])
@@ -198,10 +284,27 @@ def remove_group(name):
 @auth.required
 def new():
     name = request.form.get("name")
-    get_manager().new(name)
+    try:
+        get_manager().new(name)
+    except RemovalPendingError as e:
+        return str(e), 409
     return "", 201
 
 
+@app.route("/resources/bulk", methods=["POST"])
+@auth.required
+def new_many():
+    if not request.data:
+        return "names are required", 400
+    data = json.loads(request.data)
+    if not data.get("names"):
+        return "names are required", 400
+    results = get_manager().new_many(data["names"])
+    with timing.measure("render"):
+        body = json.dumps(results)
+    return body, 200, {"Content-Type": "application/json"}
+
+
 @app.route("/resources/<name>", methods=["DELETE"])
 @auth.required
 def remove(name):
@@ -209,11 +312,43 @@ def remove(name):
     return "", 204
 
 
-@app.route("/plugin", methods=["GET"])
-def plugin():
+def plugin_representations():
+    """
+    Returns the source of the plugin, as is and gzipped, with their etags.
+    """
     from healthcheck import plugin
     source = inspect.getsource(plugin)
-    return source, 200
+    if not isinstance(source, bytes):
+        source = source.encode("utf-8")
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode="wb", mtime=0) as f:
+        f.write(source)
+    digest = hashlib.sha1(source).hexdigest()
+    return {
+        "identity": (source, digest),
+        "gzip": (compressed.getvalue(), digest + "-gzip"),
+    }
+
+
+# the plugin only changes with a deploy, so it's read once
+PLUGIN = plugin_representations()
+
+
+@app.route("/plugin", methods=["GET"])
+def plugin():
+    encoding = "gzip" if request.accept_encodings["gzip"] else "identity"
+    body, etag = PLUGIN[encoding]
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body)
+        if encoding == "gzip":
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    response.vary.add("Accept-Encoding")
+    return response
 
 
 @app.route("/resources/<name>/bind", methods=["POST"])
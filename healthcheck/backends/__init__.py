@@ -3,8 +3,17 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import collections
+import datetime
+import logging
 import os
+import threading
+import uuid
+import zlib
 
+from healthcheck import metrics
+from healthcheck.backends.breaker import CircuitOpenError
+from healthcheck.backends.query import Query
 from healthcheck.storage import HealthCheck, Item, User, UserNotFoundError
 
 
@@ -22,6 +31,32 @@ def get_value_or_default(key, default):
     return os.environ.get(key) or default
 
 
+# seconds a collector holds removed instances, and the retry backoff
+REMOVAL_LEASE = 300
+REMOVAL_BACKOFF = 30
+REMOVAL_MAX_BACKOFF = 3600
+
+# seconds between mongodb writes of an unchanged read snapshot
+SNAPSHOT_REFRESH = 60
+
+# held by the pool fill running in the process
+_pool_fill = threading.Lock()
+
+# the last result of the SNAPSHOT_ENTRIES most recent reads, per process
+SNAPSHOT_ENTRIES = 1000
+_snapshots = collections.OrderedDict()
+
+
+def _error_message(error):
+    """
+    Returns the message of an exception, without the other arguments of
+    exceptions such as ZabbixAPIException.
+    """
+    if error.args:
+        return u"{}".format(error.args[0])
+    return u"{}".format(error)
+
+
 class Zabbix(object):
     def __init__(self):
         url = get_value("ZABBIX_URL")
@@ -29,52 +64,347 @@ class Zabbix(object):
         password = get_value("ZABBIX_PASSWORD")
         self.host_group_id = get_value("ZABBIX_HOST_GROUP")
         self.watcher_default_password = get_value_or_default("WATCHER_PASSWORD", "watcher")
+        proxies = get_value_or_default("ZABBIX_PROXIES", "")
+        self.proxies = [p.strip() for p in proxies.split(",") if p.strip()]
+        self.check_interval = int(get_value_or_default("ZABBIX_CHECK_INTERVAL", 60))
+        self.min_check_interval = int(get_value_or_default("ZABBIX_MIN_CHECK_INTERVAL", 30))
+        self.check_jitter = get_value_or_default("ZABBIX_CHECK_JITTER", None)
+        self.provisioning = get_value_or_default("ZABBIX_PROVISIONING", "direct")
+        self.shared_host = get_value_or_default("ZABBIX_SHARED_HOST", None)
+        self.shared_host_id = None
+        if self.shared_host:
+            self.shared_host_id = get_value("ZABBIX_SHARED_HOST_ID")
+        self.instances_per_host = int(get_value_or_default("ZABBIX_INSTANCES_PER_HOST", 1))
+        self.steps_per_scenario = int(get_value_or_default("ZABBIX_STEPS_PER_SCENARIO", 1))
+        self.pool_size = int(get_value_or_default("ZABBIX_POOL_SIZE", 0))
+        self.pool_timeout = int(get_value_or_default("ZABBIX_POOL_TIMEOUT", 600))
+        self.discovery_template_id = None
+        if self.provisioning == "discovery":
+            self.discovery_template_id = get_value("ZABBIX_DISCOVERY_TEMPLATE")
 
-        from pyzabbix import ZabbixAPI
-        self.zapi = ZabbixAPI(url)
+        from healthcheck.backends.client import ZabbixClient
+        self.zapi = ZabbixClient(
+            url,
+            timeout=float(get_value_or_default("ZABBIX_TIMEOUT", 10)),
+            retries=int(get_value_or_default("ZABBIX_API_RETRIES", 2)),
+            connections=int(get_value_or_default("ZABBIX_CONNECTIONS", 10)),
+            limiter=self._limiter(),
+            breaker=self._breaker(url),
+        )
+        self.batch_timeout = float(get_value_or_default("ZABBIX_BATCH_TIMEOUT", 60))
+        self.snapshot_updated_at = None
         self.zapi.login(user, password)
 
         from healthcheck.storage import MongoStorage
         self.storage = MongoStorage()
         self.storage.conn()
 
-    def add_url(self, name, url, expected_string=None, comment=None):
+    def _limiter(self):
+        max_concurrency = int(get_value_or_default("ZABBIX_MAX_CONCURRENCY", 0))
+        if not max_concurrency:
+            return None
+        from healthcheck.backends.limiter import get_limiter
+        return get_limiter(
+            get_value_or_default("ZABBIX_LIMITER_FILE", "/tmp/hcaas-zabbix-limiter"),
+            max_limit=max_concurrency,
+            rate=float(get_value_or_default("ZABBIX_RATE", 0)),
+            target_latency=float(get_value_or_default("ZABBIX_TARGET_LATENCY", 1)),
+        )
+
+    def _breaker(self, url):
+        failure_ratio = float(get_value_or_default("ZABBIX_BREAKER_RATIO", 0.5))
+        if not failure_ratio:
+            return None
+        from healthcheck.backends.breaker import get_breaker
+        return get_breaker(
+            url,
+            failure_ratio=failure_ratio,
+            slow_call=float(get_value_or_default("ZABBIX_BREAKER_SLOW_CALL", 5)),
+            reset_timeout=float(get_value_or_default("ZABBIX_BREAKER_RESET", 30)),
+        )
+
+    def _batch_zapi(self):
+        """
+        Returns the client for array-form writes of many objects.
+        """
+        return self.zapi.batch(self.batch_timeout)
+
+    def _snapshot(self, key, read):
+        """
+        Returns the result of ``read``, or while the circuit breaker is open
+        the last result recorded for ``key``, setting snapshot_updated_at.
+        Snapshots are kept in the process, for the SNAPSHOT_ENTRIES most
+        recent keys, and in mongodb, which is only written when the result
+        changes or every SNAPSHOT_REFRESH seconds.
+        """
+        try:
+            value = read()
+        except CircuitOpenError:
+            snapshot = _snapshots.get(key) or self.storage.find_snapshot(key)
+            metrics.CACHE.labels("snapshot", "hit" if snapshot else "miss").inc()
+            if not snapshot:
+                raise
+            self.snapshot_updated_at = snapshot["updated_at"]
+            return snapshot["value"]
+        now = datetime.datetime.utcnow()
+        local = _snapshots.pop(key, None)
+        if (not local or local["value"] != value or
+                now - local["saved_at"] > datetime.timedelta(seconds=SNAPSHOT_REFRESH)):
+            self.storage.save_snapshot(key, value, now)
+            local = {"value": value, "saved_at": now}
+        local["updated_at"] = now
+        _snapshots[key] = local
+        while len(_snapshots) > SNAPSHOT_ENTRIES:
+            _snapshots.popitem(last=False)
+        return value
+
+    def add_url(self, name, url, expected_string=None, comment=None, interval=None):
+        interval = self._check_interval(interval)
         hc = self.storage.find_healthcheck_by_name(name)
-        item_id = self._add_item(name, url, expected_string)
-        trigger_id = self._add_trigger(name, url, comment)
-        action_id = self._add_action(url, trigger_id, hc.group_id)
-        item = Item(
+        if self._uses_discovery(hc):
+            item = Item(
+                url,
+                group_id=hc.group_id,
+                expected_string=expected_string,
+                comment=comment,
+                interval=interval,
+            )
+        elif self._is_compact(hc):
+            item = self._add_compact_url(hc, url, expected_string, comment, interval)
+        elif self.shared_host:
+            item = self._add_shared_url(hc, url, expected_string, comment, interval)
+        else:
+            instance_name = hc.name if self._is_packed(hc) else None
+            item_name = self._create_item_name(url, instance_name)
+            item_id = self._create_httptest(hc.host_id, item_name, url,
+                                            expected_string, interval)
+            trigger_id = self._add_trigger(self._host_name(hc), url, comment,
+                                           item_name=item_name,
+                                           instance_name=instance_name)
+            item = Item(
+                url,
+                item_id=item_id,
+                trigger_id=trigger_id,
+                group_id=hc.group_id,
+                expected_string=expected_string,
+                comment=comment,
+                interval=interval,
+            )
+        self.storage.add_item(item)
+        if getattr(hc, "proxy_id", None) and not getattr(item, "shared", False):
+            self.storage.increment_proxy_load(hc.proxy_id)
+
+    def _add_shared_url(self, hc, url, expected_string, comment, interval):
+        # instances share the scenarios checking a url with the same
+        # expected string and interval
+        expected_string = expected_string or None
+        item_name = self._create_shared_item_name(url, expected_string, interval)
+        scenario = self._acquire_scenario(url, expected_string, interval, item_name)
+        try:
+            trigger_id = self._add_trigger(self.shared_host, url, comment,
+                                           item_name=item_name,
+                                           instance_name=hc.name)
+        except Exception:
+            self._release_scenario(url, expected_string, interval)
+            raise
+        return Item(
             url,
-            item_id=item_id,
+            item_id=scenario["item_id"],
             trigger_id=trigger_id,
-            action_id=action_id,
             group_id=hc.group_id,
+            interval=interval,
+            expected_string=expected_string,
+            comment=comment,
+            shared=True,
         )
-        self.storage.add_item(item)
 
-    def _add_item(self, healthcheck_name, url, expected_string=None):
-        hc = self.storage.find_healthcheck_by_name(healthcheck_name)
-        item_name = self._create_item_name(url)
-        step = {"name": item_name, "url": url,
-                "status_codes": "200", "no": 1}
+    def _acquire_scenario(self, url, expected_string, interval, item_name):
+        scenario = self.storage.acquire_scenario(url, expected_string, interval)
+        if scenario:
+            return scenario
+        from healthcheck.backends.client import ZabbixAPIException
+        try:
+            item_id = self._create_httptest(self.shared_host_id, item_name, url,
+                                            expected_string, interval)
+        except ZabbixAPIException:
+            # another request created the same scenario concurrently
+            scenario = self.storage.acquire_scenario(url, expected_string, interval)
+            if scenario:
+                return scenario
+            raise
+        return self.storage.add_scenario(url, expected_string, interval, item_id)
+
+    def _release_scenario(self, url, expected_string, interval):
+        scenario = self.storage.release_scenario(url, expected_string, interval)
+        if scenario:
+            self.zapi.httptest.delete(scenario["item_id"])
+
+    def _scenario_key(self, item):
+        return (item.url, getattr(item, "expected_string", None),
+                getattr(item, "interval", None) or self.check_interval)
+
+    def _add_compact_url(self, hc, url, expected_string, comment, interval):
+        item = Item(
+            url,
+            group_id=hc.group_id,
+            expected_string=expected_string,
+            comment=comment,
+            interval=interval,
+            compact=True,
+        )
+        for item_id, steps in self._compact_scenarios(hc).items():
+            if len(steps) < hc.steps_per_scenario and steps[0].interval == interval:
+                self._update_scenario_steps(item_id, steps + [item])
+                item.item_id = item_id
+                item.trigger_id = steps[0].trigger_id
+                return item
+        scenario_name = self._create_scenario_name(hc.name)
+        item_result = self.zapi.httptest.create(**self._httptest_params(
+            hc.host_id, scenario_name, [self._web_step(url, expected_string, 1)],
+            scenario_name, interval))
+        item.item_id = item_result['httptestids'][0]
+        trigger_result = self.zapi.trigger.create(
+            **self._scenario_trigger_params(self._host_name(hc), scenario_name, hc.name))
+        item.trigger_id = trigger_result['triggerids'][0]
+        return item
+
+    def _create_scenario_name(self, instance_name, scenario_id=None):
+        return "hc scenario {} for {}".format(scenario_id or uuid.uuid4().hex[:8], instance_name)[:64]
+
+    def _scenario_trigger_params(self, host_name, scenario_name, instance_name):
+        # web.test.fail holds the number of the failed step, or 0
+        return {
+            "description": "step {{ITEM.VALUE1}} of {} failed [{}]".format(scenario_name, instance_name),
+            "expression": "{%s:web.test.fail[%s].last()}<>0" % (host_name, scenario_name),
+            "priority": 5,
+        }
+
+    def _compact_scenarios(self, hc, exclude_url=None):
+        scenarios = {}
+        for item in self.storage.find_items_by_group(hc.group_id):
+            if getattr(item, "compact", False) and item.url != exclude_url:
+                scenarios.setdefault(item.item_id, []).append(item)
+        for steps in scenarios.values():
+            # step numbers follow the insertion order
+            steps.sort(key=lambda i: getattr(i, "_id", None))
+        return scenarios
+
+    def _update_scenario_steps(self, item_id, items):
+        steps = [self._web_step(i.url, getattr(i, "expected_string", None), no)
+                 for no, i in enumerate(items, 1)]
+        self.zapi.httptest.update(httptestid=item_id, steps=steps)
+
+    def _remove_compact_url(self, hc, item):
+        steps = self._compact_scenarios(hc, exclude_url=item.url).get(item.item_id)
+        if steps:
+            self._update_scenario_steps(item.item_id, steps)
+        else:
+            self.zapi.httptest.delete(item.item_id)
+
+    def failed_url(self, name, scenario_id, step):
+        """
+        Maps an alert of a compact scenario, "step <step> of hc scenario
+        <scenario_id> for <name> failed", back to the url of the failing
+        step. Returns None for unknown scenarios and steps.
+        """
+        hc = self.storage.find_healthcheck_by_name(name)
+        try:
+            step = int(step)
+        except (TypeError, ValueError):
+            return None
+        scenarios = self._get("httptest", ["httptestid"], hostids=[hc.host_id],
+                              filter={"name": self._create_scenario_name(hc.name, scenario_id)})
+        if not scenarios:
+            return None
+        steps = self._compact_scenarios(hc).get(scenarios[0]["httptestid"], [])
+        if 0 < step <= len(steps):
+            return steps[step - 1].url
+        return None
+
+    def _web_step(self, url, expected_string, no, name=None):
+        # the step number keeps truncated step names unique in a scenario
+        step = {"name": name or self._create_item_name(url, str(no)), "url": url,
+                "status_codes": "200", "no": no}
         if expected_string:
             step["required"] = expected_string
-        item_result = self.zapi.httptest.create(
-            name=item_name,
-            steps=[step],
-            hostid=hc.host_id,
-            retries=int(os.environ.get("ZABBIX_RETRIES", 3)),
-        )
+        return step
+
+    def _create_httptest(self, host_id, item_name, url, expected_string=None, interval=None):
+        step = self._web_step(url, expected_string, 1, item_name)
+        item_result = self.zapi.httptest.create(**self._httptest_params(
+            host_id, item_name, [step], url, interval or self.check_interval))
         return item_result['httptestids'][0]
 
-    def _create_item_name(self, url):
+    def _httptest_params(self, host_id, name, steps, jitter_key, interval):
+        return {
+            "name": name,
+            "steps": steps,
+            "hostid": host_id,
+            "retries": int(os.environ.get("ZABBIX_RETRIES", 3)),
+            "delay": self._check_delay(jitter_key, interval),
+        }
+
+    def _check_interval(self, interval):
+        if interval is None or interval == "":
+            return self.check_interval
+        try:
+            interval = int(interval)
+        except (TypeError, ValueError):
+            raise InvalidIntervalError("interval must be an integer number of seconds")
+        if interval < self.min_check_interval:
+            raise InvalidIntervalError(
+                "interval must be at least {} seconds".format(self.min_check_interval))
+        return interval
+
+    def _check_delay(self, url, interval):
+        """
+        Web scenarios have no phase setting and are rescheduled "delay"
+        seconds after their last run, so scenarios created together keep
+        firing together. A deterministic jitter derived from the url makes
+        their periods differ slightly, spreading them over time.
+        """
+        if self.check_jitter is None:
+            max_jitter = interval // 10
+        else:
+            max_jitter = int(self.check_jitter)
+        if max_jitter <= 0:
+            return interval
+        if not isinstance(url, bytes):
+            url = url.encode("utf-8")
+        return interval + (zlib.crc32(url) & 0xffffffff) % (max_jitter + 1)
+
+    def _create_item_name(self, url, instance_name=None):
         name = "hc for {}".format(url)
+        if instance_name:
+            name = "{}: {}".format(instance_name, name)
+        if len(name) <= 64:
+            return name
+        if not instance_name:
+            return name[:61] + "..."
+        # the prefix leaves little of the url, so a hash of it keeps the
+        # names of urls sharing a prefix unique on the host
+        key = url if isinstance(url, bytes) else url.encode("utf-8")
+        suffix = "... {:08x}".format(zlib.crc32(key) & 0xffffffff)
+        return name[:64 - len(suffix)] + suffix
+
+    def _create_shared_item_name(self, url, expected_string=None, interval=None):
+        key = url if not expected_string else u"{}\n{}".format(url, expected_string)
+        if interval:
+            key = u"{}\n{}".format(key, interval)
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        name = "hc {:08x} for {}".format(zlib.crc32(key) & 0xffffffff, url)
         if len(name) > 64:
             return name[:61] + "..."
         return name
 
-    def _add_trigger(self, host_name, url, comment=None):
-        item_name = self._create_item_name(url)
+    def _add_trigger(self, host_name, url, comment=None, item_name=None, instance_name=None):
+        trigger_result = self.zapi.trigger.create(
+            **self._trigger_params(host_name, url, comment, item_name, instance_name))
+        return trigger_result['triggerids'][0]
+
+    def _trigger_params(self, host_name, url, comment=None, item_name=None, instance_name=None):
+        item_name = item_name or self._create_item_name(url)
         status_expression = ("{{%s:web.test.rspcode[{item_name},"
                              "{item_name}].last()}}<>200") % host_name
         failed_expression = "{{%s:web.test.fail[{item_name}].last()}}<>0" % \
@@ -84,42 +414,573 @@ class Zabbix(object):
         expression = ("%s or %s and %s") % \
             (status_expression, failed_expression, string_expression)
 
-        trigger_result = self.zapi.trigger.create(
-            description="trigger for url {}".format(url),
-            expression=expression.format(item_name=item_name),
-            priority=5,
-            comments=comment,
-        )
-        return trigger_result['triggerids'][0]
+        description = "trigger for url {}".format(url)
+        if instance_name:
+            description += " [{}]".format(instance_name)
+        return {
+            "description": description,
+            "expression": expression.format(item_name=item_name),
+            "priority": 5,
+            "comments": comment,
+        }
 
     def remove_url(self, name, url):
-        item = self.storage.find_item_by_url(url)
-        self._remove_action(item.action_id)
-        self.zapi.httptest.delete(item.item_id)
+        hc = self.storage.find_healthcheck_by_name(name)
+        item = self.storage.find_item_by_url(url, hc.group_id)
+        if getattr(item, "shared", False):
+            self.zapi.trigger.delete(item.trigger_id)
+            self._release_scenario(*self._scenario_key(item))
+        elif getattr(item, "compact", False):
+            self._remove_compact_url(hc, item)
+        elif not self._uses_discovery(hc):
+            if getattr(item, "action_id", None):
+                self._remove_action(item.action_id)
+            self.zapi.httptest.delete(item.item_id)
         self.storage.remove_item(item)
+        if getattr(hc, "proxy_id", None) and not getattr(item, "shared", False):
+            self.storage.increment_proxy_load(hc.proxy_id, -1)
 
     def list_urls(self, name):
-        urls_comments = []
-        urls = self.storage.find_urls_by_healthcheck_name(name)
-        for url in urls:
-            url_comment = [url]
-            item = self.storage.find_item_by_url(url)
-            trigger = self.zapi.trigger.get(triggerids=item.trigger_id)
-            url_comment.append(trigger[0].get('comments', ""))
-            urls_comments.append(url_comment)
-        return urls_comments
+        hc = self.storage.find_healthcheck_by_name(name)
+        if self._uses_discovery(hc) or self._is_compact(hc):
+            items = self.storage.find_items_by_group(hc.group_id)
+            return [[i.url, getattr(i, "comment", None) or ""] for i in items]
+        return self._snapshot("list_urls:" + name, lambda: self._list_urls(hc))
+
+    def _list_urls(self, hc):
+        items = self.storage.find_items_by_group(hc.group_id)
+        comments = {}
+        if items:
+            triggers = self._get("trigger", ["triggerid", "comments"],
+                                 triggerids=[i.trigger_id for i in items])
+            comments = dict((t["triggerid"], t.get("comments", "")) for t in triggers)
+        return [[i.url, comments.get(i.trigger_id, "")] for i in items]
+
+    def _get(self, obj, output, limit=None, **params):
+        return Query(obj, output, limit, **params).run(self.zapi)
+
+    def discovery(self, name):
+        """
+        Returns the instance urls in the low-level discovery format, with
+        the macros used by the prototypes of the discovery template.
+        """
+        hc = self.storage.find_healthcheck_by_name(name)
+        data = []
+        for item in self.storage.find_items_by_group(hc.group_id):
+            interval = getattr(item, "interval", None) or self.check_interval
+            data.append({
+                "{#URL}": item.url,
+                "{#NAME}": self._create_item_name(item.url),
+                "{#EXPECTED_STRING}": getattr(item, "expected_string", None) or "",
+                "{#COMMENT}": getattr(item, "comment", None) or "",
+                "{#INTERVAL}": self._check_delay(item.url, interval),
+            })
+        return data
+
+    def clone(self, name, source):
+        """
+        Copies the urls, watchers and host groups of the source instance to
+        the instance, with a fixed number of calls: the scenarios and
+        triggers of all urls are created with one array-form call each.
+        Urls the instance already checks are kept. Instances checking urls
+        through shared or compact scenarios add them one at a time.
+        """
+        hc = self.storage.find_healthcheck_by_name(name)
+        src = self.storage.find_healthcheck_by_name(source)
+        if hc.name == src.name:
+            raise InvalidCloneError("can't clone an instance into itself")
+        current = set(i.url for i in self.storage.find_items_by_group(hc.group_id))
+        urls = [u for u in self._url_details(src) if u[0] not in current]
+        if self._uses_discovery(hc):
+            items = [Item(url, group_id=hc.group_id, expected_string=expected_string,
+                          comment=comment, interval=interval)
+                     for url, expected_string, comment, interval in urls]
+        elif self._is_compact(hc) or self.shared_host:
+            for url, expected_string, comment, interval in urls:
+                self.add_url(name, url, expected_string, comment, interval)
+            items = []
+        else:
+            items = self._create_urls(hc, urls)
+        if items:
+            self.storage.add_items(items)
+            if getattr(hc, "proxy_id", None):
+                self.storage.increment_proxy_load(hc.proxy_id, len(items))
+        self._clone_watchers_and_groups(hc, src)
+
+    def _url_details(self, hc):
+        """
+        Returns (url, expected string, comment, interval) of the urls of an
+        instance. Per-url scenarios created before they were recorded in
+        mongodb keep them in zabbix only.
+        """
+        items = self.storage.find_items_by_group(hc.group_id)
+        in_zabbix = [i for i in items if self._details_in_zabbix(hc, i)]
+        steps, comments = {}, {}
+        if in_zabbix:
+            httptests = self._get("httptest", ["httptestid"], selectSteps=["required"],
+                                  httptestids=[i.item_id for i in in_zabbix])
+            steps = dict((h["httptestid"], h["steps"]) for h in httptests)
+            triggers = self._get("trigger", ["triggerid", "comments"],
+                                 triggerids=[i.trigger_id for i in in_zabbix])
+            comments = dict((t["triggerid"], t["comments"]) for t in triggers)
+        urls = []
+        for item in items:
+            if self._details_in_zabbix(hc, item):
+                item_steps = steps.get(item.item_id) or [{}]
+                expected_string = item_steps[0].get("required") or None
+                comment = comments.get(item.trigger_id) or None
+            else:
+                expected_string = getattr(item, "expected_string", None)
+                comment = getattr(item, "comment", None)
+            urls.append((item.url, expected_string, comment,
+                         getattr(item, "interval", None) or self.check_interval))
+        return urls
+
+    def _per_url_scenario(self, hc, item):
+        return not (self._uses_discovery(hc) or getattr(item, "compact", False) or
+                    getattr(item, "shared", False))
+
+    def _details_in_zabbix(self, hc, item):
+        return (self._per_url_scenario(hc, item) and
+                not hasattr(item, "expected_string") and not hasattr(item, "comment"))
+
+    def _create_urls(self, hc, urls):
+        if not urls:
+            return []
+        instance_name = hc.name if self._is_packed(hc) else None
+        item_names = [self._create_item_name(u[0], instance_name) for u in urls]
+        httptests = [self._httptest_params(hc.host_id, item_name,
+                                           [self._web_step(url, expected_string, 1, item_name)],
+                                           url, interval)
+                     for item_name, (url, expected_string, _, interval) in zip(item_names, urls)]
+        zapi = self._batch_zapi()
+        item_ids = zapi.httptest.create(*httptests)["httptestids"]
+        triggers = [self._trigger_params(self._host_name(hc), url, comment, item_name, instance_name)
+                    for item_name, (url, _, comment, _) in zip(item_names, urls)]
+        trigger_ids = zapi.trigger.create(*triggers)["triggerids"]
+        return [Item(url, item_id=item_id, trigger_id=trigger_id, group_id=hc.group_id,
+                     expected_string=expected_string, comment=comment, interval=interval)
+                for (url, expected_string, comment, interval), item_id, trigger_id
+                in zip(urls, item_ids, trigger_ids)]
+
+    def _clone_watchers_and_groups(self, hc, src):
+        users = self.storage.find_users_by_group(hc.group_id)
+        user_ids = [u.id for u in users]
+        new_users = [u.id for u in self.storage.find_users_by_group(src.group_id)
+                     if u.id not in user_ids]
+        new_groups = [g for g in src.host_groups if g not in hc.host_groups]
+        if not new_users and not new_groups:
+            return
+        host_groups = hc.host_groups + new_groups
+        self.zapi.usergroup.update(
+            usrgrpid=hc.group_id,
+            userids=user_ids + new_users,
+            rights=[{"permission": 2, "id": gid} for gid in host_groups],
+        )
+        if new_groups and not self._is_packed(hc):
+            self.zapi.host.update(
+                hostid=hc.host_id,
+                groups=[{"groupid": gid} for gid in host_groups],
+            )
+        self.storage.add_users_to_group(new_users, hc.group_id)
+        self.storage.add_groups_to_instance(hc, new_groups)
+
+    def _uses_discovery(self, hc):
+        return getattr(hc, "provisioning", None) == "discovery"
+
+    def _is_compact(self, hc):
+        return (getattr(hc, "steps_per_scenario", None) or 1) > 1
+
+    def _is_packed(self, hc):
+        return getattr(hc, "packed", False)
+
+    def _host_name(self, hc):
+        return getattr(hc, "host_name", None) or hc.name
 
     def new(self, name):
-        host = self._add_host(name, self.host_group_id)
-        group = self._create_user_group(name, self.host_group_id)
+        if self.storage.find_removed_healthcheck(name):
+            self._collect_now(name)
+        packed = self.instances_per_host > 1 and not self.discovery_template_id
+        pool_entry = None
+        group = action = None
+        if packed:
+            packed_host = self._claim_packed_host()
+            host = packed_host["host_id"]
+            host_name = packed_host["name"]
+            proxy_id = packed_host.get("proxy_id")
+        else:
+            pool_entry = self._claim_pool_entry(name)
+            if pool_entry:
+                host = pool_entry["host_id"]
+                group = pool_entry["group_id"]
+                # entries filled by older versions have no action
+                action = pool_entry.get("action_id")
+                proxy_id = pool_entry.get("proxy_id")
+            else:
+                proxy_id = self._choose_proxy()
+                host = self._add_host(name, self.host_group_id, proxy_id,
+                                      self.discovery_template_id)
+            host_name = name
+        if not group:
+            group = self._create_user_group(name, self.host_group_id)
+        if not action:
+            action = self._add_action(name, None if packed else host, group)
         hc = HealthCheck(
             name=name,
             host_group_id=self.host_group_id,
             host_groups=[self.host_group_id],
             host_id=host,
-            group_id=group
+            host_name=host_name,
+            packed=packed,
+            group_id=group,
+            action_id=action,
+            proxy_id=proxy_id,
+            provisioning=self.provisioning,
+            steps_per_scenario=self.steps_per_scenario,
         )
         self.storage.add_healthcheck(hc)
+        if pool_entry:
+            self.storage.remove_pool_entry(pool_entry)
+            self._refill_pool()
+
+    def _claim_pool_entry(self, name):
+        """
+        Takes a ready host, user group and action from the pool and renames
+        the host after the instance. The user group and the action keep
+        their pool name, and the action only matches the triggers the
+        instance owns on the shared host once renamed, so it's only updated
+        with ZABBIX_SHARED_HOST set. A pair claimed by a request that fails
+        afterwards is removed by reclaim_pool.
+        """
+        if not self.pool_size:
+            return None
+        entry = self.storage.claim_pool_entry(name)
+        if not entry:
+            self._refill_pool()
+            return None
+        params = {"hostid": entry["host_id"], "host": name}
+        if self.discovery_template_id:
+            params["macros"] = [{"macro": "{$HCAAS_INSTANCE}", "value": name}]
+        self.zapi.host.update(**params)
+        if self.shared_host and entry.get("action_id"):
+            action = self._action_params(name, entry["host_id"], entry["group_id"])
+            self.zapi.action.update(actionid=entry["action_id"], name=action["name"],
+                                    evaltype=action["evaltype"], formula=action["formula"],
+                                    conditions=action["conditions"])
+        return entry
+
+    def _refill_pool(self):
+        # a fill running in the process already covers the claim
+        if not _pool_fill.locked():
+            self._in_background(self.fill_pool, "failed to fill the zabbix pool")
+
+    def _in_background(self, target, error):
+        def run():
+            try:
+                target()
+            except Exception:
+                logging.getLogger(__name__).exception(error)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def fill_pool(self):
+        """
+        Creates the host, user group and action triples missing from the
+        pool, with one array-form call for each. One fill runs at a time,
+        holding a process lock and a mongodb lock for ZABBIX_POOL_TIMEOUT
+        seconds, and other fills return at once. Pool entries are recorded
+        before the zabbix objects are created, so reclaim_pool finds the
+        objects of a fill that failed halfway. Returns the number of
+        triples created.
+        """
+        if not _pool_fill.acquire(False):
+            return 0
+        try:
+            if not self.storage.acquire_lock("pool_fill", self.pool_timeout):
+                return 0
+            try:
+                return self._fill_pool()
+            finally:
+                self.storage.release_lock("pool_fill")
+        finally:
+            _pool_fill.release()
+
+    def _fill_pool(self):
+        missing = self.pool_size - self.storage.count_pool_entries()
+        if missing <= 0:
+            return 0
+        names = ["hcaas-pool-{}".format(uuid.uuid4().hex[:12]) for _ in range(missing)]
+        proxies = self._choose_proxies(missing)
+        entries = self.storage.add_pool_entries(names, proxies)
+        zapi = self._batch_zapi()
+        hosts = zapi.host.create(*[
+            self._host_params(name, [self.host_group_id], proxy_id, self.discovery_template_id)
+            for name, proxy_id in zip(names, proxies)])["hostids"]
+        groups = zapi.usergroup.create(*[
+            {"name": name, "rights": {"permission": 2, "id": self.host_group_id}}
+            for name in names])["usrgrpids"]
+        actions = zapi.action.create(*[
+            self._action_params(name, host_id, group_id)
+            for name, host_id, group_id in zip(names, hosts, groups)])["actionids"]
+        self.storage.set_pool_entries_ready(list(zip(entries, hosts, groups, actions)))
+        return missing
+
+    def reclaim_pool(self):
+        """
+        Deletes the zabbix objects of pool entries left behind by fills and
+        claims that didn't finish within ZABBIX_POOL_TIMEOUT seconds.
+        Returns the number of entries removed.
+        """
+        entries = self.storage.find_stale_pool_entries(self.pool_timeout)
+        if not entries:
+            return 0
+        instances = [e["instance"] for e in entries if e.get("instance")]
+        hosts = dict((hc.name, hc.host_id)
+                     for hc in self.storage.find_healthchecks_by_names(instances))
+        leaked = [e for e in entries
+                  if not e.get("instance") or hosts.get(e["instance"]) != e.get("host_id")]
+        names = [e["name"] for e in leaked if not e.get("host_id")]
+        host_ids = [e["host_id"] for e in leaked if e.get("host_id")]
+        group_ids = [e["group_id"] for e in leaked if e.get("group_id")]
+        action_ids = [e["action_id"] for e in leaked if e.get("action_id")]
+        if names:
+            host_ids += [h["hostid"] for h in self._get(
+                "host", ["hostid"], filter={"host": names})]
+            group_ids += [g["usrgrpid"] for g in self._get(
+                "usergroup", ["usrgrpid"], filter={"name": names})]
+            action_ids += [a["actionid"] for a in self._get(
+                "action", ["actionid"],
+                filter={"name": [self._action_params(n, None, None)["name"] for n in names]})]
+        # actions first, they reference the user groups
+        if action_ids:
+            self.zapi.action.delete(*action_ids)
+        if host_ids:
+            self.zapi.host.delete(*host_ids)
+        if group_ids:
+            self.zapi.usergroup.delete(*group_ids)
+        self.storage.remove_pool_entries(entries)
+        return len(entries)
+
+    def new_many(self, names):
+        """
+        Creates many instances with one array-form call per kind of zabbix
+        object and a single mongodb insert. Returns a list of dicts with
+        the name and either "created" or an "error" message, in the order
+        of the names. Packed instances are created one at a time, since
+        they claim their hosts one by one. Removed instances with one of
+        the names are collected first, as in new.
+        """
+        results = dict((name, None) for name in names)
+        found = self.storage.find_healthchecks_by_names(names, with_removed=True)
+        exists = set(hc.name for hc in found if not getattr(hc, "removed", False))
+        for name in set(hc.name for hc in found if getattr(hc, "removed", False)) - exists:
+            try:
+                self._collect_now(name)
+            except RemovalPendingError as e:
+                results[name] = _error_message(e)
+        exists.update(h["host"] for h in self._get("host", ["host"], filter={"host": names}))
+        for name in exists:
+            results[name] = results[name] or "instance already exists"
+        pending = []
+        for name in names:
+            if results[name] is None and name not in pending:
+                pending.append(name)
+        if self.instances_per_host > 1 and not self.discovery_template_id:
+            for name in pending:
+                try:
+                    self.new(name)
+                except Exception as e:
+                    results[name] = _error_message(e)
+        elif pending:
+            try:
+                self._new_many(pending)
+            except Exception as e:
+                for name in pending:
+                    results[name] = _error_message(e)
+        return [{"name": name, "error": results[name]} if results[name] else
+                {"name": name, "created": True} for name in names]
+
+    def _new_many(self, names):
+        """
+        Creates the zabbix objects and the instances of ``names``. When a
+        call fails, the objects already created for the batch are deleted,
+        so the names can be used again.
+        """
+        proxies = self._choose_proxies(len(names))
+        zapi = self._batch_zapi()
+        created = []
+        try:
+            hosts = zapi.host.create(*[
+                self._host_params(name, [self.host_group_id], proxy_id, self.discovery_template_id)
+                for name, proxy_id in zip(names, proxies)])["hostids"]
+            created.append(("host", hosts))
+            groups = zapi.usergroup.create(*[
+                {"name": name, "rights": {"permission": 2, "id": self.host_group_id}}
+                for name in names])["usrgrpids"]
+            created.append(("usergroup", groups))
+            actions = zapi.action.create(*[
+                self._action_params(name, host, group)
+                for name, host, group in zip(names, hosts, groups)])["actionids"]
+            created.append(("action", actions))
+            self._add_new_healthchecks(names, hosts, groups, actions, proxies)
+        except Exception:
+            self._delete_created(zapi, created)
+            raise
+
+    def _delete_created(self, zapi, created):
+        for obj, ids in reversed(created):
+            try:
+                getattr(zapi, obj).delete(*ids)
+            except Exception as error:
+                logging.getLogger(__name__).exception(error)
+
+    def _add_new_healthchecks(self, names, hosts, groups, actions, proxies):
+        self.storage.add_healthchecks([
+            HealthCheck(
+                name=name,
+                host_group_id=self.host_group_id,
+                host_groups=[self.host_group_id],
+                host_id=host,
+                host_name=name,
+                packed=False,
+                group_id=group,
+                action_id=action,
+                proxy_id=proxy_id,
+                provisioning=self.provisioning,
+                steps_per_scenario=self.steps_per_scenario,
+            )
+            for name, host, group, action, proxy_id in zip(names, hosts, groups, actions, proxies)
+        ])
+
+    def _choose_proxies(self, count):
+        """
+        Spreads new hosts over the least loaded proxies, counting each new
+        host as one scenario.
+        """
+        if not self.proxies:
+            return [None] * count
+        loads = self.storage.find_proxy_loads(self.proxies)
+        chosen = []
+        for _ in range(count):
+            proxy_id = min(self.proxies, key=lambda p: loads.get(p, 0))
+            loads[proxy_id] = loads.get(proxy_id, 0) + 1
+            chosen.append(proxy_id)
+        return chosen
+
+    def _claim_packed_host(self):
+        packed_host = self.storage.claim_packed_host(self.instances_per_host)
+        if packed_host:
+            return packed_host
+        proxy_id = self._choose_proxy()
+        host_name = "hcaas-pack-{}".format(uuid.uuid4().hex[:12])
+        host = self._add_host(host_name, self.host_group_id, proxy_id)
+        return self.storage.add_packed_host(host, host_name, proxy_id)
+
+    def merge_actions(self):
+        """
+        Replaces the per-url actions created by older versions with a single
+        action per instance, with one array-form call to create the
+        instance actions and one to delete the per-url ones. Safe to run
+        more than once. Returns the number of per-url actions removed.
+        """
+        healthchecks = self.storage.find_healthchecks()
+        actions = {}
+        for item in self.storage.find_items_by_groups([hc.group_id for hc in healthchecks]):
+            if getattr(item, "action_id", None):
+                actions.setdefault(item.group_id, []).append(item.action_id)
+        zapi = self._batch_zapi()
+        missing = [hc for hc in healthchecks if not getattr(hc, "action_id", None)]
+        if missing:
+            action_ids = zapi.action.create(*[
+                self._action_params(hc.name, None if self._is_packed(hc) else hc.host_id, hc.group_id)
+                for hc in missing])["actionids"]
+            self.storage.set_healthchecks_actions(list(zip(missing, action_ids)))
+        group_ids = [hc.group_id for hc in healthchecks if hc.group_id in actions]
+        removed = [action_id for group_id in group_ids for action_id in actions[group_id]]
+        if removed:
+            zapi.action.delete(*removed)
+            self.storage.unset_items_actions(group_ids)
+        return len(removed)
+
+    def _choose_proxy(self):
+        if not self.proxies:
+            return None
+        loads = self.storage.find_proxy_loads(self.proxies)
+        return min(self.proxies, key=lambda p: loads.get(p, 0))
+
+    def rebalance_proxies(self):
+        """
+        Moves hosts between the configured proxies so that every proxy runs
+        roughly the same number of web scenarios. Hosts assigned to proxies
+        that are no longer in the pool are always moved. Returns a list of
+        (healthcheck name, old proxy, new proxy) tuples.
+        """
+        if not self.proxies:
+            return []
+        counts = self.storage.count_items_by_group()
+        healthchecks = self.storage.find_healthchecks()
+        # packed instances share a host, so hosts are moved as a unit
+        units = {}
+        for hc in healthchecks:
+            unit = units.setdefault(hc.host_id, [0, []])
+            unit[0] += counts.get(hc.group_id, 0)
+            unit[1].append(hc)
+
+        loads = dict((p, 0) for p in self.proxies)
+        hosts = dict((p, []) for p in self.proxies)
+        orphans = []
+        for host_id, (scenarios, hcs) in units.items():
+            proxy_id = getattr(hcs[0], "proxy_id", None)
+            if proxy_id in loads:
+                loads[proxy_id] += scenarios
+                hosts[proxy_id].append((scenarios, host_id))
+            else:
+                orphans.append((scenarios, host_id))
+
+        placement = {}
+        for scenarios, host_id in sorted(orphans, key=lambda o: -o[0]):
+            target = min(self.proxies, key=lambda p: loads[p])
+            loads[target] += scenarios
+            hosts[target].append((scenarios, host_id))
+            placement[host_id] = target
+
+        for _ in range(len(units)):
+            heaviest = max(self.proxies, key=lambda p: loads[p])
+            lightest = min(self.proxies, key=lambda p: loads[p])
+            gap = loads[heaviest] - loads[lightest]
+            movable = [h for h in hosts[heaviest] if 0 < h[0] < gap]
+            if not movable:
+                break
+            host = min(movable, key=lambda h: abs(gap - 2 * h[0]))
+            hosts[heaviest].remove(host)
+            hosts[lightest].append(host)
+            loads[heaviest] -= host[0]
+            loads[lightest] += host[0]
+            placement[host[1]] = lightest
+
+        moves = []
+        by_proxy = {}
+        for host_id, (scenarios, hcs) in units.items():
+            target = placement.get(host_id)
+            old = getattr(hcs[0], "proxy_id", None)
+            if target is None or target == old:
+                continue
+            by_proxy.setdefault(target, []).append(host_id)
+            moves.extend((hc.name, old, target) for hc in hcs)
+        for proxy_id, host_ids in by_proxy.items():
+            self.zapi.host.massupdate(
+                hosts=[{"hostid": host_id} for host_id in host_ids],
+                proxy_hostid=proxy_id,
+            )
+            for host_id in host_ids:
+                for hc in units[host_id][1]:
+                    self.storage.set_healthcheck_proxy(hc, proxy_id)
+                if self._is_packed(units[host_id][1][0]):
+                    self.storage.set_packed_host_proxy(host_id, proxy_id)
+        for proxy_id, scenarios in loads.items():
+            self.storage.set_proxy_load(proxy_id, scenarios)
+        return moves
 
     def add_watcher(self, name, email, password=None):
         hc = self.storage.find_healthcheck_by_name(name)
@@ -145,23 +1006,24 @@ class Zabbix(object):
         self.storage.add_user_to_group(user, hc.group_id)
 
     def _add_new_user(self, hc, email, password):
-        result = self.zapi.user.create(
-            alias=email,
-            passwd=password,
-            usrgrps=[{
-                "usrgrpid": hc.group_id,
-            }],
-            user_medias=[{
+        result = self.zapi.user.create(**self._user_params(email, password, [hc.group_id]))
+        user_id = result["userids"][0]
+        user = User(user_id, email, hc.group_id)
+        self.storage.add_user(user)
+
+    def _user_params(self, email, password, group_ids):
+        return {
+            "alias": email,
+            "passwd": password,
+            "usrgrps": [{"usrgrpid": group_id} for group_id in group_ids],
+            "user_medias": [{
                 "mediatypeid": "1",
                 "sendto": email,
                 "active": 0,
                 "severity": 63,
                 "period": "1-7,00:00-24:00",
             }],
-        )
-        user_id = result["userids"][0]
-        user = User(user_id, email, hc.group_id)
-        self.storage.add_user(user)
+        }
 
     def list_watchers(self, name):
         return self.storage.find_watchers_by_healthcheck_name(name)
@@ -190,30 +1052,126 @@ class Zabbix(object):
         self.storage.remove_user(user)
 
     def remove(self, name):
-        urls = self.storage.find_urls_by_healthcheck_name(name)
-        for url in urls:
-            self.remove_url(name, url)
+        """
+        Marks the instance as removed and returns. Its zabbix objects are
+        deleted later by collect_removed, together with those of other
+        removed instances.
+        """
+        healthcheck = self.storage.find_healthcheck_by_name(name)
+        self.storage.tombstone_healthcheck(healthcheck)
+        self._in_background(self.collect_removed, "failed to collect removed instances")
 
-        watchers = self.list_watchers(name)
-        for watcher in watchers:
-            self.remove_watcher(name, watcher)
+    def collect_removed(self, limit=100):
+        """
+        Deletes the zabbix objects and records of up to ``limit`` removed
+        instances, with one array-form delete per kind of object. A failed
+        collection is retried by a later run, after a backoff doubling with
+        each attempt. Returns the number of instances collected.
+        """
+        healthchecks = self.storage.claim_removed_healthchecks(limit, REMOVAL_LEASE)
+        if not healthchecks:
+            return 0
+        try:
+            self._collect(healthchecks)
+        except Exception:
+            for hc in healthchecks:
+                self.storage.defer_removal(hc, self._removal_backoff(hc))
+            raise
+        return len(healthchecks)
 
-        healthcheck = self.storage.find_healthcheck_by_name(name)
-        self._remove_user_group(healthcheck.group_id)
-        self._remove_host(healthcheck.host_id)
-        self.storage.remove_healthcheck(healthcheck)
+    def _collect_now(self, name):
+        """
+        Collects a removed instance whose name is being reused.
+        """
+        healthchecks = self.storage.claim_removed_healthchecks(1, REMOVAL_LEASE, name)
+        if not healthchecks:
+            raise RemovalPendingError(
+                "instance {} is still being removed, try again later".format(name))
+        try:
+            self._collect(healthchecks)
+        except Exception:
+            self.storage.defer_removal(healthchecks[0], self._removal_backoff(healthchecks[0]))
+            raise RemovalPendingError(
+                "instance {} is still being removed, try again later".format(name))
+
+    def _removal_backoff(self, hc):
+        return min(REMOVAL_BACKOFF * 2 ** getattr(hc, "attempts", 0), REMOVAL_MAX_BACKOFF)
+
+    def _collect(self, healthchecks):
+        group_ids = [hc.group_id for hc in healthchecks]
+        packed_groups = set(hc.group_id for hc in healthchecks if self._is_packed(hc))
+        items = self.storage.find_items_by_groups(group_ids)
+        shared = [i for i in items if getattr(i, "shared", False)]
+        action_ids = [hc.action_id for hc in healthchecks if getattr(hc, "action_id", None)]
+        action_ids += [i.action_id for i in items if getattr(i, "action_id", None)]
+        # scenarios and triggers on an instance host go away with the host
+        httptest_ids = set(i.item_id for i in items
+                           if i.group_id in packed_groups and not getattr(i, "shared", False))
+        released = {}
+        for item in shared:
+            key = self._scenario_key(item)
+            released[key] = released.get(key, 0) + 1
+        for scenario in self.storage.find_scenarios([url for url, _, _ in released]):
+            key = (scenario["url"], scenario.get("expected_string"), scenario.get("interval"))
+            if scenario["refs"] <= released.get(key, 0):
+                httptest_ids.add(scenario["item_id"])
+        users = [u for u in self.storage.find_users_by_groups(group_ids)
+                 if set(u.groups_id) <= set(group_ids)]
+
+        self._delete("action", "actionid", action_ids)
+        self._delete("trigger", "triggerid", [i.trigger_id for i in shared])
+        self._delete("httptest", "httptestid", sorted(httptest_ids))
+        self._delete("user", "userid", [u.id for u in users])
+        self._delete("usergroup", "usrgrpid", group_ids)
+        self._delete("host", "hostid", [hc.host_id for hc in healthchecks
+                                        if hc.group_id not in packed_groups])
+
+        # mongodb is changed last, so a failed collection starts over from
+        # the same records
+        self.storage.release_scenarios(released)
+        self.storage.remove_users(users)
+        self.storage.remove_groups_from_users(group_ids)
+        for hc in healthchecks:
+            if hc.group_id in packed_groups:
+                self.storage.release_packed_host(hc.host_id)
+            count = len([i for i in items if i.group_id == hc.group_id and
+                         not getattr(i, "shared", False)])
+            if getattr(hc, "proxy_id", None) and count:
+                self.storage.increment_proxy_load(hc.proxy_id, -count)
+        self.storage.remove_items_by_groups(group_ids)
+        self.storage.remove_healthchecks(healthchecks)
+
+    def _delete(self, obj, id_field, ids):
+        """
+        Deletes the objects that still exist, so retrying a collection
+        doesn't fail on the objects a previous attempt deleted.
+        """
+        if not ids:
+            return
+        existing = [o[id_field] for o in self._get(obj, [id_field], **{id_field + "s": ids})]
+        if existing:
+            getattr(self._batch_zapi(), obj).delete(*existing)
 
     def list_service_groups(self, keyword=None):
+        # searches are not snapshotted, their keys are unbounded
+        if keyword:
+            return self._list_service_groups(keyword)
+        return self._snapshot("list_service_groups:", lambda: self._list_service_groups(None))
+
+    def _list_service_groups(self, keyword):
         if keyword:
-            groups = self.zapi.hostgroup.get(search={"name": [keyword]}, startSearch=True)
+            groups = self._get("hostgroup", ["name"], search={"name": [keyword]}, startSearch=True)
         else:
-            groups = self.zapi.hostgroup.get()
+            groups = self._get("hostgroup", ["name"])
         group_names = [group.get('name') for group in groups]
         return group_names
 
     def list_groups(self, name):
         hc = self.storage.find_healthcheck_by_name(name)
-        groups = self.zapi.hostgroup.get(groupids=hc.host_groups)
+        return self._snapshot("list_groups:" + name, lambda: self._list_groups(hc))
+
+    def _list_groups(self, hc):
+        groups = self._get("hostgroup", ["name"], groupids=hc.host_groups)
         group_names = [group.get('name') for group in groups]
         return group_names
 
@@ -229,12 +1187,14 @@ class Zabbix(object):
             usrgrpid=hc.group_id,
             rights=groups,
         )
-        groups = [{"groupid": gid} for gid in hc.host_groups]
-        groups.append({"groupid": host_group_id})
-        self.zapi.host.update(
-            hostid=hc.host_id,
-            groups=groups,
-        )
+        if not self._is_packed(hc):
+            # a packed host is shared, its groups can't follow one instance
+            groups = [{"groupid": gid} for gid in hc.host_groups]
+            groups.append({"groupid": host_group_id})
+            self.zapi.host.update(
+                hostid=hc.host_id,
+                groups=groups,
+            )
         return self.storage.add_group_to_instance(hc, host_group_id)
 
     def remove_group(self, name, group):
@@ -255,24 +1215,46 @@ class Zabbix(object):
             usrgrpid=hc.group_id,
             rights=groups,
         )
-        groups = [{"groupid": gid}
-                  for gid in hc.host_groups if gid != host_group_id]
-        self.zapi.host.update(
-            hostid=hc.host_id,
-            groups=groups,
-        )
+        if not self._is_packed(hc):
+            groups = [{"groupid": gid}
+                      for gid in hc.host_groups if gid != host_group_id]
+            self.zapi.host.update(
+                hostid=hc.host_id,
+                groups=groups,
+            )
         self.storage.remove_group_from_instance(hc, host_group_id)
 
     def _get_host_group_id(self, group):
-        result = self.zapi.hostgroup.get(filter={"name": [group]})
+        result = self._get("hostgroup", ["groupid"], limit=1, filter={"name": [group]})
         if result:
             return result[0]["groupid"]
         else:
             raise GroupNotExists()
 
-    def _add_action(self, url, trigger_id, group_id):
-        result = self.zapi.action.create(
-            name="action for url {}".format(url),
+    def _add_action(self, name, host_id, group_id):
+        result = self.zapi.action.create(**self._action_params(name, host_id, group_id))
+        return result["actionids"][0]
+
+    def _action_params(self, name, host_id, group_id):
+        conditions = [
+            # Maintenance status not in maintenance
+            {"conditiontype": 16, "value": "", "operator": 7,
+             "formulaid": "A"},
+            # Trigger value = PROBLEM
+            {"conditiontype": 5, "value": "1", "formulaid": "B"},
+        ]
+        if host_id:
+            # Host = instance host
+            conditions.append({"conditiontype": 1, "operator": 0,
+                               "value": host_id, "formulaid": "C"})
+        # Trigger name like [instance name], for the triggers the instance
+        # owns on shared or packed hosts
+        conditions.append({"conditiontype": 3, "operator": 2,
+                           "value": "[{}]".format(name),
+                           "formulaid": "D" if host_id else "C"})
+        formula = "A and B and (C or D)" if host_id else "A and B and C"
+        return dict(
+            name="action for {}".format(name),
             eventsource=0,
             recovery_msg=1,
             status=0,
@@ -284,15 +1266,9 @@ class Zabbix(object):
             r_shortdata="hcaas {HOST.NAME} #{EVENT.ID} {TRIGGER.STATUS}",
             r_longdata=("{TRIGGER.NAME}: {TRIGGER.STATUS}\r\n"
                         "HTTP status code: {ITEM.VALUE1}"),
-            evaltype=0,
-            conditions=[
-                # Maintenance status not in maintenance
-                {"conditiontype": 16, "value": "", "operator": 7},
-                # Trigger value = PROBLEM
-                {"conditiontype": 5, "value": "1"},
-                # Trigger = trigger id
-                {"conditiontype": 2, "value": trigger_id},
-            ],
+            evaltype=3,
+            formula=formula,
+            conditions=conditions,
             operations=[
                 {
                     "operationtype": 0,
@@ -313,7 +1289,6 @@ class Zabbix(object):
                 }
             ],
         )
-        return result["actionids"][0]
 
     def _create_user_group(self, name, host_group):
         result = self.zapi.usergroup.create(
@@ -322,20 +1297,29 @@ class Zabbix(object):
         )
         return result["usrgrpids"][0]
 
-    def _add_host(self, name, host_group):
-        result = self.zapi.host.create(
-            host=name,
-            groups=[{"groupid": host_group}],
-            interfaces=[{
+    def _add_host(self, name, host_group, proxy_id=None, template_id=None):
+        result = self.zapi.host.create(**self._host_params(name, [host_group], proxy_id, template_id))
+        return result["hostids"][0]
+
+    def _host_params(self, name, host_groups, proxy_id=None, template_id=None):
+        params = {
+            "host": name,
+            "groups": [{"groupid": gid} for gid in host_groups],
+            "interfaces": [{
                 "type": 1,
                 "main": 1,
                 "useip": 1,
                 "ip": "127.0.0.1",
                 "dns": "",
                 "port": "10050"
-            }]
-        )
-        return result["hostids"][0]
+            }],
+        }
+        if proxy_id:
+            params["proxy_hostid"] = proxy_id
+        if template_id:
+            params["templates"] = [{"templateid": template_id}]
+            params["macros"] = [{"macro": "{$HCAAS_INSTANCE}", "value": name}]
+        return params
 
     def _remove_host(self, id):
         self.zapi.host.delete(id)
@@ -361,3 +1345,15 @@ class GroupNotInInstanceError(Exception):
 
 class GroupNotExists(Exception):
     pass
+
+
+class InvalidIntervalError(Exception):
+    pass
+
+
+class InvalidCloneError(Exception):
+    pass
+
+
+class RemovalPendingError(Exception):
+    pass
@@ -0,0 +1,122 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+import logging
+import threading
+import time
+
+from healthcheck import metrics
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """
+    Fails zabbix calls fast while zabbix is unhealthy.
+
+    The breaker opens when at least ``failure_ratio`` of the last
+    ``window`` calls failed, a call failing when it doesn't get a response,
+    gets a 5xx or takes more than ``slow_call`` seconds. Once open, calls
+    raise CircuitOpenError for ``reset_timeout`` seconds, then a single
+    call probes zabbix: the breaker closes if it succeeds and opens again
+    otherwise.
+    """
+
+    def __init__(self, window=20, min_calls=10, failure_ratio=0.5, slow_call=5,
+                 reset_timeout=30):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.calls = collections.deque(maxlen=window)
+        self.opened_at = None
+        self.probe_started_at = None
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Raises CircuitOpenError unless a call may be sent now.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.time()
+            if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+            # a probe that never reported back doesn't hold the breaker forever
+            if self.state == HALF_OPEN and (self.probe_started_at is None or
+                                            now - self.probe_started_at >= self.reset_timeout):
+                self.probe_started_at = now
+                return
+            self.counters["rejected"] += 1
+            metrics.BREAKER_REJECTED.inc()
+            # while a probe is in flight, calls may retry once it times out
+            since = self.probe_started_at if self.state == HALF_OPEN else self.opened_at
+            retry_after = max(1, self.reset_timeout - (now - since))
+        raise CircuitOpenError("zabbix is unavailable", retry_after)
+
+    def record(self, latency, failed, count_slow=True):
+        """
+        Records the outcome of a call sent after allow. Calls expected to
+        be slow, such as writes of many objects, pass ``count_slow`` false.
+        """
+        failed = failed or (count_slow and latency > self.slow_call)
+        with self._lock:
+            self.counters["calls"] += 1
+            if failed:
+                self.counters["failures"] += 1
+            if self.state == HALF_OPEN:
+                self.probe_started_at = None
+                self._transition(OPEN if failed else CLOSED)
+                return
+            self.calls.append(failed)
+            if (self.state == CLOSED and len(self.calls) >= self.min_calls and
+                    self.calls.count(True) >= self.failure_ratio * len(self.calls)):
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        logger.warning("zabbix circuit breaker %s -> %s (%s)", self.state, state,
+                       ", ".join("{}={}".format(k, v) for k, v in sorted(self.counters.items())))
+        self.state = state
+        self.counters[state] += 1
+        metrics.BREAKER_STATE.set(STATES.index(state))
+        if state == OPEN:
+            self.opened_at = time.time()
+        elif state == CLOSED:
+            self.calls.clear()
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self.counters)
+            metrics["state"] = self.state
+            return metrics
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url, **kwargs):
+    """
+    Returns the process breaker for the zabbix at ``url``.
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(url)
+        if breaker is None:
+            breaker = _breakers[url] = CircuitBreaker(**kwargs)
+        return breaker
+
+
+class CircuitOpenError(Exception):
+    pass
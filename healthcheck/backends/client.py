@@ -0,0 +1,213 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import itertools
+import json
+import random
+import threading
+import time
+
+import requests
+
+from healthcheck import metrics, timing
+from healthcheck.backends.limiter import LimiterTimeoutError
+
+
+# connections are kept alive across managers, one pool per zabbix url,
+# and auth tokens are reused until zabbix terminates the session
+_sessions = {}
+_tokens = {}
+_lock = threading.Lock()
+
+
+class ZabbixClient(object):
+    """
+    A zabbix JSON-RPC client, called like pyzabbix's ZabbixAPI:
+    ``client.host.get(output=["hostid"])`` sends an object and
+    ``client.host.create(host1, host2)`` sends an array.
+
+    Every call has a connect and a read timeout. Get calls are
+    idempotent and are retried on connection errors, timeouts and 5xx
+    responses, sleeping a random time up to an exponential backoff.
+    Other calls are sent once. With a ``limiter``, each attempt waits for
+    a slot, get calls being prioritised over writes. With a ``breaker``,
+    attempts raise CircuitOpenError while zabbix is failing. Clients
+    returned by ``batch`` wait longer, and their slow calls aren't counted
+    as failures by the breaker.
+    """
+
+    def __init__(self, url, timeout=10, connect_timeout=3, retries=2, backoff=0.1,
+                 max_backoff=2, connections=10, limiter=None, breaker=None):
+        self.url = url.rstrip("/") + "/api_jsonrpc.php"
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = _session(self.url, connections)
+        self.limiter = limiter
+        self.breaker = breaker
+        self.count_slow = True
+        self.ids = itertools.count()
+        self.auth = None
+        self.credentials = None
+
+    def login(self, user, password):
+        self.credentials = (user, password)
+        key = (self.url, user, password)
+        self.auth = _tokens.get(key)
+        metrics.CACHE.labels("zabbix_token", "hit" if self.auth else "miss").inc()
+        if not self.auth:
+            self.auth = self.user.login(user=user, password=password)
+            _tokens[key] = self.auth
+
+    def api_version(self):
+        return self.apiinfo.version()
+
+    def with_timeout(self, timeout):
+        """
+        Returns a client sharing this one's connections and session, whose
+        calls wait up to ``timeout`` seconds for a response.
+        """
+        client = object.__new__(ZabbixClient)
+        client.__dict__.update(self.__dict__)
+        client.timeout = timeout
+        return client
+
+    def batch(self, timeout):
+        """
+        Returns a client for array-form calls on many objects, which wait
+        up to ``timeout`` seconds and may be slow without opening the
+        breaker.
+        """
+        client = self.with_timeout(timeout)
+        client.count_slow = False
+        return client
+
+    def do_request(self, method, params=None):
+        try:
+            return self._call(method, params)
+        except ZabbixAPIException as e:
+            if not self.credentials or method == "user.login" or not _is_session_error(e):
+                raise
+        _tokens.pop((self.url,) + self.credentials, None)
+        self.login(*self.credentials)
+        return self._call(method, params)
+
+    def _call(self, method, params):
+        started, failed = time.time(), True
+        try:
+            with timing.measure("zabbix", method):
+                result = self._send(method, params)
+            failed = False
+            return result
+        finally:
+            metrics.observe("zabbix", method, started, failed)
+
+    def _send(self, method, params):
+        payload = {"jsonrpc": "2.0", "method": method, "params": params or {},
+                   "id": next(self.ids)}
+        if self.auth and method not in ("apiinfo.version", "user.login"):
+            payload["auth"] = self.auth
+        read = method.endswith(".get") or method == "apiinfo.version"
+        retries = self.retries if read else 0
+        data = json.dumps(payload)
+        for attempt in range(retries + 1):
+            try:
+                response = self._post(data, read)
+                if response.status_code < 500:
+                    break
+                error = ZabbixAPIException("HTTP error {}".format(response.status_code))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = ZabbixAPIException("{} failed: {}".format(method, e))
+            if attempt == retries:
+                raise error
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+        if response.status_code != 200:
+            raise ZabbixAPIException("HTTP error {}".format(response.status_code))
+        try:
+            # parsing the bytes skips requests' charset detection
+            result = json.loads(response.content.decode("utf-8"))
+        except ValueError:
+            raise ZabbixAPIException("Unable to parse json: {!r}".format(response.content[:200]))
+        if "error" in result:
+            error = result["error"]
+            msg = "Error {}: {}, {}".format(error.get("code"), error.get("message"),
+                                            error.get("data", "No data"))
+            raise ZabbixAPIException(msg, error.get("code"))
+        return result
+
+    def _post(self, data, read):
+        if self.breaker:
+            self.breaker.allow()
+        slot = None
+        if self.limiter:
+            try:
+                slot = self.limiter.acquire(read)
+            except LimiterTimeoutError as e:
+                raise ZabbixAPIException(str(e))
+        started, failed = time.time(), True
+        metrics.ZABBIX_IN_FLIGHT.inc()
+        try:
+            response = self.session.post(self.url, data=data,
+                                         timeout=(self.connect_timeout, self.timeout))
+            failed = response.status_code >= 500
+            return response
+        finally:
+            metrics.ZABBIX_IN_FLIGHT.dec()
+            latency = time.time() - started
+            if slot is not None:
+                metrics.ZABBIX_LIMIT.set(self.limiter.release(slot, latency, failed))
+            if self.breaker:
+                self.breaker.record(latency, failed, self.count_slow)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _Object(name, self)
+
+
+class _Object(object):
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            if args and kwargs:
+                raise TypeError("zabbix calls take either args or kwargs")
+            name = "{}.{}".format(self.name, method)
+            return self.client.do_request(name, list(args) if args else kwargs)["result"]
+        return call
+
+
+def _session(url, connections):
+    with _lock:
+        session = _sessions.get(url)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=connections)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({
+                "Content-Type": "application/json-rpc",
+                "Accept-Encoding": "gzip",
+                "User-Agent": "healthcheck-as-a-service",
+            })
+            _sessions[url] = session
+        return session
+
+
+def _is_session_error(e):
+    message = e.args[0] if e.args else ""
+    return "re-login" in message or "Not authorised" in message
+
+
+class ZabbixAPIException(Exception):
+    pass
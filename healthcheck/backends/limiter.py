@@ -0,0 +1,188 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import errno
+import fcntl
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+
+MAGIC = 0x68636c31
+# magic, max limit, limit, tokens, refilled at, decreased at, reads waiting until
+HEADER = struct.Struct("=iiddddd")
+# pid, expires at
+SLOT = struct.Struct("=id")
+
+
+class Limiter(object):
+    """
+    Limits the zabbix calls in flight and their rate across every worker
+    of a node. The state lives in a memory-mapped file locked with fcntl,
+    so processes sharing ``path`` share the limit.
+
+    Each call takes a slot, leased for ``lease`` seconds so slots of
+    crashed workers are recovered. The limit adapts to the latency seen
+    by the calls, AIMD style: it grows by one slot per limit of calls
+    answered within ``target_latency``, and is cut by ``decrease`` at most
+    once per ``target_latency`` when calls are slower or fail. Writes can
+    only take ``write_share`` of the limit and wait while reads are
+    waiting, so reads get through when zabbix is loaded.
+    """
+
+    def __init__(self, path, max_limit=16, min_limit=1, rate=0, burst=None,
+                 target_latency=1.0, decrease=0.7, write_share=0.75, lease=60,
+                 wait=30, poll=0.005):
+        self.path = path
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.write_share = write_share
+        self.lease = lease
+        self.wait = wait
+        self.poll = poll
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        size = HEADER.size + SLOT.size * self.max_limit
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+            self.map = mmap.mmap(self.fd, size)
+            magic, max_limit = HEADER.unpack_from(self.map)[:2]
+            if magic != MAGIC or max_limit != self.max_limit:
+                self.map[:] = b"\0" * size
+                self._write_header(float(self.max_limit), float(self.burst), time.time(), 0.0, 0.0)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # fcntl locks are held by the process, the thread lock orders its threads
+        with self._lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _read_header(self):
+        return list(HEADER.unpack_from(self.map)[2:])
+
+    def _write_header(self, limit, tokens, refilled_at, decreased_at, reads_waiting_until):
+        HEADER.pack_into(self.map, 0, MAGIC, self.max_limit, limit, tokens, refilled_at,
+                         decreased_at, reads_waiting_until)
+
+    def _slots(self):
+        return [SLOT.unpack_from(self.map, HEADER.size + SLOT.size * i)
+                for i in range(self.max_limit)]
+
+    def _set_slot(self, index, pid, expires_at):
+        SLOT.pack_into(self.map, HEADER.size + SLOT.size * index, pid, expires_at)
+
+    def limit(self):
+        with self._locked():
+            return self._read_header()[0]
+
+    def in_flight(self):
+        now = time.time()
+        with self._locked():
+            return len([s for s in self._slots() if s[0] and s[1] > now])
+
+    def acquire(self, read=True):
+        """
+        Waits for a slot and returns its index, to be given to release.
+        Raises LimiterTimeoutError after waiting ``wait`` seconds.
+        """
+        deadline = time.time() + self.wait
+        while True:
+            slot = self._try_acquire(read)
+            if slot is not None:
+                return slot
+            if time.time() >= deadline:
+                raise LimiterTimeoutError("no zabbix call slot after {}s".format(self.wait))
+            time.sleep(random.uniform(0.5, 1.5) * self.poll)
+
+    def _try_acquire(self, read):
+        now = time.time()
+        with self._locked():
+            limit, tokens, refilled_at, decreased_at, reads_waiting_until = self._read_header()
+            if self.rate:
+                tokens = min(self.burst, tokens + (now - refilled_at) * self.rate)
+            refilled_at = now
+            allowed = int(limit) if read else max(1, int(limit * self.write_share))
+            slot = None
+            if (read or reads_waiting_until < now) and (not self.rate or tokens >= 1):
+                slot = self._free_slot(now, allowed)
+            if slot is not None:
+                self._set_slot(slot, self.pid, now + self.lease)
+                if self.rate:
+                    tokens -= 1
+            elif read:
+                # holds writes back until the waiting reads got their slots
+                reads_waiting_until = now + self.poll * 4
+            self._write_header(limit, tokens, refilled_at, decreased_at, reads_waiting_until)
+            return slot
+
+    def _free_slot(self, now, allowed):
+        slots = self._slots()
+        busy = [i for i, (pid, expires_at) in enumerate(slots)
+                if pid and expires_at > now and (pid == self.pid or _is_alive(pid))]
+        if len(busy) >= allowed:
+            return None
+        return next(i for i in range(self.max_limit) if i not in busy)
+
+    def release(self, slot, latency, overloaded=False):
+        """
+        Frees ``slot`` and adapts the limit to the ``latency`` of the call,
+        ``overloaded`` telling whether it failed for lack of capacity.
+        Returns the new limit.
+        """
+        now = time.time()
+        with self._locked():
+            pid, _ = SLOT.unpack_from(self.map, HEADER.size + SLOT.size * slot)
+            if pid == self.pid:
+                self._set_slot(slot, 0, 0)
+            limit, tokens, refilled_at, decreased_at, reads_waiting_until = self._read_header()
+            if overloaded or latency > self.target_latency:
+                if now - decreased_at > self.target_latency:
+                    limit = max(self.min_limit, limit * self.decrease)
+                    decreased_at = now
+            else:
+                limit = min(self.max_limit, limit + 1.0 / limit)
+            self._write_header(limit, tokens, refilled_at, decreased_at, reads_waiting_until)
+        return limit
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+_limiters = {}
+
+
+def get_limiter(path, **kwargs):
+    """
+    Returns the process limiter for ``path``, opening it once.
+    """
+    limiter = _limiters.get(path)
+    if limiter is None or limiter.pid != os.getpid():
+        limiter = _limiters[path] = Limiter(path, **kwargs)
+    return limiter
+
+
+class LimiterTimeoutError(Exception):
+    pass
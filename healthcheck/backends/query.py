@@ -0,0 +1,39 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+
+class Query(object):
+    """
+    A zabbix get call. Zabbix returns every field of the objects when no
+    output is given, so a query must name the fields it reads, in output
+    and in each select parameter, and may limit the number of objects.
+    """
+
+    def __init__(self, obj, output, limit=None, **params):
+        if not _is_field_list(output):
+            raise InvalidQueryError("{}.get must list its output fields".format(obj))
+        for key, value in params.items():
+            if key.startswith("select") and value != "count" and not _is_field_list(value):
+                raise InvalidQueryError("{}.get must list the fields of {}".format(obj, key))
+        self.obj = obj
+        self.output = list(output)
+        self.limit = limit
+        self.params = params
+
+    def to_params(self):
+        params = dict(self.params, output=self.output)
+        if self.limit is not None:
+            params["limit"] = self.limit
+        return params
+
+    def run(self, zapi):
+        return getattr(zapi, self.obj).get(**self.to_params())
+
+
+def _is_field_list(value):
+    return isinstance(value, (list, tuple)) and len(value) > 0
+
+
+class InvalidQueryError(Exception):
+    pass
@@ -0,0 +1,29 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+gunicorn settings of the API, used with
+
+    $ gunicorn healthcheck.api:app -c python:healthcheck.gunicorn_conf
+
+Workers keep their prometheus samples in prometheus_multiproc_dir,
+/tmp/hcaas-metrics by default, which is emptied when gunicorn starts.
+The gauges of workers that exit are dropped.
+"""
+
+import os
+import shutil
+
+os.environ.setdefault("prometheus_multiproc_dir", "/tmp/hcaas-metrics")
+
+
+def on_starting(server):
+    path = os.environ["prometheus_multiproc_dir"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,177 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Log records and Sentry events sent from a background worker, so a slow
+log sink or Sentry server doesn't add to the latency of the API.
+
+A request only puts the record, or the event built by raven, in a bounded
+queue. Records are formatted by the worker when they are handled, and
+Sentry events are encoded and sent by it, in batches. When a queue is
+full, new items are dropped and counted in hcaas_log_dropped_total, and
+while raven backs off a failing Sentry server its events are dropped too.
+The queue of the log records holds API_LOG_QUEUE_SIZE items, 10000 by
+default, and the one of the Sentry events SENTRY_QUEUE_SIZE, 100 by
+default.
+
+Workers start with the first item of each process, so they survive the
+fork of gunicorn workers. Under the gevent worker they run as greenlets.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+import traceback
+
+from raven.base import Client
+
+from healthcheck import metrics
+
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue
+
+
+class Worker(object):
+    """
+    Calls ``process`` in a background thread with lists of up to ``batch``
+    items taken from a queue of ``size`` items.
+    """
+
+    def __init__(self, name, process, size, batch=1):
+        self.name = name
+        self.process = process
+        self.size = size
+        self.batch = batch
+        self.dropped = 0
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        """
+        Queues ``item`` without blocking, returning whether it was queued.
+        """
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.drop(1)
+            return False
+        return True
+
+    def drop(self, count):
+        self.dropped += count
+        metrics.LOG_DROPPED.labels(self.name).inc(count)
+
+    def flush(self, timeout=None):
+        """
+        Waits up to ``timeout`` seconds for the queued items to be
+        processed, returning whether they were.
+        """
+        queue = self.queue
+        if queue is None:
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        with queue.all_tasks_done:
+            while queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is None:
+                atexit.register(self.flush, 2)
+            self.queue = Queue(self.size)
+            thread = threading.Thread(target=self._run, args=(self.queue,),
+                                      name="{}-worker".format(self.name))
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def _run(self, queue):
+        while True:
+            items = [queue.get()]
+            try:
+                while len(items) < self.batch:
+                    items.append(queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self.process(items)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                for _ in items:
+                    queue.task_done()
+
+
+def _handle_records(items):
+    for handler, record in items:
+        handler.handle(record)
+
+
+_records = Worker("log", _handle_records, int(os.environ.get("API_LOG_QUEUE_SIZE", 10000)))
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands the records to ``handler`` from the log worker. The message is
+    only formatted then, so the arguments of a log call must not be
+    changed after it.
+    """
+
+    def __init__(self, handler, worker=None):
+        logging.Handler.__init__(self, handler.level)
+        self.handler = handler
+        self.worker = worker or _records
+
+    def handle(self, record):
+        # queueing is thread safe, there's no need for the handler lock
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        self.worker.put((self.handler, record))
+
+
+def queued(handler):
+    return QueueHandler(handler)
+
+
+class SentryClient(Client):
+    """
+    Raven client building events in the request and sending them from a
+    background worker. Plain http and https DSNs use the synchronous
+    transport of raven, in the worker.
+    """
+
+    def __init__(self, dsn=None, **options):
+        dsn = dsn or os.environ.get("SENTRY_DSN")
+        if dsn and dsn.split("://", 1)[0] in ("http", "https"):
+            dsn = "sync+" + dsn
+        Client.__init__(self, dsn, **options)
+        self.worker = Worker("sentry", self._send_batch, int(os.environ.get("SENTRY_QUEUE_SIZE", 100)),
+                             batch=10)
+
+    def send(self, auth_header=None, **data):
+        self.worker.put((auth_header, data))
+
+    def _send_batch(self, events):
+        for i, (auth_header, data) in enumerate(events):
+            if not self.state.should_try():
+                self.worker.drop(len(events) - i)
+                return
+            Client.send(self, auth_header=auth_header, **data)
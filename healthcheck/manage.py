@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import sys
+
+
+def get_manager():
+    from healthcheck.backends import Zabbix
+    return Zabbix()
+
+
+def rebalance_proxies():
+    """
+    rebalance-proxies moves instance hosts between the proxies configured in
+    ZABBIX_PROXIES, so every proxy runs about the same number of web
+    scenarios. Run it after adding or removing proxies. Usage:
+
+        python -m healthcheck.manage rebalance-proxies
+    """
+    moves = get_manager().rebalance_proxies()
+    for name, old, new in moves:
+        sys.stdout.write("{}: {} -> {}\n".format(name, old, new))
+    sys.stdout.write("{} host(s) moved\n".format(len(moves)))
+
+
+def merge_actions():
+    """
+    merge-actions replaces the per-url zabbix actions created by older
+    versions with one action per instance. It can be run more than once.
+    Usage:
+
+        python -m healthcheck.manage merge-actions
+    """
+    removed = get_manager().merge_actions()
+    sys.stdout.write("{} per-url action(s) merged\n".format(removed))
+
+
+def restore(batch_size=500, concurrency=4):
+    """
+    restore recreates hosts, user groups, watchers, actions, web scenarios
+    and triggers of every instance in zabbix from mongodb, and records the
+    new ids in mongodb. Stop the API while restoring. An interrupted
+    restore resumes where it stopped when run again. Usage:
+
+        python -m healthcheck.manage restore [batch-size] [concurrency]
+    """
+    from healthcheck.restore import Restore
+    Restore(get_manager(), int(batch_size), int(concurrency), sys.stdout).run()
+
+
+def fill_pool():
+    """
+    fill-pool creates the hosts and user groups missing from the pool of
+    ZABBIX_POOL_SIZE pairs used by new instances. Usage:
+
+        python -m healthcheck.manage fill-pool
+    """
+    created = get_manager().fill_pool()
+    sys.stdout.write("{} pool entry(ies) created\n".format(created))
+
+
+def reclaim_pool():
+    """
+    reclaim-pool deletes the hosts and user groups of pool entries whose
+    creation or claim didn't finish. Run it periodically. Usage:
+
+        python -m healthcheck.manage reclaim-pool
+    """
+    removed = get_manager().reclaim_pool()
+    sys.stdout.write("{} pool entry(ies) reclaimed\n".format(removed))
+
+
+def collect_removed(limit=100):
+    """
+    collect-removed deletes the zabbix objects of removed instances, up to
+    limit instances per batch, until none is left to collect. Instances
+    whose collection fails are retried by a later run. Usage:
+
+        python -m healthcheck.manage collect-removed [limit]
+    """
+    manager = get_manager()
+    total = errors = 0
+    while errors < 10:
+        try:
+            collected = manager.collect_removed(int(limit))
+        except Exception as e:
+            # the failed batch is deferred, go on with the next one
+            sys.stderr.write("ERROR: {}\n".format(e))
+            errors += 1
+            continue
+        if not collected:
+            break
+        total += collected
+    sys.stdout.write("{} instance(s) collected\n".format(total))
+
+
+def show_help(command_name=None, exit=0):
+    """
+    help displays the help of the specified command. Usage:
+
+        python -m healthcheck.manage help [command-name]
+    """
+    commands = _get_commands()
+    if command_name and command_name in commands:
+        sys.stderr.write(commands[command_name].__doc__.rstrip() + "\n")
+        sys.exit(exit)
+    sys.stderr.write("Usage: python -m healthcheck.manage command [args]\n\n")
+    sys.stderr.write("Available commands:\n")
+    for name in sorted(commands.keys()):
+        if name != "help":
+            sys.stderr.write("  {}\n".format(name))
+    sys.stderr.write("  help\n")
+    sys.exit(exit)
+
+
+def _get_commands():
+    return {
+        "rebalance-proxies": rebalance_proxies,
+        "merge-actions": merge_actions,
+        "restore": restore,
+        "collect-removed": collect_removed,
+        "fill-pool": fill_pool,
+        "reclaim-pool": reclaim_pool,
+        "help": show_help,
+    }
+
+
+def command(command_name):
+    commands = _get_commands()
+    if command_name in commands:
+        return commands[command_name]
+    show_help(exit=2)
+
+
+def main(cmd, *args):
+    try:
+        command(cmd)(*args)
+    except TypeError:
+        show_help(cmd, exit=2)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        show_help(exit=2)
+    main(sys.argv[1], *sys.argv[2:])
@@ -0,0 +1,127 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Prometheus metrics of the API, served on /metrics.
+
+Under gunicorn, the config in healthcheck/gunicorn_conf.py points
+prometheus_multiproc_dir to a directory where each worker keeps its
+samples in mmap files. Updating a metric only takes a lock of the worker,
+and /metrics merges the files of all the workers, so a scrape covers the
+whole node. Without prometheus_multiproc_dir, metrics are kept in memory
+by the process serving the scrape.
+"""
+
+import functools
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest)
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+REQUESTS = Counter("hcaas_requests_total", "API requests",
+                   ["method", "route", "status"])
+REQUEST_LATENCY = Histogram("hcaas_request_duration_seconds", "API request latency",
+                            ["method", "route"], buckets=BUCKETS)
+IN_FLIGHT = Gauge("hcaas_requests_in_flight", "API requests being served",
+                  multiprocess_mode="livesum")
+BACKEND_CALLS = Counter("hcaas_backend_calls_total", "Calls to mongodb and zabbix",
+                        ["backend", "operation", "outcome"])
+BACKEND_LATENCY = Histogram("hcaas_backend_call_duration_seconds",
+                            "Latency of calls to mongodb and zabbix",
+                            ["backend", "operation"], buckets=BUCKETS)
+CACHE = Counter("hcaas_cache_requests_total", "Lookups of zabbix auth tokens and snapshots",
+                ["cache", "result"])
+ZABBIX_IN_FLIGHT = Gauge("hcaas_zabbix_calls_in_flight", "Zabbix calls waiting for a response",
+                         multiprocess_mode="livesum")
+ZABBIX_LIMIT = Gauge("hcaas_zabbix_concurrency_limit", "Adaptive limit of zabbix calls in flight",
+                     multiprocess_mode="max")
+BREAKER_STATE = Gauge("hcaas_zabbix_breaker_state",
+                      "Circuit breaker of each worker: 0 closed, 1 half-open, 2 open",
+                      multiprocess_mode="liveall")
+BREAKER_REJECTED = Counter("hcaas_zabbix_breaker_rejected_total",
+                           "Zabbix calls failed at once by an open circuit breaker")
+LOG_DROPPED = Counter("hcaas_log_dropped_total", "Log records and sentry events dropped by a full queue",
+                      ["queue"])
+
+
+def observe(backend, operation, started, failed):
+    BACKEND_CALLS.labels(backend, operation, "error" if failed else "ok").inc()
+    BACKEND_LATENCY.labels(backend, operation).observe(time.time() - started)
+
+
+def observed_methods(backend, exclude=()):
+    """
+    Class decorator recording the calls of every public method, but those
+    in ``exclude``, as calls to ``backend``.
+    """
+    def observed(name, fn):
+        @functools.wraps(fn)
+        def decorated(*args, **kwargs):
+            started, failed = time.time(), True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe(backend, name, started, failed)
+        return decorated
+
+    def decorator(cls):
+        for name, attr in list(vars(cls).items()):
+            if not name.startswith("_") and name not in exclude and callable(attr):
+                setattr(cls, name, observed(name, attr))
+        return cls
+    return decorator
+
+
+def registry():
+    """
+    Returns the registry to scrape: the samples of all workers in
+    multiprocess mode, or those of this process.
+    """
+    path = os.environ.get("prometheus_multiproc_dir")
+    if not path:
+        return REGISTRY
+    from prometheus_client import multiprocess
+    merged = CollectorRegistry()
+    multiprocess.MultiProcessCollector(merged, path)
+    return merged
+
+
+def install(app):
+    """
+    Records the requests of ``app`` and serves the metrics on /metrics,
+    with the basic auth of the API.
+    """
+    import flask
+    from healthcheck import auth
+
+    @app.before_request
+    def start_request():
+        flask.g.metrics_started = time.time()
+        IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request(response):
+        started = getattr(flask.g, "metrics_started", None)
+        if started is not None:
+            rule = flask.request.url_rule
+            route = rule.rule if rule else "unmatched"
+            REQUESTS.labels(flask.request.method, route, str(response.status_code)).inc()
+            REQUEST_LATENCY.labels(flask.request.method, route).observe(time.time() - started)
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        if getattr(flask.g, "metrics_started", None) is not None:
+            IN_FLIGHT.dec()
+
+    @auth.required
+    def expose():
+        return generate_latest(registry()), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+    app.add_url_rule("/metrics", "metrics", expose)
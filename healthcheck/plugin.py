@@ -62,11 +62,11 @@ def proxy_request(service_name, instance_name, method, path, body=None, headers=
         raise
 
 
-def add_url(service_name, name, url, expected_string=None, comment=None):
+def add_url(service_name, name, url, expected_string=None, comment=None, interval=None):
     """
     add-url add a new url checker to the given instance. Usage:
 
-        add-url <service-name> <instance-name> <url> [expected_string] [comment]
+        add-url <service-name> <instance-name> <url> [expected_string] [comment] [interval]
 
     expected_string is an optional parameter that represents the string that
     the healthcheck should expect to find in the body of the response. Example:
@@ -78,11 +78,22 @@ def add_url(service_name, name, url, expected_string=None, comment=None):
 
         tsuru {plugin_name} add-url hcaas mysite http://mysite.com/hc 'restart the app'
 
+    interval is an optional parameter that sets how often, in seconds, the
+    url is checked. Use empty strings to skip the previous parameters. Example:
+
+        tsuru {plugin_name} add-url hcaas mysite http://mysite.com/hc '' '' 300
+
     """
     parsed_url = urlparse(url)
     if parsed_url.scheme == '':
         sys.stderr.write("ERROR: missing url scheme\n")
         sys.exit(2)
+    if interval:
+        try:
+            interval = int(interval)
+        except ValueError:
+            sys.stderr.write("ERROR: interval must be a number of seconds\n")
+            sys.exit(2)
 
     data = {
         "url": url,
@@ -91,6 +102,8 @@ def add_url(service_name, name, url, expected_string=None, comment=None):
         data["expected_string"] = expected_string
     if comment:
         data["comment"] = comment
+    if interval:
+        data["interval"] = interval
     headers = {
         "Content-Type": "application/json",
         "Accept": "text/plain"
@@ -152,6 +165,60 @@ def list_urls(service_name, name):
         sys.exit(1)
 
 
+def failed_url(service_name, name, scenario, step):
+    """
+    failed-url shows the url of the failing step of an alert, for instances
+    checking their urls as steps of multi-step web scenarios. Usage:
+
+        failed-url <service_name> <instance-name> <scenario> <step>
+
+    Alerts of these instances read "step 2 of hc scenario 0a1b2c3d for mysite
+    failed", scenario being the id after "hc scenario" or the whole scenario
+    name. Example:
+
+        tsuru {plugin_name} failed-url hcaas mysite 0a1b2c3d 2
+    """
+    words = scenario.split()
+    if len(words) > 2 and words[:2] == ["hc", "scenario"]:
+        scenario = words[2]
+    url = "/failed-url/{}/{}".format(scenario, step)
+    result = proxy_request(service_name, name, "GET", url)
+    if result.getcode() == 200:
+        sys.stdout.write(result.read().decode('utf-8') + "\n")
+    else:
+        msg = result.read().decode('utf-8').rstrip("\n")
+        sys.stderr.write("ERROR: " + msg + "\n")
+        sys.exit(1)
+
+
+def clone(service_name, name, source):
+    """
+    clone copies the urls, watchers and hostgroups of the source instance to
+    the given instance. Usage:
+
+        clone <service_name> <instance-name> <source-instance-name>
+
+    Example:
+
+        tsuru {plugin_name} clone hcaas mysite-staging mysite
+    """
+    data = {
+        "source": source,
+    }
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "text/plain"
+    }
+    result = proxy_request(service_name, name, "POST", "/clone", data, headers)
+    if result.getcode() == 201:
+        msg = "instance {} successfully cloned to {}!\n".format(source, name)
+        sys.stdout.write(msg)
+    else:
+        msg = result.read().decode('utf-8').rstrip("\n")
+        sys.stderr.write("ERROR: " + msg + "\n")
+        sys.exit(1)
+
+
 def add_watcher(service_name, name, watcher, password=None):
     """
     add-watcher creates a new watcher for the given monitoring instance. A
@@ -379,6 +446,8 @@ def _get_commands():
         "add-url": add_url,
         "remove-url": remove_url,
         "list-urls": list_urls,
+        "failed-url": failed_url,
+        "clone": clone,
         "add-watcher": add_watcher,
         "remove-watcher": remove_watcher,
         "list-watchers": list_watchers,
@@ -0,0 +1,207 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Opt-in profiling of single API requests. With API_PROFILE_TOKEN set, a
+request sent with the header ``X-Profile: <token>`` runs under cProfile,
+and so does a share API_PROFILE_SAMPLE_RATE of all requests. The CPU
+profile and the allocations of the request are stored in mongodb and the
+response carries their id in ``X-Profile-Id``:
+
+    $ curl -H "X-Profile: $TOKEN" <API-URL>/resources/site/url -D -
+    $ curl -H "X-Profile: $TOKEN" <API-URL>/profiles/<id> -o request.prof
+    $ python -m pstats request.prof
+
+Without a token the app is left untouched.
+"""
+
+import collections
+import cProfile
+import datetime
+import gc
+import hmac
+import io
+import json
+import marshal
+import os
+import pstats
+import random
+import time
+
+import flask
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+HEADER = "X-Profile"
+TOP = 30
+
+
+def install(app):
+    """
+    Wraps the WSGI app of ``app`` in a Profiler and adds the routes to
+    download profiles, when API_PROFILE_TOKEN is set.
+    """
+    token = os.environ.get("API_PROFILE_TOKEN")
+    if not token:
+        return None
+    profiler = Profiler(
+        app.wsgi_app,
+        token,
+        sample_rate=float(os.environ.get("API_PROFILE_SAMPLE_RATE", 0)),
+        keep=int(os.environ.get("API_PROFILE_KEEP", 100)),
+    )
+    app.wsgi_app = profiler
+    app.add_url_rule("/profiles", "list_profiles", profiler.list_profiles)
+    app.add_url_rule("/profiles/<profile_id>", "get_profile", profiler.get_profile)
+    return profiler
+
+
+class Profiler(object):
+    """
+    WSGI middleware profiling the requests carrying the token, and a
+    sample of the others, keeping the last ``keep`` profiles.
+    """
+
+    def __init__(self, app, token, sample_rate=0, keep=100):
+        self.app = app
+        self.token = token
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.random = random.Random()
+        self._storage = None
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            from healthcheck.storage import MongoStorage
+            self._storage = MongoStorage()
+        return self._storage
+
+    def authorized(self, value):
+        return bool(value) and hmac.compare_digest(str(value), str(self.token))
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith("/profiles") or not (
+                self.authorized(environ.get("HTTP_X_PROFILE")) or
+                (self.sample_rate and self.random.random() < self.sample_rate)):
+            return self.app(environ, start_response)
+        return self._profile(environ, start_response)
+
+    def _profile(self, environ, start_response):
+        response = []
+        body = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+            return body.append
+
+        memory = _Allocations()
+        profile = cProfile.Profile()
+        started = time.time()
+        profile.enable()
+        try:
+            result = self.app(environ, capture)
+            try:
+                body.extend(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        finally:
+            profile.disable()
+            duration = time.time() - started
+            allocations = memory.stop()
+        profile_id = self._save(environ, response[0], duration, profile, allocations)
+        status, headers, exc_info = response
+        start_response(status, headers + [("X-Profile-Id", profile_id)], exc_info)
+        return body
+
+    def _save(self, environ, status, duration, profile, allocations):
+        from bson.binary import Binary
+        from bson.objectid import ObjectId
+        profile.create_stats()
+        stats = Binary(marshal.dumps(profile.stats))
+        out = io.BytesIO() if str is bytes else io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(TOP)
+        profile_id = ObjectId()
+        self.storage.add_profile({
+            "_id": profile_id,
+            "method": environ.get("REQUEST_METHOD"),
+            "path": environ.get("PATH_INFO"),
+            "status": int(status.split(" ", 1)[0]),
+            "duration": duration,
+            "created_at": datetime.datetime.utcnow(),
+            "stats": stats,
+            "summary": out.getvalue(),
+            "allocations": allocations,
+        }, self.keep)
+        return str(profile_id)
+
+    def list_profiles(self):
+        if not self.authorized(flask.request.headers.get(HEADER)):
+            return "you do not have access to this resource", 401
+        profiles = [{
+            "id": str(p["_id"]),
+            "method": p["method"],
+            "path": p["path"],
+            "status": p["status"],
+            "duration": p["duration"],
+            "created_at": p["created_at"].isoformat(),
+        } for p in self.storage.find_profiles()]
+        return json.dumps(profiles), 200, {"Content-Type": "application/json"}
+
+    def get_profile(self, profile_id):
+        """
+        Returns the profile in the pstats format, or its summary and
+        allocations as text with ``?format=text``.
+        """
+        if not self.authorized(flask.request.headers.get(HEADER)):
+            return "you do not have access to this resource", 401
+        profile = self.storage.find_profile(profile_id)
+        if not profile:
+            return "profile not found", 404
+        if flask.request.args.get("format") == "text":
+            lines = [profile["summary"], "allocations:"]
+            for a in profile["allocations"]:
+                size = "" if a["size"] is None else a["size"]
+                lines.append("{:>12} {:>8} {}".format(size, a["count"], a["where"]))
+            return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain"}
+        return bytes(profile["stats"]), 200, {
+            "Content-Type": "application/octet-stream",
+            "Content-Disposition": "attachment; filename={}.prof".format(profile_id),
+        }
+
+
+class _Allocations(object):
+    """
+    Counts the allocations of a request: the bytes by line with
+    tracemalloc, where it is available, or else the growth of live
+    objects by type.
+    """
+
+    def __init__(self):
+        if tracemalloc:
+            self.tracing = tracemalloc.is_tracing()
+            if not self.tracing:
+                tracemalloc.start()
+            self.before = tracemalloc.take_snapshot()
+        else:
+            self.before = self._objects()
+
+    def stop(self):
+        if tracemalloc:
+            after = tracemalloc.take_snapshot()
+            if not self.tracing:
+                tracemalloc.stop()
+            return [{"where": str(s.traceback), "size": s.size_diff, "count": s.count_diff}
+                    for s in after.compare_to(self.before, "lineno")[:TOP]]
+        growth = self._objects()
+        growth.subtract(self.before)
+        return [{"where": name, "size": None, "count": count}
+                for name, count in growth.most_common(TOP) if count > 0]
+
+    def _objects(self):
+        return collections.Counter(type(o).__name__ for o in gc.get_objects())
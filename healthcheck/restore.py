@@ -0,0 +1,334 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from healthcheck.backends.query import Query
+
+
+# zabbix object, field holding the unique name, field holding the id,
+# ids key of the create result
+OBJECTS = {
+    "packed_hosts": ("host", "host", "hostid", "hostids"),
+    "hosts": ("host", "host", "hostid", "hostids"),
+    "usergroups": ("usergroup", "name", "usrgrpid", "usrgrpids"),
+    "users": ("user", "alias", "userid", "userids"),
+    "actions": ("action", "name", "actionid", "actionids"),
+    "scenarios": ("httptest", "name", "httptestid", "httptestids"),
+    "httptests": ("httptest", "name", "httptestid", "httptestids"),
+    "triggers": ("trigger", "description", "triggerid", "triggerids"),
+}
+
+PHASES = ["packed_hosts", "hosts", "usergroups", "users", "actions",
+          "scenarios", "httptests", "triggers"]
+
+
+class Unit(object):
+    """
+    One zabbix object to create. ``key`` identifies the unit across runs,
+    ``updates`` lists the (collection, query, fields) to set on mongodb
+    once the object id is known, ``fields`` being a function of the id.
+    """
+
+    def __init__(self, key, params, updates, name=None):
+        self.key = key
+        self.params = params
+        self.updates = updates
+        self.name = name
+
+
+class Restore(object):
+    """
+    Recreates the zabbix objects of every instance recorded in mongodb.
+
+    Objects are created in batches with array-form create calls, running
+    up to ``concurrency`` batches at once. The new ids of each batch are
+    recorded in the restore collection, which is the checkpoint: a run
+    skips the objects recorded there, and objects created by a batch that
+    crashed before its checkpoint are found by name, or triggers by
+    description and expression, and reused. Mongodb documents are
+    rewritten in bulk with the new ids only once all the objects exist,
+    so the snapshot read by every run stays the same.
+
+    Host groups, proxies and the discovery template are referenced by id
+    and must exist before restoring. Watchers get WATCHER_PASSWORD. Urls
+    added to per-url scenarios before their expected string and comment
+    were recorded in mongodb are restored without them, so their checks
+    pass on any 200 response. They are counted in a warning.
+    """
+
+    def __init__(self, manager, batch_size=500, concurrency=4, out=sys.stdout):
+        self.manager = manager
+        self.storage = manager.storage
+        self.zapi = manager.zapi
+        self.batch_zapi = manager._batch_zapi()
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.out = out
+        self.ids = {}
+
+    def run(self):
+        self._load()
+        unrecorded = self._unrecorded()
+        if unrecorded:
+            self.out.write("warning: {} url(s) restored without their expected string "
+                           "and comment, which were kept in zabbix only\n".format(unrecorded))
+        total, started = 0, time.time()
+        for phase in PHASES:
+            units = [u for u in getattr(self, "_" + phase)()
+                     if (phase, u.key) not in self.ids]
+            total += self._create(phase, units)
+        self.storage.apply_restore_entries()
+        self._report("total", total, time.time() - started)
+        return total
+
+    def _load(self):
+        self.healthchecks = self.storage.find_healthchecks()
+        self.items = self.storage.find_items()
+        self.users = self.storage.find_users()
+        self.packed_hosts = self.storage.find_packed_hosts()
+        self.scenarios = self.storage.find_scenarios()
+        self.items_by_group = {}
+        for item in self.items:
+            self.items_by_group.setdefault(getattr(item, "group_id", None), []).append(item)
+        for entry in self.storage.find_restore_entries():
+            self.ids[(entry["phase"], entry["unit"])] = entry["new_id"]
+
+    def _unrecorded(self):
+        return sum(1 for hc in self.healthchecks
+                   for item in self.items_by_group.get(hc.group_id, [])
+                   if self.manager._details_in_zabbix(hc, item))
+
+    def _create(self, phase, units):
+        started = time.time()
+        batches = [units[i:i + self.batch_size]
+                   for i in range(0, len(units), self.batch_size)]
+        pool = ThreadPool(self.concurrency)
+        try:
+            created = sum(pool.imap_unordered(lambda b: self._create_batch(phase, b), batches))
+        finally:
+            pool.close()
+        self._report(phase, created, time.time() - started)
+        return created
+
+    def _create_batch(self, phase, units):
+        obj, name_field, id_field, ids_key = OBJECTS[phase]
+        existing = self._existing(obj, name_field, id_field, units)
+        missing = [u for u in units if self._name_key(u) not in existing]
+        created = {}
+        if missing:
+            result = getattr(self.batch_zapi, obj).create(*[u.params for u in missing])
+            created = dict(zip([u.key for u in missing], result[ids_key]))
+        new_ids, entries = {}, []
+        for unit in units:
+            new_id = created.get(unit.key) or existing[self._name_key(unit)]
+            new_ids[unit.key] = new_id
+            entries.append({"phase": phase, "unit": unit.key, "new_id": new_id})
+            for collection, query, fields in unit.updates:
+                entries.append({"collection": collection, "query": query,
+                                "fields": fields(new_id)})
+        self.storage.add_restore_entries(entries)
+        for key, new_id in new_ids.items():
+            self.ids[(phase, key)] = new_id
+        return len(units)
+
+    def _existing(self, obj, name_field, id_field, units):
+        """
+        Finds the objects a crashed run created without checkpointing them.
+        Web scenario names are only unique within a host.
+        """
+        if obj == "trigger":
+            return self._existing_triggers(units)
+        output = [id_field, name_field]
+        params = {"filter": {name_field: [u.name for u in units]}}
+        scoped = "hostid" in units[0].params
+        if scoped:
+            output.append("hostid")
+            params["hostids"] = list(set(u.params["hostid"] for u in units))
+        existing = {}
+        for found in Query(obj, output, **params).run(self.zapi):
+            existing[(found["hostid"] if scoped else None, found[name_field])] = found[id_field]
+        return existing
+
+    def _existing_triggers(self, units):
+        """
+        Trigger descriptions aren't unique, so triggers are matched by
+        description and expression, which names the host.
+        """
+        params = {"filter": {"description": list(set(u.params["description"] for u in units))},
+                  "expandExpression": True}
+        existing = {}
+        for found in Query("trigger", ["triggerid", "description", "expression"],
+                           **params).run(self.zapi):
+            existing[(None, (found["description"], found["expression"]))] = found["triggerid"]
+        return existing
+
+    def _name_key(self, unit):
+        return (unit.params.get("hostid"), unit.name)
+
+    def _report(self, phase, count, elapsed):
+        rate = count / elapsed if elapsed > 0 else 0
+        self.out.write("{}: {} object(s) in {:.1f}s ({:.1f} objects/s)\n".format(
+            phase, count, elapsed, rate))
+
+    def _hc_key(self, hc):
+        return str(hc._id)
+
+    def _host_id(self, hc):
+        if self.manager._is_packed(hc):
+            packed_host = next(p for p in self.packed_hosts if p["host_id"] == hc.host_id)
+            return self.ids[("packed_hosts", str(packed_host["_id"]))]
+        return self.ids[("hosts", self._hc_key(hc))]
+
+    def _host_groups(self, hc):
+        return hc.host_groups or [hc.host_group_id]
+
+    def _group_id(self, hc):
+        return self.ids[("usergroups", self._hc_key(hc))]
+
+    def _set(self, collection, doc_id, field):
+        return (collection, {"_id": doc_id}, lambda new_id: {field: new_id})
+
+    def _packed_hosts(self):
+        for packed_host in self.packed_hosts:
+            updates = [self._set("packed_hosts", packed_host["_id"], "host_id")]
+            updates += [self._set("healthchecks", hc._id, "host_id") for hc in self.healthchecks
+                        if self.manager._is_packed(hc) and hc.host_id == packed_host["host_id"]]
+            params = self.manager._host_params(packed_host["name"], [self.manager.host_group_id],
+                                               packed_host.get("proxy_id"))
+            yield Unit(str(packed_host["_id"]), params, updates, packed_host["name"])
+
+    def _hosts(self):
+        for hc in self.healthchecks:
+            if self.manager._is_packed(hc):
+                continue
+            template_id = None
+            if self.manager._uses_discovery(hc):
+                template_id = self.manager.discovery_template_id
+            params = self.manager._host_params(hc.name, self._host_groups(hc),
+                                               getattr(hc, "proxy_id", None), template_id)
+            yield Unit(self._hc_key(hc), params,
+                       [self._set("healthchecks", hc._id, "host_id")], hc.name)
+
+    def _usergroups(self):
+        for hc in self.healthchecks:
+            updates = [self._set("healthchecks", hc._id, "group_id")]
+            updates += [self._set("items", item._id, "group_id")
+                        for item in self.items_by_group.get(hc.group_id, [])]
+            params = {"name": hc.name,
+                      "rights": [{"permission": 2, "id": gid} for gid in self._host_groups(hc)]}
+            yield Unit(self._hc_key(hc), params, updates, hc.name)
+
+    def _users(self):
+        groups = dict((hc.group_id, self._group_id(hc)) for hc in self.healthchecks)
+        for user in self.users:
+            group_ids = [groups[g] for g in user.groups_id if g in groups]
+            if not group_ids:
+                continue
+            params = self.manager._user_params(user.email, self.manager.watcher_default_password,
+                                               group_ids)
+            updates = [("users", {"email": user.email},
+                        lambda new_id, group_ids=group_ids: {"id": new_id, "groups_id": group_ids})]
+            yield Unit(user.email, params, updates, user.email)
+
+    def _actions(self):
+        for hc in self.healthchecks:
+            host_id = None if self.manager._is_packed(hc) else self._host_id(hc)
+            params = self.manager._action_params(hc.name, host_id, self._group_id(hc))
+            updates = [self._set("healthchecks", hc._id, "action_id")]
+            # per-url actions are merged into the instance action
+            updates += [("items", {"_id": item._id}, lambda new_id: {"action_id": None})
+                        for item in self.items_by_group.get(hc.group_id, [])
+                        if getattr(item, "action_id", None)]
+            yield Unit(self._hc_key(hc), params, updates, params["name"])
+
+    def _scenarios(self):
+        manager = self.manager
+        for scenario in self.scenarios:
+            key = (scenario["url"], scenario.get("expected_string"), scenario.get("interval"))
+            url, expected_string, interval = key
+            items = [i for i in self.items if getattr(i, "shared", False) and
+                     manager._scenario_key(i) == key]
+            name = manager._create_shared_item_name(url, expected_string, interval)
+            params = manager._httptest_params(manager.shared_host_id, name,
+                                              [manager._web_step(url, expected_string, 1, name)],
+                                              url, interval)
+            updates = [self._set("scenarios", scenario["_id"], "item_id")]
+            updates += [self._set("items", i._id, "item_id") for i in items]
+            yield Unit(str(scenario["_id"]), params, updates, name)
+
+    def _httptests(self):
+        manager = self.manager
+        for hc in self.healthchecks:
+            if manager._uses_discovery(hc):
+                continue
+            host_id = self._host_id(hc)
+            for key, items in self._scenario_items(hc):
+                if getattr(items[0], "compact", False):
+                    name = self._compact_name(hc, key)
+                    steps = [manager._web_step(i.url, getattr(i, "expected_string", None), no)
+                             for no, i in enumerate(items, 1)]
+                    jitter_key = name
+                else:
+                    item = items[0]
+                    name = manager._create_item_name(
+                        item.url, hc.name if manager._is_packed(hc) else None)
+                    steps = [manager._web_step(item.url, getattr(item, "expected_string", None), 1, name)]
+                    jitter_key = item.url
+                params = manager._httptest_params(
+                    host_id, name, steps, jitter_key,
+                    getattr(items[0], "interval", None) or manager.check_interval)
+                yield Unit(key, params, [self._set("items", i._id, "item_id") for i in items], name)
+
+    def _triggers(self):
+        manager = self.manager
+        for hc in self.healthchecks:
+            if manager._uses_discovery(hc):
+                continue
+            host_name = manager._host_name(hc)
+            instance_name = hc.name if manager._is_packed(hc) else None
+            for item in self.items_by_group.get(hc.group_id, []):
+                if getattr(item, "shared", False):
+                    item_name = manager._create_shared_item_name(*manager._scenario_key(item))
+                    params = manager._trigger_params(manager.shared_host, item.url,
+                                                     getattr(item, "comment", None), item_name, hc.name)
+                    yield self._trigger_unit(str(item._id), params,
+                                             [self._set("items", item._id, "trigger_id")])
+            for key, items in self._scenario_items(hc):
+                if getattr(items[0], "compact", False):
+                    params = manager._scenario_trigger_params(
+                        host_name, self._compact_name(hc, key), hc.name)
+                else:
+                    item = items[0]
+                    params = manager._trigger_params(
+                        host_name, item.url, getattr(item, "comment", None),
+                        manager._create_item_name(item.url, instance_name), instance_name)
+                yield self._trigger_unit(key, params,
+                                         [self._set("items", i._id, "trigger_id") for i in items])
+
+    def _trigger_unit(self, key, params, updates):
+        return Unit(key, params, updates, name=(params["description"], params["expression"]))
+
+    def _scenario_items(self, hc):
+        """
+        Groups the items of an instance checked by its own scenarios, one
+        group per scenario, keyed by the first item of the scenario.
+        """
+        scenarios = {}
+        for item in sorted(self.items_by_group.get(hc.group_id, []), key=lambda i: i._id):
+            if getattr(item, "shared", False):
+                continue
+            if getattr(item, "compact", False):
+                scenarios.setdefault(("compact", item.item_id), []).append(item)
+            else:
+                scenarios[("url", item._id)] = [item]
+        return sorted([(str(items[0]._id), items) for items in scenarios.values()],
+                      key=lambda s: s[0])
+
+    def _compact_name(self, hc, key):
+        # derived from the first item so a resumed run finds the scenario
+        return "hc scenario {} for {}".format(key[-8:], hc.name)[:64]
@@ -2,7 +2,11 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import os
+import uuid
+
+from healthcheck import metrics, timing
 
 
 class Jsonable(object):
@@ -44,7 +48,15 @@ class Item(Jsonable):
         return self.__dict__
 
 
+# seconds mongodb keeps a snapshot after its last write
+SNAPSHOT_TTL = int(os.environ.get("SNAPSHOT_TTL", 7 * 24 * 3600))
+
+
+# connecting is lazy, only commands are measured
+@timing.measured_methods("mongo", exclude=("conn",))
+@metrics.observed_methods("mongo", exclude=("conn",))
 class MongoStorage(object):
+    snapshots_indexed = False
 
     def __init__(self):
         self.database_name = os.environ.get("MONGODB_DATABASE", "hcapi")
@@ -60,14 +72,34 @@ class MongoStorage(object):
     def add_item(self, item):
         self.db.items.insert(item.to_json())
 
-    def find_item_by_url(self, url):
-        result = self.db.items.find_one(
-            {"url": url}
-        )
+    def add_items(self, items):
+        self.db.items.insert_many([item.to_json() for item in items])
+
+    def find_item_by_url(self, url, group_id=None):
+        query = {"url": url}
+        if group_id is not None:
+            query["group_id"] = group_id
+        result = self.db.items.find_one(query)
         if not result:
             raise ItemNotFoundError()
         return Item(**result)
 
+    def find_items_by_group(self, group_id):
+        return [Item(**r) for r in self.db.items.find({"group_id": group_id})]
+
+    def find_items_by_groups(self, group_ids):
+        return [Item(**r) for r in self.db.items.find({"group_id": {"$in": group_ids}})]
+
+    def remove_items_by_groups(self, group_ids):
+        self.db.items.remove({"group_id": {"$in": group_ids}})
+
+    def find_items(self):
+        return [Item(**r) for r in self.db.items.find()]
+
+    def unset_items_actions(self, group_ids):
+        self.db.items.update_many({"group_id": {"$in": group_ids}},
+                                  {"$unset": {"action_id": ""}})
+
     def find_urls_by_healthcheck_name(self, name):
         items = []
         healthcheck = self.find_healthcheck_by_name(name)
@@ -86,7 +118,43 @@ class MongoStorage(object):
         return [watcher.email for watcher in watchers]
 
     def remove_item(self, item):
-        self.db.items.remove({"url": item.url})
+        query = {"url": item.url}
+        if getattr(item, "group_id", None) is not None:
+            query["group_id"] = item.group_id
+        self.db.items.remove(query)
+
+    def acquire_scenario(self, url, expected_string, interval):
+        from pymongo import ReturnDocument
+        return self.db.scenarios.find_one_and_update(
+            {"url": url, "expected_string": expected_string, "interval": interval},
+            {"$inc": {"refs": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def add_scenario(self, url, expected_string, interval, item_id):
+        scenario = {"url": url, "expected_string": expected_string, "interval": interval,
+                    "item_id": item_id, "refs": 1}
+        self.db.scenarios.insert(scenario)
+        return scenario
+
+    def release_scenario(self, url, expected_string, interval):
+        query = {"url": url, "expected_string": expected_string, "interval": interval}
+        self.db.scenarios.update_one(query, {"$inc": {"refs": -1}})
+        query["refs"] = {"$lte": 0}
+        return self.db.scenarios.find_one_and_delete(query)
+
+    def find_scenarios(self, urls=None):
+        query = {}
+        if urls is not None:
+            query["url"] = {"$in": urls}
+        return list(self.db.scenarios.find(query))
+
+    def release_scenarios(self, released):
+        for (url, expected_string, interval), count in released.items():
+            query = {"url": url, "expected_string": expected_string, "interval": interval}
+            self.db.scenarios.update_one(query, {"$inc": {"refs": -count}})
+        if released:
+            self.db.scenarios.remove({"refs": {"$lte": 0}})
 
     def add_user(self, user):
         self.db.users.insert(user.to_json())
@@ -94,15 +162,28 @@ class MongoStorage(object):
     def remove_user(self, user):
         self.db.users.remove({"email": user.email})
 
+    def remove_users(self, users):
+        if users:
+            self.db.users.remove({"email": {"$in": [u.email for u in users]}})
+
     def add_healthcheck(self, healthcheck):
         self.db.healthchecks.insert(
             healthcheck.to_json()
         )
 
+    def add_healthchecks(self, healthchecks):
+        self.db.healthchecks.insert_many([hc.to_json() for hc in healthchecks])
+
     def add_group_to_instance(self, healthcheck, group):
         self.db.healthchecks.update_one({"name": healthcheck.name},
                                         {"$push": {"host_groups": group}})
 
+    def add_groups_to_instance(self, healthcheck, groups):
+        if groups:
+            self.db.healthchecks.update_one(
+                {"name": healthcheck.name},
+                {"$addToSet": {"host_groups": {"$each": groups}}})
+
     def remove_group_from_instance(self, healthcheck, group):
         self.db.healthchecks.update_one({"name": healthcheck.name},
                                         {"$pull": {"host_groups": group}})
@@ -114,12 +195,228 @@ class MongoStorage(object):
 
     def find_healthcheck_by_name(self, name):
         result = self.db.healthchecks.find_one(
-            {"name": name}
+            {"name": name, "removed": {"$ne": True}}
         )
         if not result:
             raise HealthCheckNotFoundError()
         return HealthCheck(**result)
 
+    def find_healthchecks(self):
+        return [HealthCheck(**r) for r in self.db.healthchecks.find({"removed": {"$ne": True}})]
+
+    def tombstone_healthcheck(self, healthcheck):
+        now = datetime.datetime.utcnow()
+        self.db.healthchecks.update_one(
+            {"name": healthcheck.name, "removed": {"$ne": True}},
+            {"$set": {"removed": True, "removed_at": now, "next_attempt": now, "attempts": 0}})
+
+    def find_removed_healthcheck(self, name):
+        return self.db.healthchecks.find_one({"name": name, "removed": True})
+
+    def claim_removed_healthchecks(self, limit, lease, name=None):
+        """
+        Takes up to ``limit`` removed instances due for collection, and
+        holds them for ``lease`` seconds so other collectors skip them.
+        """
+        now = datetime.datetime.utcnow()
+        query = {"removed": True, "next_attempt": {"$lte": now}}
+        if name:
+            query["name"] = name
+        ids = [r["_id"] for r in self.db.healthchecks.find(query, {"_id": 1}).limit(limit)]
+        if not ids:
+            return []
+        query["_id"] = {"$in": ids}
+        token = uuid.uuid4().hex
+        self.db.healthchecks.update_many(
+            query, {"$set": {"next_attempt": now + datetime.timedelta(seconds=lease),
+                             "lease": token}})
+        return [HealthCheck(**r) for r in self.db.healthchecks.find({"lease": token})]
+
+    def defer_removal(self, healthcheck, delay):
+        next_attempt = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        self.db.healthchecks.update_one({"_id": healthcheck._id},
+                                        {"$set": {"next_attempt": next_attempt},
+                                         "$inc": {"attempts": 1}})
+
+    def remove_healthchecks(self, healthchecks):
+        self.db.healthchecks.remove({"_id": {"$in": [hc._id for hc in healthchecks]}})
+
+    def find_healthchecks_by_names(self, names, with_removed=False):
+        query = {"name": {"$in": names}}
+        if not with_removed:
+            query["removed"] = {"$ne": True}
+        return [HealthCheck(**r) for r in self.db.healthchecks.find(query)]
+
+    def set_healthcheck_proxy(self, healthcheck, proxy_id):
+        self.db.healthchecks.update_one({"name": healthcheck.name},
+                                        {"$set": {"proxy_id": proxy_id}})
+
+    def set_healthchecks_actions(self, actions):
+        from pymongo import UpdateOne
+        self.db.healthchecks.bulk_write([
+            UpdateOne({"name": healthcheck.name}, {"$set": {"action_id": action_id}})
+            for healthcheck, action_id in actions])
+
+    def count_items_by_group(self):
+        result = self.db.items.aggregate([
+            {"$match": {"shared": {"$ne": True}}},
+            {"$group": {"_id": "$group_id", "count": {"$sum": 1}}},
+        ])
+        return dict((r["_id"], r["count"]) for r in result)
+
+    def increment_proxy_load(self, proxy_id, value=1):
+        self.db.proxies.update_one({"proxy_id": proxy_id},
+                                   {"$inc": {"scenarios": value}},
+                                   upsert=True)
+
+    def set_proxy_load(self, proxy_id, value):
+        self.db.proxies.update_one({"proxy_id": proxy_id},
+                                   {"$set": {"scenarios": value}},
+                                   upsert=True)
+
+    def find_proxy_loads(self, proxy_ids):
+        result = self.db.proxies.find({"proxy_id": {"$in": proxy_ids}})
+        return dict((r["proxy_id"], r["scenarios"]) for r in result)
+
+    def claim_packed_host(self, limit):
+        from pymongo import ReturnDocument
+        return self.db.packed_hosts.find_one_and_update(
+            {"instances": {"$lt": limit}},
+            {"$inc": {"instances": 1}},
+            sort=[("instances", -1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def add_packed_host(self, host_id, name, proxy_id=None):
+        packed_host = {"host_id": host_id, "name": name,
+                       "proxy_id": proxy_id, "instances": 1}
+        self.db.packed_hosts.insert(packed_host)
+        return packed_host
+
+    def release_packed_host(self, host_id):
+        self.db.packed_hosts.update_one({"host_id": host_id},
+                                        {"$inc": {"instances": -1}})
+
+    def set_packed_host_proxy(self, host_id, proxy_id):
+        self.db.packed_hosts.update_one({"host_id": host_id},
+                                        {"$set": {"proxy_id": proxy_id}})
+
+    def add_pool_entries(self, names, proxies):
+        now = datetime.datetime.utcnow()
+        entries = [{"name": name, "proxy_id": proxy_id, "state": "creating",
+                    "updated_at": now} for name, proxy_id in zip(names, proxies)]
+        self.db.pool.insert_many(entries)
+        return entries
+
+    def set_pool_entries_ready(self, created):
+        from pymongo import UpdateOne
+        now = datetime.datetime.utcnow()
+        self.db.pool.bulk_write([
+            UpdateOne({"_id": entry["_id"]},
+                      {"$set": {"host_id": host_id, "group_id": group_id, "action_id": action_id,
+                                "state": "ready", "updated_at": now}})
+            for entry, host_id, group_id, action_id in created])
+
+    def count_pool_entries(self):
+        return self.db.pool.count({"state": {"$in": ["creating", "ready"]}})
+
+    def claim_pool_entry(self, name):
+        from pymongo import ReturnDocument
+        return self.db.pool.find_one_and_update(
+            {"state": "ready"},
+            {"$set": {"state": "claimed", "instance": name,
+                      "updated_at": datetime.datetime.utcnow()}},
+            sort=[("updated_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def remove_pool_entry(self, entry):
+        self.db.pool.remove({"_id": entry["_id"]})
+
+    def find_stale_pool_entries(self, timeout):
+        before = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+        return list(self.db.pool.find({"state": {"$in": ["creating", "claimed"]},
+                                       "updated_at": {"$lt": before}}))
+
+    def remove_pool_entries(self, entries):
+        self.db.pool.remove({"_id": {"$in": [e["_id"] for e in entries]}})
+
+    def acquire_lock(self, name, timeout):
+        """
+        Takes the lock ``name`` for ``timeout`` seconds, returning whether
+        it was free or had expired.
+        """
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.datetime.utcnow()
+        try:
+            self.db.locks.update_one(
+                {"_id": name, "expires_at": {"$lt": now}},
+                {"$set": {"expires_at": now + datetime.timedelta(seconds=timeout)}},
+                upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def release_lock(self, name):
+        self.db.locks.delete_one({"_id": name})
+
+    def find_packed_hosts(self):
+        return list(self.db.packed_hosts.find())
+
+    def find_restore_entries(self):
+        return list(self.db.restore.find({"phase": {"$exists": True}}))
+
+    def add_restore_entries(self, entries):
+        self.db.restore.insert_many(entries)
+
+    def apply_restore_entries(self):
+        """
+        Sets the fields recorded by a restore on their documents, with one
+        bulk write per collection, and drops the restore checkpoint.
+        """
+        from pymongo import UpdateOne
+        updates = {}
+        for entry in self.db.restore.find({"collection": {"$exists": True}}):
+            key = (entry["collection"], tuple(sorted(entry["query"].items())))
+            updates.setdefault(key, {}).update(entry["fields"])
+        requests = {}
+        for (collection, query), fields in updates.items():
+            requests.setdefault(collection, []).append(
+                UpdateOne(dict(query), {"$set": fields}))
+        for collection, ops in requests.items():
+            self.db[collection].bulk_write(ops, ordered=False)
+        self.db.restore.drop()
+
+    def find_snapshot(self, key):
+        return self.db.snapshots.find_one({"_id": key})
+
+    def save_snapshot(self, key, value, updated_at):
+        if not MongoStorage.snapshots_indexed:
+            self.db.snapshots.create_index("updated_at", expireAfterSeconds=SNAPSHOT_TTL)
+            MongoStorage.snapshots_indexed = True
+        self.db.snapshots.update_one({"_id": key},
+                                     {"$set": {"value": value, "updated_at": updated_at}},
+                                     upsert=True)
+
+    def add_profile(self, profile, keep):
+        """
+        Stores a request profile, dropping the oldest beyond ``keep``.
+        """
+        self.db.profiles.insert_one(profile)
+        old = list(self.db.profiles.find({}, {"_id": 1}).sort("_id", -1).skip(keep))
+        if old:
+            self.db.profiles.delete_many({"_id": {"$in": [p["_id"] for p in old]}})
+
+    def find_profiles(self):
+        return list(self.db.profiles.find({}, {"stats": 0, "summary": 0, "allocations": 0})
+                    .sort("_id", -1))
+
+    def find_profile(self, profile_id):
+        from bson.objectid import ObjectId
+        if not ObjectId.is_valid(profile_id):
+            return None
+        return self.db.profiles.find_one({"_id": ObjectId(profile_id)})
+
     def find_user_by_email(self, email):
         result = self.db.users.find_one(
             {"email": email}
@@ -128,6 +425,17 @@ class MongoStorage(object):
             raise UserNotFoundError()
         return User(result["id"], result["email"], *result["groups_id"])
 
+    def find_users(self):
+        return [User(r["id"], r["email"], *r["groups_id"]) for r in self.db.users.find()]
+
+    def find_users_by_groups(self, group_ids):
+        items = self.db.users.find({"groups_id": {"$in": group_ids}})
+        return [User(r["id"], r["email"], *r["groups_id"]) for r in items]
+
+    def remove_groups_from_users(self, group_ids):
+        self.db.users.update_many({"groups_id": {"$in": group_ids}},
+                                  {"$pull": {"groups_id": {"$in": group_ids}}})
+
     def find_users_by_group(self, group_id):
         items = self.db.users.find(
             {"groups_id": group_id},
@@ -137,6 +445,11 @@ class MongoStorage(object):
     def add_user_to_group(self, user, group):
         self.db.users.update({"id": user.id}, {"$push": {"groups_id": group}})
 
+    def add_users_to_group(self, user_ids, group):
+        if user_ids:
+            self.db.users.update_many({"id": {"$in": user_ids}},
+                                      {"$addToSet": {"groups_id": group}})
+
     def remove_user_from_group(self, user, group):
         self.db.users.update({"id": user.id}, {"$pull": {"groups_id": group}})
 
@@ -0,0 +1,316 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Splits the wall time of each API request into the time spent in mongodb,
+in zabbix calls and rendering the response, and the time the request
+waited before reaching a worker. With API_SERVER_TIMING set, responses
+carry a Server-Timing header, such as
+
+    Server-Timing: queue;dur=2.0, mongo;dur=3.1;desc="2 calls",
+        zabbix;dur=40.5;desc="1 call", render;dur=0.3, app;dur=45.2
+
+and each request is logged as a JSON line to the healthcheck.timing
+logger. Records carry their fields as a dict, serialized by
+JsonFormatter in the log worker rather than in the request. The queueing
+time is read from the X-Request-Start header set by the router. Measures
+are kept in a thread local, and measuring outside of a timed request
+does nothing.
+
+Requests slower than API_SLOW_REQUEST_THRESHOLD seconds, or making a
+call slower than API_SLOW_CALL_THRESHOLD seconds, are logged to the
+healthcheck.slow logger with their route, instance, the sequence of
+mongodb and zabbix calls and the stack of the slowest call, at most
+API_SLOW_LOG_RATE times a minute per worker.
+"""
+
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from healthcheck import logs
+
+KINDS = ("mongo", "zabbix", "render")
+MAX_EVENTS = 200
+STACK_LIMIT = 15
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("healthcheck.slow")
+
+_local = threading.local()
+
+
+class Timing(object):
+    """
+    The time spent and the number of calls of each kind of a request.
+    """
+
+    def __init__(self, started, queue=None, slow_call=None):
+        self.started = started
+        self.queue = queue
+        self.slow_call = slow_call
+        self.durations = dict((kind, 0.0) for kind in KINDS)
+        self.calls = dict((kind, 0) for kind in KINDS)
+        self.running = set()
+        self.events = []
+        self.slowest = None
+
+    def add(self, kind, duration, operation=None, started=None):
+        """
+        Records a call. The first MAX_EVENTS calls are kept in order, and
+        the stack of the slowest call over ``slow_call`` seconds is kept.
+        """
+        self.durations[kind] = self.durations.get(kind, 0.0) + duration
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        if len(self.events) < MAX_EVENTS:
+            offset = (started if started is not None else time.time() - duration) - self.started
+            self.events.append((kind, operation, offset, duration))
+        if (self.slow_call is not None and duration >= self.slow_call and
+                (self.slowest is None or duration > self.slowest[2])):
+            # the frame making the call, above measure and this method
+            stack = traceback.format_stack(sys._getframe(2), limit=STACK_LIMIT)
+            self.slowest = (kind, operation, duration, stack)
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def header(self, total):
+        parts = []
+        if self.queue is not None:
+            parts.append("queue;dur={:.1f}".format(self.queue * 1000))
+        for kind in KINDS:
+            part = "{};dur={:.1f}".format(kind, self.durations[kind] * 1000)
+            if kind != "render":
+                calls = self.calls[kind]
+                part += ';desc="{} call{}"'.format(calls, "" if calls == 1 else "s")
+            parts.append(part)
+        parts.append("app;dur={:.1f}".format(total * 1000))
+        return ", ".join(parts)
+
+    def fields(self, total):
+        fields = {"total_ms": round(total * 1000, 1)}
+        if self.queue is not None:
+            fields["queue_ms"] = round(self.queue * 1000, 1)
+        for kind in KINDS:
+            fields[kind + "_ms"] = round(self.durations[kind] * 1000, 1)
+            if kind != "render":
+                fields[kind + "_calls"] = self.calls[kind]
+        return fields
+
+    def slow_fields(self, total):
+        fields = {
+            "total_ms": round(total * 1000, 1),
+            "calls": [{"kind": kind, "operation": operation, "start_ms": round(offset * 1000, 1),
+                       "ms": round(duration * 1000, 1)}
+                      for kind, operation, offset, duration in self.events],
+        }
+        if self.queue is not None:
+            fields["queue_ms"] = round(self.queue * 1000, 1)
+        if len(self.events) < sum(self.calls.values()):
+            fields["calls_dropped"] = sum(self.calls.values()) - len(self.events)
+        if self.slowest:
+            kind, operation, duration, stack = self.slowest
+            fields["slowest"] = {"kind": kind, "operation": operation,
+                                 "ms": round(duration * 1000, 1), "stack": "".join(stack)}
+        return fields
+
+
+def start(queue=None, slow_call=None):
+    _local.timing = Timing(time.time(), queue, slow_call)
+    return _local.timing
+
+
+def current():
+    return getattr(_local, "timing", None)
+
+
+def stop():
+    timing = current()
+    _local.timing = None
+    return timing
+
+
+class measure(object):
+    """
+    Context manager adding the time of its block to the current request,
+    under ``kind``. Blocks nested in a block of the same kind, such as a
+    storage method calling another, are counted once.
+    """
+
+    __slots__ = ("kind", "operation", "timing", "started")
+
+    def __init__(self, kind, operation=None):
+        self.kind = kind
+        self.operation = operation
+        self.timing = None
+
+    def __enter__(self):
+        timing = getattr(_local, "timing", None)
+        if timing is not None and self.kind not in timing.running:
+            timing.running.add(self.kind)
+            self.timing = timing
+            self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timing = self.timing
+        if timing is not None:
+            self.timing = None
+            timing.running.discard(self.kind)
+            timing.add(self.kind, time.time() - self.started, self.operation, self.started)
+
+
+def measured(kind, operation=None):
+    """
+    Decorates a function to measure its calls under ``kind``.
+    """
+    def decorator(fn):
+        name = operation or fn.__name__
+
+        @functools.wraps(fn)
+        def decorated(*args, **kwargs):
+            with measure(kind, name):
+                return fn(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def measured_methods(kind, exclude=()):
+    """
+    Class decorator measuring every public method under ``kind``, but
+    those in ``exclude``.
+    """
+    def decorator(cls):
+        for name, attr in list(vars(cls).items()):
+            if not name.startswith("_") and name not in exclude and callable(attr):
+                setattr(cls, name, measured(kind, name)(attr))
+        return cls
+    return decorator
+
+
+def request_start(value, now):
+    """
+    Returns the seconds since the time in an X-Request-Start header, in
+    seconds, milliseconds or microseconds since the epoch, optionally
+    prefixed with "t=".
+    """
+    try:
+        started = float(value.strip().lstrip("t="))
+    except (AttributeError, ValueError):
+        return None
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, now - started)
+
+
+class RateLimit(object):
+    """
+    Allows ``rate`` events a minute, in bursts of up to ``rate``.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated_at = time.time()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns whether an event may happen now, and how many were
+        suppressed since the last allowed one.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate / 60)
+            self.updated_at = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False, self.suppressed
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return True, suppressed
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records logged with a dict as their message as a JSON line.
+    """
+
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            return json.dumps(record.msg, sort_keys=True)
+        return logging.Formatter.format(self, record)
+
+
+def _add_handler(log, level):
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        log.addHandler(logs.queued(handler))
+    log.setLevel(level)
+    log.propagate = False
+
+
+def install(app):
+    """
+    Times the requests of ``app`` when API_SERVER_TIMING or one of the
+    slow log thresholds is set.
+    """
+    server_timing = os.environ.get("API_SERVER_TIMING", "0") in ("True", "true", "1")
+    slow_request = float(os.environ.get("API_SLOW_REQUEST_THRESHOLD", 0)) or None
+    slow_call = float(os.environ.get("API_SLOW_CALL_THRESHOLD", 0)) or None
+    if not (server_timing or slow_request or slow_call):
+        return False
+    import flask
+    if server_timing:
+        _add_handler(logger, logging.INFO)
+    if slow_request or slow_call:
+        _add_handler(slow_logger, logging.WARNING)
+    rate_limit = RateLimit(float(os.environ.get("API_SLOW_LOG_RATE", 6)))
+
+    @app.before_request
+    def start_timing():
+        header = flask.request.headers.get("X-Request-Start")
+        start(request_start(header, time.time()) if header else None, slow_call)
+
+    @app.after_request
+    def add_timing(response):
+        timing = stop()
+        if timing is None:
+            return response
+        total = timing.elapsed()
+        request = {
+            "method": flask.request.method,
+            "route": flask.request.url_rule.rule if flask.request.url_rule else None,
+            "path": flask.request.path,
+            "status": response.status_code,
+        }
+        if server_timing:
+            response.headers["Server-Timing"] = timing.header(total)
+            fields = timing.fields(total)
+            fields.update(request)
+            logger.info(fields)
+        if (slow_request and total >= slow_request) or timing.slowest:
+            allowed, suppressed = rate_limit.allow()
+            if allowed:
+                fields = timing.slow_fields(total)
+                fields.update(request)
+                fields["instance"] = (flask.request.view_args or {}).get("name")
+                fields["suppressed"] = suppressed
+                slow_logger.warning(fields)
+        return response
+
+    @app.teardown_request
+    def clear_timing(exc):
+        _local.timing = None
+
+    return True
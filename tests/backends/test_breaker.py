@@ -0,0 +1,112 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import unittest
+
+import mock
+import requests
+
+from healthcheck.backends.breaker import CircuitBreaker, CircuitOpenError, OPEN, HALF_OPEN, CLOSED
+from healthcheck.backends.client import ZabbixClient
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        time_patch = mock.patch("time.time", return_value=1000.0)
+        self.time = time_patch.start()
+        self.addCleanup(time_patch.stop)
+        self.breaker = CircuitBreaker(window=4, min_calls=4, failure_ratio=0.5, slow_call=1,
+                                      reset_timeout=30)
+
+    def test_opens_on_failures(self):
+        for failed in [False, True, False, True]:
+            self.breaker.allow()
+            self.breaker.record(0.1, failed)
+
+        self.assertEqual(OPEN, self.breaker.state)
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.breaker.allow()
+        self.assertEqual(30, cm.exception.args[1])
+        self.assertEqual(1, self.breaker.metrics()["rejected"])
+
+    def test_opens_on_slow_calls(self):
+        for _ in range(4):
+            self.breaker.record(2, False)
+
+        self.assertEqual(OPEN, self.breaker.state)
+
+    def test_ignores_slow_batch_calls(self):
+        for _ in range(4):
+            self.breaker.record(20, False, count_slow=False)
+
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_stays_closed_below_ratio(self):
+        for failed in [False, False, False, True, False]:
+            self.breaker.record(0.1, failed)
+
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_probes_half_open(self):
+        for _ in range(4):
+            self.breaker.record(0.1, True)
+        self.time.return_value = 1030.0
+
+        self.breaker.allow()
+
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.time.return_value = 1040.0
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.breaker.allow()
+        self.assertEqual(20, cm.exception.args[1])
+        self.breaker.record(0.1, False)
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.breaker.allow()
+
+    def test_retry_after_at_least_one_second(self):
+        for _ in range(4):
+            self.breaker.record(0.1, True)
+        self.time.return_value = 1029.9
+
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.breaker.allow()
+
+        self.assertEqual(1, cm.exception.args[1])
+
+    def test_failed_probe_opens_again(self):
+        for _ in range(4):
+            self.breaker.record(0.1, True)
+        self.time.return_value = 1030.0
+        self.breaker.allow()
+
+        self.breaker.record(0.1, True)
+
+        self.assertEqual(OPEN, self.breaker.state)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.allow()
+        metrics = self.breaker.metrics()
+        self.assertEqual(2, metrics["open"])
+        self.assertEqual(1, metrics["half-open"])
+        self.assertEqual(5, metrics["failures"])
+
+    def test_client(self):
+        client = ZabbixClient("http://zbx.com", retries=0, breaker=self.breaker)
+        client.session = mock.Mock()
+        client.session.post.side_effect = requests.ConnectionError("refused")
+        for _ in range(4):
+            with self.assertRaises(Exception):
+                client.host.get(output=["hostid"])
+
+        with self.assertRaises(CircuitOpenError):
+            client.host.get(output=["hostid"])
+
+        self.assertEqual(4, client.session.post.call_count)
+        self.time.return_value = 1030.0
+        client.session.post.side_effect = None
+        client.session.post.return_value = mock.Mock(status_code=200,
+                                                     content=json.dumps({"result": []}))
+        self.assertEqual([], client.host.get(output=["hostid"]))
+        self.assertEqual(CLOSED, self.breaker.state)
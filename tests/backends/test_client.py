@@ -0,0 +1,151 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import unittest
+
+import mock
+import requests
+
+from healthcheck.backends import client
+from healthcheck.backends.client import ZabbixClient, ZabbixAPIException
+
+
+def response(body, status_code=200):
+    resp = mock.Mock(status_code=status_code)
+    resp.content = json.dumps(body).encode("utf-8")
+    return resp
+
+
+class ZabbixClientTest(unittest.TestCase):
+
+    def setUp(self):
+        client._sessions.clear()
+        client._tokens.clear()
+        self.client = ZabbixClient("http://zbx.com/", retries=2)
+        self.client.session = self.session = mock.Mock()
+        sleep_patch = mock.patch("time.sleep")
+        self.sleep = sleep_patch.start()
+        self.addCleanup(sleep_patch.stop)
+
+    def sent(self, index=-1):
+        return json.loads(self.session.post.call_args_list[index][1]["data"])
+
+    def test_kwargs_are_sent_as_object(self):
+        self.session.post.return_value = response({"result": [{"hostid": "1"}]})
+
+        result = self.client.host.get(output=["hostid"], hostids=["1"])
+
+        self.assertEqual([{"hostid": "1"}], result)
+        self.session.post.assert_called_with("http://zbx.com/api_jsonrpc.php", data=mock.ANY,
+                                             timeout=(3, 10))
+        sent = self.sent()
+        self.assertEqual("host.get", sent["method"])
+        self.assertEqual({"output": ["hostid"], "hostids": ["1"]}, sent["params"])
+
+    def test_args_are_sent_as_array(self):
+        self.session.post.return_value = response({"result": {"hostids": ["1", "2"]}})
+
+        self.client.host.create({"host": "a"}, {"host": "b"})
+
+        self.assertEqual([{"host": "a"}, {"host": "b"}], self.sent()["params"])
+
+    def test_args_and_kwargs(self):
+        with self.assertRaises(TypeError):
+            self.client.host.create({"host": "a"}, host="b")
+
+    def test_login_reuses_token(self):
+        self.session.post.return_value = response({"result": "token"})
+        self.client.login("user", "pass")
+
+        other = ZabbixClient("http://zbx.com")
+        other.session = self.session
+        other.login("user", "pass")
+
+        self.assertEqual(1, self.session.post.call_count)
+        self.assertEqual("token", other.auth)
+        self.session.post.return_value = response({"result": []})
+        other.host.get(output=["hostid"])
+        self.assertEqual("token", self.sent()["auth"])
+        self.assertNotIn("auth", self.sent(0))
+
+    def test_logs_in_again_when_session_terminated(self):
+        self.session.post.side_effect = [
+            response({"result": "old"}),
+            response({"error": {"code": -32602, "message": "Invalid params.",
+                                "data": "Session terminated, re-login, please."}}),
+            response({"result": "new"}),
+            response({"result": []}),
+        ]
+        self.client.login("user", "pass")
+
+        self.assertEqual([], self.client.host.get(output=["hostid"]))
+
+        self.assertEqual("new", self.sent()["auth"])
+        self.assertEqual("new", client._tokens[(self.client.url, "user", "pass")])
+
+    def test_error(self):
+        self.session.post.return_value = response(
+            {"error": {"code": -32602, "message": "Invalid params.", "data": "already exists"}})
+
+        with self.assertRaises(ZabbixAPIException) as cm:
+            self.client.host.create({"host": "a"})
+
+        self.assertEqual(("Error -32602: Invalid params., already exists", -32602),
+                         cm.exception.args)
+        self.assertEqual(1, self.session.post.call_count)
+
+    def test_get_is_retried(self):
+        self.session.post.side_effect = [
+            requests.ConnectionError("reset"),
+            response({}, status_code=502),
+            response({"result": []}),
+        ]
+
+        self.assertEqual([], self.client.host.get(output=["hostid"]))
+
+        self.assertEqual(3, self.session.post.call_count)
+        self.assertEqual(2, self.sleep.call_count)
+        self.assertTrue(0 <= self.sleep.call_args_list[1][0][0] <= 0.2)
+
+    def test_get_gives_up(self):
+        self.session.post.side_effect = requests.Timeout("timed out")
+
+        with self.assertRaises(ZabbixAPIException):
+            self.client.host.get(output=["hostid"])
+
+        self.assertEqual(3, self.session.post.call_count)
+
+    def test_writes_are_not_retried(self):
+        self.session.post.side_effect = requests.Timeout("timed out")
+
+        with self.assertRaises(ZabbixAPIException):
+            self.client.host.create({"host": "a"})
+
+        self.assertEqual(1, self.session.post.call_count)
+
+    def test_with_timeout(self):
+        self.session.post.return_value = response({"result": []})
+
+        self.client.with_timeout(60).host.delete("1")
+
+        self.session.post.assert_called_with(mock.ANY, data=mock.ANY, timeout=(3, 60))
+        self.assertEqual(10, self.client.timeout)
+
+    def test_batch(self):
+        self.session.post.return_value = response({"result": {"hostids": ["1"]}})
+        self.client.breaker = mock.Mock()
+
+        self.client.batch(60).host.create({"host": "a"})
+        self.client.host.create({"host": "b"})
+
+        self.session.post.assert_any_call(mock.ANY, data=mock.ANY, timeout=(3, 60))
+        self.assertEqual([False, True], [c[0][2] for c in self.client.breaker.record.call_args_list])
+
+    def test_connections_are_shared(self):
+        one = ZabbixClient("http://zbx.com")
+        two = ZabbixClient("http://zbx.com")
+
+        self.assertIs(one.session, two.session)
+        self.assertEqual("gzip", one.session.headers["Accept-Encoding"])
@@ -0,0 +1,177 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from healthcheck.backends.client import ZabbixClient, ZabbixAPIException
+from healthcheck.backends.limiter import Limiter, LimiterTimeoutError
+
+
+class FakeServer(object):
+    """
+    A server answering in ``latency`` seconds up to ``capacity`` concurrent
+    calls, and proportionally slower above it.
+    """
+
+    def __init__(self, capacity, latency):
+        self.capacity = capacity
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.running = 0
+        self.loads = []
+
+    def call(self):
+        with self.lock:
+            self.running += 1
+            load = float(self.running) / self.capacity
+            self.loads.append(load)
+        time.sleep(self.latency * max(1, load))
+        with self.lock:
+            self.running -= 1
+
+
+class LimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "limiter")
+
+    def limiter(self, **kwargs):
+        kwargs.setdefault("wait", 1)
+        return Limiter(self.path, **kwargs)
+
+    def test_limits_calls_in_flight(self):
+        limiter = self.limiter(max_limit=2, wait=0.05)
+        limiter.acquire()
+        limiter.acquire()
+
+        with self.assertRaises(LimiterTimeoutError):
+            limiter.acquire()
+        self.assertEqual(2, limiter.in_flight())
+
+    def test_limit_is_shared_by_workers(self):
+        self.limiter(max_limit=2).acquire()
+        other = self.limiter(max_limit=2, wait=0.05)
+        slot = other.acquire()
+
+        with self.assertRaises(LimiterTimeoutError):
+            other.acquire()
+        other.release(slot, 0.01)
+        other.acquire()
+
+    def test_slots_of_dead_workers_are_recovered(self):
+        limiter = self.limiter(max_limit=1, wait=0.05)
+        slot = limiter.acquire()
+        limiter._set_slot(slot, 2 ** 31 - 1, time.time() + 60)
+
+        self.assertEqual(slot, limiter.acquire())
+
+    def test_expired_slots_are_recovered(self):
+        limiter = self.limiter(max_limit=1, lease=0.01)
+        limiter.acquire()
+        time.sleep(0.02)
+
+        limiter.acquire()
+
+    def test_limit_decreases_on_slow_calls(self):
+        limiter = self.limiter(max_limit=10, target_latency=0.5)
+
+        limiter.release(limiter.acquire(), 1)
+        limit = limiter.release(limiter.acquire(), 1)
+
+        self.assertAlmostEqual(7, limit)
+        self.assertAlmostEqual(7, limiter.limit())
+
+    def test_limit_decreases_on_overload(self):
+        limiter = self.limiter(max_limit=10, min_limit=2, target_latency=0)
+
+        for _ in range(10):
+            limiter.release(limiter.acquire(), 0, overloaded=True)
+            limiter._write_header(limiter.limit(), 1, time.time(), 0, 0)
+
+        self.assertEqual(2, limiter.limit())
+
+    def test_limit_increases_on_fast_calls(self):
+        limiter = self.limiter(max_limit=10)
+        limiter._write_header(4.0, 1, time.time(), 0, 0)
+
+        for _ in range(4):
+            limiter.release(limiter.acquire(), 0.01)
+
+        self.assertAlmostEqual(5, limiter.limit(), places=0)
+
+    def test_writes_leave_room_for_reads(self):
+        limiter = self.limiter(max_limit=4, write_share=0.5, wait=0.05)
+        limiter.acquire(read=False)
+        limiter.acquire(read=False)
+
+        with self.assertRaises(LimiterTimeoutError):
+            limiter.acquire(read=False)
+        limiter.acquire(read=True)
+
+    def test_writes_wait_for_waiting_reads(self):
+        limiter = self.limiter(max_limit=1, wait=0.05, poll=0.05)
+        slot = limiter.acquire()
+        with self.assertRaises(LimiterTimeoutError):
+            limiter.acquire(read=True)
+        limiter.release(slot, 0.01)
+
+        with self.assertRaises(LimiterTimeoutError):
+            limiter.acquire(read=False)
+        limiter.acquire(read=True)
+
+    @mock.patch("time.time")
+    def test_rate(self, time_mock):
+        time_mock.return_value = 1000.0
+        limiter = self.limiter(max_limit=10, rate=2, wait=0)
+        limiter.release(limiter.acquire(), 0.01)
+        limiter.release(limiter.acquire(), 0.01)
+
+        with self.assertRaises(LimiterTimeoutError):
+            limiter.acquire()
+        time_mock.return_value = 1000.5
+        limiter.acquire()
+
+    def test_adapts_to_server_capacity(self):
+        server = FakeServer(capacity=4, latency=0.005)
+        limiter = self.limiter(max_limit=16, target_latency=0.008, poll=0.001, wait=5)
+
+        def worker():
+            for _ in range(25):
+                slot = limiter.acquire()
+                started = time.time()
+                server.call()
+                limiter.release(slot, time.time() - started)
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # unlimited, the 16 workers would load the server 4 times its capacity
+        loads = sorted(server.loads)
+        self.assertLessEqual(loads[len(loads) // 2], 2)
+        self.assertEqual(0, limiter.in_flight())
+
+    def test_client(self):
+        limiter = self.limiter(max_limit=1, wait=0.05)
+        client = ZabbixClient("http://zbx.com", limiter=limiter)
+        client.session = mock.Mock()
+        client.session.post.return_value = mock.Mock(status_code=200, content=b'{"result": []}')
+
+        self.assertEqual([], client.host.get(output=["hostid"]))
+        self.assertEqual(0, limiter.in_flight())
+
+        limiter.acquire()
+        with self.assertRaises(ZabbixAPIException):
+            client.host.create({"host": "a"})
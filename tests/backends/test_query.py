@@ -0,0 +1,53 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import ast
+import os
+import unittest
+
+import mock
+
+import healthcheck
+from healthcheck.backends.query import InvalidQueryError, Query
+
+
+class QueryTest(unittest.TestCase):
+
+    def test_run(self):
+        zapi = mock.Mock()
+        zapi.host.get.return_value = [{"hostid": "1"}]
+        query = Query("host", ["hostid"], limit=1, filter={"host": ["a"]},
+                      selectGroups=["groupid"])
+        self.assertEqual([{"hostid": "1"}], query.run(zapi))
+        zapi.host.get.assert_called_with(output=["hostid"], limit=1, filter={"host": ["a"]},
+                                         selectGroups=["groupid"])
+
+    def test_output_is_required(self):
+        for output in (None, [], "extend"):
+            with self.assertRaises(InvalidQueryError):
+                Query("host", output)
+
+    def test_select_fields_are_required(self):
+        with self.assertRaises(InvalidQueryError):
+            Query("httptest", ["httptestid"], selectSteps="extend")
+        Query("httptest", ["httptestid"], selectSteps="count")
+
+    def test_backends_only_get_through_queries(self):
+        root = os.path.dirname(healthcheck.__file__)
+        calls = []
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if not filename.endswith(".py") or filename == "query.py":
+                    continue
+                path = os.path.join(dirpath, filename)
+                with open(path) as f:
+                    tree = ast.parse(f.read(), path)
+                for node in ast.walk(tree):
+                    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+                            node.func.attr == "get" and self._uses_zapi(node.func.value):
+                        calls.append("{}:{}".format(path, node.lineno))
+        self.assertEqual([], calls, "zabbix get calls without Query")
+
+    def _uses_zapi(self, node):
+        return any(isinstance(n, ast.Attribute) and n.attr == "zapi" for n in ast.walk(node))
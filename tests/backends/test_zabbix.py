@@ -3,20 +3,25 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import os
 import unittest
 
 import mock
 
+from healthcheck import backends
+from healthcheck.backends.breaker import CircuitOpenError
 from healthcheck.backends import (WatcherAlreadyRegisteredError,
-                                  WatcherNotInInstanceError, get_value)
+                                  WatcherNotInInstanceError, InvalidIntervalError,
+                                  InvalidCloneError, RemovalPendingError,
+                                  get_value)
 from healthcheck.storage import Item, User, HealthCheck, UserNotFoundError
 
 
 class ZabbixTest(unittest.TestCase):
 
     @mock.patch("healthcheck.storage.MongoStorage")
-    @mock.patch("pyzabbix.ZabbixAPI")
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
     def setUp(self, zabbix_mock, mongo_mock):
         os.environ["ZABBIX_URL"] = self.url = "http://zbx.com"
         os.environ["ZABBIX_USER"] = self.user = "user"
@@ -25,6 +30,7 @@ class ZabbixTest(unittest.TestCase):
         os.environ["ZABBIX_HOST_GROUP"] = "2"
         zapi_mock = mock.Mock()
         zapi_mock.trigger.get.return_value = {"result": [{"comments": "teste"}]}
+        zapi_mock.batch.return_value = zapi_mock
         zabbix_mock.return_value = zapi_mock
 
         instance_mock = mock.Mock()
@@ -32,12 +38,25 @@ class ZabbixTest(unittest.TestCase):
 
         from healthcheck.backends import Zabbix
         self.backend = Zabbix()
-        zabbix_mock.assert_called_with(self.url)
+        zabbix_mock.assert_called_with(self.url, timeout=10.0, retries=2, connections=10,
+                                       limiter=None, breaker=mock.ANY)
         zapi_mock.login.assert_called_with(self.user, self.password)
 
         mongo_mock.assert_called_with()
         instance_mock.conn.assert_called_with()
         self.backend.storage = mock.Mock()
+        self.backend.storage.find_removed_healthcheck.return_value = None
+        backends._snapshots.clear()
+
+    @mock.patch("healthcheck.storage.MongoStorage")
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
+    def test_api_retries_apart_from_scenario_retries(self, zabbix_mock, mongo_mock):
+        with mock.patch.dict(os.environ, {"ZABBIX_RETRIES": "5", "ZABBIX_API_RETRIES": "1"}):
+            backend = backends.Zabbix()
+            params = backend._httptest_params("1", "hc for http://a.com", [], "http://a.com", 60)
+
+        self.assertEqual(1, zabbix_mock.call_args[1]["retries"])
+        self.assertEqual(5, params["retries"])
 
     def test_get_value(self):
         url = get_value("ZABBIX_URL")
@@ -60,7 +79,7 @@ class ZabbixTest(unittest.TestCase):
         self.backend.zapi.trigger.create.return_value = {"triggerids": [1]}
         old_add_action = self.backend._add_action
         self.backend._add_action = mock.Mock()
-        hmock = mock.Mock(host_id="1", group_id=13)
+        hmock = HealthCheck("hc_name", host_id="1", group_id=13)
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
 
         self.backend.add_url(hc_name, url)
@@ -77,6 +96,7 @@ class ZabbixTest(unittest.TestCase):
             }],
             hostid="1",
             retries=3,
+            delay=self.backend._check_delay(url, 60),
         )
         expression = ("{{hc_name:web.test.rspcode[{item_name},"
                       "{item_name}].last()}}<>200 or {{hc_name:web.test.fail["
@@ -88,10 +108,22 @@ class ZabbixTest(unittest.TestCase):
             priority=5,
             comments=None,
         )
-        self.assertTrue(self.backend.storage.add_item.called)
-        self.backend._add_action.assert_called_with(url, 1, 13)
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual((None, None), (item.expected_string, item.comment))
+        self.assertFalse(self.backend._add_action.called)
         self.backend._add_action = old_add_action
 
+    def test_add_url_records_expected_string_and_comment(self):
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["70"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["80"]}
+        hc = HealthCheck("hc_name", host_id="1", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+
+        self.backend.add_url("hc_name", "http://mysite.com", "OK", "call ops")
+
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual(("OK", "call ops"), (item.expected_string, item.comment))
+
     def test_add_url_expected_string(self):
         url = "http://mysite.com"
         hc_name = "hc_name"
@@ -105,7 +137,7 @@ class ZabbixTest(unittest.TestCase):
             self.backend._add_action = old_add_action
         self.addCleanup(set_old_add_action)
         self.backend._add_action = mock.Mock()
-        hmock = mock.Mock(host_id="1", group_id=13)
+        hmock = HealthCheck("hc_name", host_id="1", group_id=13)
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
 
         self.backend.add_url(hc_name, url, expected_string="WORKING")
@@ -123,6 +155,7 @@ class ZabbixTest(unittest.TestCase):
             }],
             hostid="1",
             retries=3,
+            delay=self.backend._check_delay(url, 60),
         )
 
     def test_add_url_comment(self):
@@ -137,7 +170,7 @@ class ZabbixTest(unittest.TestCase):
             self.backend._add_action = old_add_action
         self.addCleanup(set_old_add_action)
         self.backend._add_action = mock.Mock()
-        hmock = mock.Mock(host_id="1", group_id=13)
+        hmock = HealthCheck("hc_name", host_id="1", group_id=13)
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
 
         self.backend.add_url(hc_name, url, comment="http://test.com")
@@ -161,7 +194,7 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         self.backend.zapi.trigger.create.return_value = {"triggerids": [1]}
         old_add_action = self.backend._add_action
         self.backend._add_action = mock.Mock()
-        hmock = mock.Mock(host_id="1", group_id=13)
+        hmock = HealthCheck("hc_name", host_id="1", group_id=13)
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
 
         self.backend.add_url(hc_name, url)
@@ -178,6 +211,7 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
             }],
             hostid="1",
             retries=3,
+            delay=self.backend._check_delay(url, 60),
         )
         expression = ("{{hc_name:web.test.rspcode[{item_name},"
                       "{item_name}].last()}}<>200 or {{hc_name:web.test.fail["
@@ -190,9 +224,56 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
             comments=None,
         )
         self.assertTrue(self.backend.storage.add_item.called)
-        self.backend._add_action.assert_called_with(url, 1, 13)
+        self.assertFalse(self.backend._add_action.called)
         self.backend._add_action = old_add_action
 
+    def test_add_url_interval(self):
+        url = "http://mysite.com"
+        self.backend.zapi.httptest.create.return_value = {"httptestids": [1]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": [1]}
+        self.backend.zapi.action.create.return_value = {"actionids": [1]}
+        hmock = HealthCheck("hc_name", host_id="1", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hmock
+
+        self.backend.add_url("hc_name", url, interval="300")
+
+        _, kwargs = self.backend.zapi.httptest.create.call_args
+        self.assertEqual(self.backend._check_delay(url, 300), kwargs["delay"])
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual(300, item.interval)
+
+    def test_add_url_interval_below_minimum(self):
+        with self.assertRaises(InvalidIntervalError):
+            self.backend.add_url("hc_name", "http://mysite.com", interval=10)
+        self.assertFalse(self.backend.zapi.httptest.create.called)
+
+    def test_add_url_invalid_interval(self):
+        with self.assertRaises(InvalidIntervalError):
+            self.backend.add_url("hc_name", "http://mysite.com", interval="often")
+        self.assertFalse(self.backend.zapi.httptest.create.called)
+
+    def test_check_interval_default(self):
+        self.assertEqual(60, self.backend._check_interval(None))
+        self.assertEqual(60, self.backend._check_interval(""))
+        self.assertEqual(120, self.backend._check_interval(120))
+
+    def test_check_delay(self):
+        delays = set()
+        for i in range(100):
+            url = u"http://mysite{}.com/hc".format(i)
+            delay = self.backend._check_delay(url, 60)
+            self.assertEqual(delay, self.backend._check_delay(url, 60))
+            self.assertTrue(60 <= delay <= 66)
+            delays.add(delay)
+        self.assertEqual(7, len(delays))
+
+    def test_check_delay_configured_jitter(self):
+        self.backend.check_jitter = "0"
+        self.assertEqual(60, self.backend._check_delay("http://mysite.com", 60))
+        self.backend.check_jitter = "30"
+        delay = self.backend._check_delay("http://mysite.com", 60)
+        self.assertTrue(60 <= delay <= 90)
+
     def test_remove_url(self):
         url = "http://mysite.com"
         item_id = 1
@@ -215,6 +296,492 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         self.backend._remove_action = old_action
         self.backend.storage.remove_item.assert_called_with(item)
 
+    def test_remove_url_without_action(self):
+        item = Item("http://mysite.com", item_id=1, trigger_id=1)
+        self.backend.storage.find_item_by_url.return_value = item
+
+        self.backend.remove_url("hc_name", "http://mysite.com")
+
+        self.assertFalse(self.backend.zapi.action.delete.called)
+        self.backend.zapi.httptest.delete.assert_called_with(1)
+
+    def test_add_url_shared(self):
+        url = "http://auth.com/hc"
+        self.backend.shared_host = "hcaas-shared"
+        self.backend.shared_host_id = "50"
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, proxy_id="10")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.acquire_scenario.return_value = None
+        self.backend.storage.add_scenario.return_value = {"item_id": "70", "refs": 1}
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["70"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["80"]}
+
+        self.backend.add_url("hc_name", url, "OK")
+
+        item_name = self.backend._create_shared_item_name(url, "OK", 60)
+        self.backend.storage.acquire_scenario.assert_called_with(url, "OK", 60)
+        self.backend.zapi.httptest.create.assert_called_with(
+            name=item_name,
+            steps=[{"name": item_name, "url": url, "status_codes": "200",
+                    "no": 1, "required": "OK"}],
+            hostid="50",
+            retries=3,
+            delay=self.backend._check_delay(url, 60),
+        )
+        self.backend.storage.add_scenario.assert_called_with(url, "OK", 60, "70")
+        _, kwargs = self.backend.zapi.trigger.create.call_args
+        self.assertEqual("trigger for url http://auth.com/hc [hc_name]", kwargs["description"])
+        self.assertIn("{hcaas-shared:web.test.fail[%s].last()}" % item_name, kwargs["expression"])
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual(("70", "80", 13, True), (item.item_id, item.trigger_id, item.group_id, item.shared))
+        self.assertFalse(self.backend.storage.increment_proxy_load.called)
+
+    def test_add_url_shared_existing_scenario(self):
+        self.backend.shared_host = "hcaas-shared"
+        self.backend.shared_host_id = "50"
+        hc = HealthCheck("hc_name", host_id="1", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.acquire_scenario.return_value = {"item_id": "70", "refs": 2}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["81"]}
+
+        self.backend.add_url("hc_name", "http://auth.com/hc")
+
+        self.backend.storage.acquire_scenario.assert_called_with("http://auth.com/hc", None, 60)
+        self.assertFalse(self.backend.zapi.httptest.create.called)
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual(("70", "81"), (item.item_id, item.trigger_id))
+
+    def test_add_url_shared_other_interval(self):
+        self.backend.shared_host = "hcaas-shared"
+        self.backend.shared_host_id = "50"
+        hc = HealthCheck("hc_name", host_id="1", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.acquire_scenario.return_value = None
+        self.backend.storage.add_scenario.return_value = {"item_id": "71", "refs": 1}
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["71"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["81"]}
+
+        self.backend.add_url("hc_name", "http://auth.com/hc", interval=120)
+
+        self.backend.storage.acquire_scenario.assert_called_with("http://auth.com/hc", None, 120)
+        _, kwargs = self.backend.zapi.httptest.create.call_args
+        self.assertEqual(self.backend._create_shared_item_name("http://auth.com/hc", None, 120), kwargs["name"])
+        self.assertEqual(self.backend._check_delay("http://auth.com/hc", 120), kwargs["delay"])
+        self.backend.storage.add_scenario.assert_called_with("http://auth.com/hc", None, 120, "71")
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual(("71", 120), (item.item_id, item.interval))
+
+    def test_add_url_shared_trigger_failure_releases_scenario(self):
+        self.backend.shared_host = "hcaas-shared"
+        self.backend.shared_host_id = "50"
+        hc = HealthCheck("hc_name", host_id="1", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.acquire_scenario.return_value = {"item_id": "70", "refs": 2}
+        self.backend.storage.release_scenario.return_value = None
+        self.backend.zapi.trigger.create.side_effect = ValueError()
+
+        with self.assertRaises(ValueError):
+            self.backend.add_url("hc_name", "http://auth.com/hc")
+
+        self.backend.storage.release_scenario.assert_called_with("http://auth.com/hc", None, 60)
+        self.assertFalse(self.backend.storage.add_item.called)
+
+    def test_remove_url_shared(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13)
+        item = Item("http://auth.com/hc", item_id="70", trigger_id="80", group_id=13,
+                    expected_string="OK", shared=True)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_item_by_url.return_value = item
+        self.backend.storage.release_scenario.return_value = None
+
+        self.backend.remove_url("hc_name", "http://auth.com/hc")
+
+        self.backend.storage.find_item_by_url.assert_called_with("http://auth.com/hc", 13)
+        self.backend.zapi.trigger.delete.assert_called_with("80")
+        self.backend.storage.release_scenario.assert_called_with("http://auth.com/hc", "OK", 60)
+        self.assertFalse(self.backend.zapi.httptest.delete.called)
+        self.backend.storage.remove_item.assert_called_with(item)
+
+    def test_remove_url_shared_last_reference(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13)
+        item = Item("http://auth.com/hc", item_id="70", trigger_id="80", group_id=13, shared=True)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_item_by_url.return_value = item
+        self.backend.storage.release_scenario.return_value = {"item_id": "70", "refs": 0}
+
+        self.backend.remove_url("hc_name", "http://auth.com/hc")
+
+        self.backend.zapi.httptest.delete.assert_called_with("70")
+
+    def test_create_shared_item_name(self):
+        name = self.backend._create_shared_item_name("http://auth.com/hc")
+        self.assertTrue(name.startswith("hc "))
+        self.assertTrue(name.endswith(" for http://auth.com/hc"))
+        self.assertNotEqual(name, self.backend._create_shared_item_name("http://auth.com/hc", "OK"))
+        self.assertNotEqual(name, self.backend._create_shared_item_name("http://auth.com/hc", None, 120))
+        long_name = self.backend._create_shared_item_name("http://auth.com/" + "a" * 100)
+        self.assertEqual(64, len(long_name))
+
+    def test_add_url_compact_new_scenario(self):
+        url = "http://auth.com/hc"
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, steps_per_scenario=10)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_items_by_group.return_value = []
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["70"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["80"]}
+
+        self.backend.add_url("hc_name", url, "OK", "my comment")
+
+        _, kwargs = self.backend.zapi.httptest.create.call_args
+        scenario_name = kwargs["name"]
+        self.assertTrue(scenario_name.startswith("hc scenario "))
+        self.assertTrue(scenario_name.endswith(" for hc_name"))
+        self.assertEqual([{"name": "1: hc for http://auth.com/hc", "url": url,
+                           "status_codes": "200", "no": 1, "required": "OK"}], kwargs["steps"])
+        self.assertEqual("1", kwargs["hostid"])
+        _, kwargs = self.backend.zapi.trigger.create.call_args
+        self.assertEqual("{hc_name:web.test.fail[%s].last()}<>0" % scenario_name, kwargs["expression"])
+        self.assertIn("[hc_name]", kwargs["description"])
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual(("70", "80", 13, True, "my comment"),
+                         (item.item_id, item.trigger_id, item.group_id, item.compact, item.comment))
+
+    def test_add_url_compact_existing_scenario(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, steps_per_scenario=2)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_items_by_group.return_value = [
+            Item("http://a.com", _id=1, item_id="70", trigger_id="80", interval=60, compact=True),
+            Item("http://b.com", _id=2, item_id="71", trigger_id="81", interval=60, compact=True),
+            Item("http://c.com", _id=3, item_id="71", trigger_id="81", interval=60, compact=True),
+        ]
+
+        self.backend.add_url("hc_name", "http://d.com")
+
+        self.assertFalse(self.backend.zapi.httptest.create.called)
+        self.assertFalse(self.backend.zapi.trigger.create.called)
+        self.backend.zapi.httptest.update.assert_called_with(httptestid="70", steps=[
+            {"name": "1: hc for http://a.com", "url": "http://a.com", "status_codes": "200", "no": 1},
+            {"name": "2: hc for http://d.com", "url": "http://d.com", "status_codes": "200", "no": 2},
+        ])
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual(("70", "80"), (item.item_id, item.trigger_id))
+
+    def test_add_url_compact_other_interval(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, steps_per_scenario=10)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_items_by_group.return_value = [
+            Item("http://a.com", _id=1, item_id="70", trigger_id="80", interval=60, compact=True),
+        ]
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["71"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["81"]}
+
+        self.backend.add_url("hc_name", "http://d.com", interval=300)
+
+        self.assertFalse(self.backend.zapi.httptest.update.called)
+        self.assertTrue(self.backend.zapi.httptest.create.called)
+
+    def test_remove_url_compact(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, steps_per_scenario=10)
+        item = Item("http://a.com", _id=1, item_id="70", trigger_id="80", group_id=13, compact=True)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_item_by_url.return_value = item
+        self.backend.storage.find_items_by_group.return_value = [
+            item,
+            Item("http://b.com", _id=2, item_id="70", trigger_id="80", expected_string="OK", compact=True),
+        ]
+
+        self.backend.remove_url("hc_name", "http://a.com")
+
+        self.backend.zapi.httptest.update.assert_called_with(httptestid="70", steps=[
+            {"name": "1: hc for http://b.com", "url": "http://b.com", "status_codes": "200",
+             "no": 1, "required": "OK"},
+        ])
+        self.assertFalse(self.backend.zapi.httptest.delete.called)
+        self.backend.storage.remove_item.assert_called_with(item)
+
+    def test_remove_url_compact_last_step(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, steps_per_scenario=10)
+        item = Item("http://a.com", _id=1, item_id="70", trigger_id="80", group_id=13, compact=True)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_item_by_url.return_value = item
+        self.backend.storage.find_items_by_group.return_value = [item]
+
+        self.backend.remove_url("hc_name", "http://a.com")
+
+        self.assertFalse(self.backend.zapi.httptest.update.called)
+        self.backend.zapi.httptest.delete.assert_called_with("70")
+
+    def test_list_urls(self):
+        hc = HealthCheck("hc_name", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_items_by_group.return_value = [
+            Item("http://a.com", item_id="70", trigger_id="80"),
+            Item("http://b.com", item_id="71", trigger_id="81"),
+        ]
+        self.backend.zapi.trigger.get.return_value = [
+            {"triggerid": "81", "comments": ""},
+            {"triggerid": "80", "comments": "call ops"},
+        ]
+
+        urls = self.backend.list_urls("hc_name")
+
+        self.assertEqual([["http://a.com", "call ops"], ["http://b.com", ""]], urls)
+        self.backend.zapi.trigger.get.assert_called_once_with(
+            output=["triggerid", "comments"], triggerids=["80", "81"])
+
+    def test_list_urls_compact(self):
+        hc = HealthCheck("hc_name", group_id=13, steps_per_scenario=10)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_items_by_group.return_value = [
+            Item("http://a.com", item_id="70", comment="my comment", compact=True),
+        ]
+
+        self.assertEqual([["http://a.com", "my comment"]], self.backend.list_urls("hc_name"))
+        self.assertFalse(self.backend.zapi.trigger.get.called)
+
+    def test_failed_url(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, steps_per_scenario=10)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_items_by_group.return_value = [
+            Item("http://b.com", _id=2, item_id="70", compact=True),
+            Item("http://a.com", _id=1, item_id="70", compact=True),
+        ]
+        self.backend.zapi.httptest.get.return_value = [{"httptestid": "70"}]
+
+        self.assertEqual("http://b.com", self.backend.failed_url("hc_name", "0a1b2c3d", "2"))
+        self.backend.zapi.httptest.get.assert_called_with(
+            output=["httptestid"], hostids=["1"], filter={"name": "hc scenario 0a1b2c3d for hc_name"})
+        self.assertIsNone(self.backend.failed_url("hc_name", "0a1b2c3d", "0"))
+        self.assertIsNone(self.backend.failed_url("hc_name", "0a1b2c3d", "two"))
+        self.backend.zapi.httptest.get.return_value = []
+        self.assertIsNone(self.backend.failed_url("hc_name", "0a1b2c3d", "1"))
+
+    def test_clone(self):
+        hc = HealthCheck("staging", host_id="1", group_id="g1", host_groups=["2"], proxy_id="10")
+        src = HealthCheck("prod", host_id="9", group_id="g9", host_groups=["2", "3"])
+        self.backend.storage.find_healthcheck_by_name.side_effect = [hc, src]
+        self.backend.storage.find_items_by_group.side_effect = [
+            [Item("http://a.com", item_id="5")],
+            [Item("http://a.com", item_id="70", trigger_id="80", interval=60),
+             Item("http://b.com", item_id="71", trigger_id="81", interval=300)],
+        ]
+        self.backend.storage.find_users_by_group.side_effect = [
+            [User("u1", "a@a.com", "g1")],
+            [User("u1", "a@a.com", "g1", "g9"), User("u2", "b@a.com", "g9")],
+        ]
+        self.backend.zapi.httptest.get.return_value = [
+            {"httptestid": "71", "steps": [{"required": "OK"}]},
+        ]
+        self.backend.zapi.trigger.get.return_value = [
+            {"triggerid": "81", "comments": "restart"},
+        ]
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["72"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["82"]}
+
+        self.backend.clone("staging", "prod")
+
+        self.backend.zapi.httptest.get.assert_called_with(
+            httptestids=["70", "71"], output=["httptestid"], selectSteps=["required"])
+        item_name = self.backend._create_item_name("http://b.com")
+        self.backend.zapi.httptest.create.assert_called_with({
+            "name": item_name,
+            "steps": [{"name": item_name, "url": "http://b.com", "status_codes": "200",
+                       "no": 1, "required": "OK"}],
+            "hostid": "1",
+            "retries": 3,
+            "delay": self.backend._check_delay("http://b.com", 300),
+        })
+        trigger = self.backend.zapi.trigger.create.call_args[0][0]
+        self.assertEqual("restart", trigger["comments"])
+        items = self.backend.storage.add_items.call_args[0][0]
+        self.assertEqual([("http://b.com", "72", "82", "g1", 300)],
+                         [(i.url, i.item_id, i.trigger_id, i.group_id, i.interval) for i in items])
+        self.backend.storage.increment_proxy_load.assert_called_with("10", 1)
+        self.backend.zapi.usergroup.update.assert_called_with(
+            usrgrpid="g1", userids=["u1", "u2"],
+            rights=[{"permission": 2, "id": "2"}, {"permission": 2, "id": "3"}])
+        self.backend.zapi.host.update.assert_called_with(
+            hostid="1", groups=[{"groupid": "2"}, {"groupid": "3"}])
+        self.backend.storage.add_users_to_group.assert_called_with(["u2"], "g1")
+        self.backend.storage.add_groups_to_instance.assert_called_with(hc, ["3"])
+
+    def test_clone_recorded_details(self):
+        hc = HealthCheck("staging", host_id="1", group_id="g1", host_groups=["2"])
+        src = HealthCheck("prod", host_id="9", group_id="g9", host_groups=["2"])
+        self.backend.storage.find_healthcheck_by_name.side_effect = [hc, src]
+        self.backend.storage.find_items_by_group.side_effect = [
+            [],
+            [Item("http://b.com", item_id="71", trigger_id="81", interval=60,
+                  expected_string="OK", comment="restart")],
+        ]
+        self.backend.storage.find_users_by_group.return_value = []
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["72"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["82"]}
+
+        self.backend.clone("staging", "prod")
+
+        self.assertFalse(self.backend.zapi.httptest.get.called)
+        self.assertFalse(self.backend.zapi.trigger.get.called)
+        step = self.backend.zapi.httptest.create.call_args[0][0]["steps"][0]
+        self.assertEqual("OK", step["required"])
+        items = self.backend.storage.add_items.call_args[0][0]
+        self.assertEqual([("OK", "restart")], [(i.expected_string, i.comment) for i in items])
+
+    def test_clone_discovery(self):
+        hc = HealthCheck("staging", host_id="1", group_id="g1", host_groups=["2"],
+                         provisioning="discovery")
+        src = HealthCheck("prod", host_id="9", group_id="g9", host_groups=["2"],
+                          provisioning="discovery")
+        self.backend.storage.find_healthcheck_by_name.side_effect = [hc, src]
+        self.backend.storage.find_items_by_group.side_effect = [
+            [], [Item("http://a.com", expected_string="OK", comment="c", interval=60)]]
+        self.backend.storage.find_users_by_group.return_value = []
+
+        self.backend.clone("staging", "prod")
+
+        self.assertFalse(self.backend.zapi.httptest.get.called)
+        self.assertFalse(self.backend.zapi.httptest.create.called)
+        self.assertFalse(self.backend.zapi.usergroup.update.called)
+        items = self.backend.storage.add_items.call_args[0][0]
+        self.assertEqual([("http://a.com", "g1", "OK", "c", 60)],
+                         [(i.url, i.group_id, i.expected_string, i.comment, i.interval) for i in items])
+
+    def test_clone_into_itself(self):
+        hc = HealthCheck("prod", group_id="g9")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        with self.assertRaises(InvalidCloneError):
+            self.backend.clone("prod", "prod")
+
+    def test_new_many(self):
+        self.backend.proxies = ["10", "11"]
+        self.backend.storage.find_proxy_loads.return_value = {"10": 1}
+        self.backend.storage.find_healthchecks_by_names.return_value = [HealthCheck("c")]
+        self.backend.zapi.host.get.return_value = [{"host": "d"}]
+        self.backend.zapi.host.create.return_value = {"hostids": ["1", "2"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["3", "4"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5", "6"]}
+
+        results = self.backend.new_many(["a", "b", "c", "d"])
+
+        self.assertEqual([{"name": "a", "created": True}, {"name": "b", "created": True},
+                          {"name": "c", "error": "instance already exists"},
+                          {"name": "d", "error": "instance already exists"}], results)
+        self.backend.zapi.host.get.assert_called_with(filter={"host": ["a", "b", "c", "d"]},
+                                                      output=["host"])
+        hosts = self.backend.zapi.host.create.call_args[0]
+        self.assertEqual([("a", "11"), ("b", "10")], [(h["host"], h["proxy_hostid"]) for h in hosts])
+        self.backend.zapi.usergroup.create.assert_called_with(
+            {"name": "a", "rights": {"permission": 2, "id": "2"}},
+            {"name": "b", "rights": {"permission": 2, "id": "2"}})
+        actions = self.backend.zapi.action.create.call_args[0]
+        self.assertEqual(("action for b", "2"), (actions[1]["name"], actions[1]["conditions"][2]["value"]))
+        hcs = self.backend.storage.add_healthchecks.call_args[0][0]
+        self.assertEqual([("a", "1", "3", "5", "11"), ("b", "2", "4", "6", "10")],
+                         [(h.name, h.host_id, h.group_id, h.action_id, h.proxy_id) for h in hcs])
+        self.backend.zapi.batch.assert_called_with(60.0)
+
+    def test_new_many_collects_removed_instances(self):
+        removed = HealthCheck("a", _id=1, group_id="4", host_id="5")
+        self.backend.storage.find_healthchecks_by_names.return_value = [
+            HealthCheck("a", removed=True), HealthCheck("b", removed=True)]
+        self.backend.storage.claim_removed_healthchecks.side_effect = lambda limit, lease, name: (
+            [removed] if name == "a" else [])
+        self.backend.storage.find_items_by_groups.return_value = []
+        self.backend.storage.find_scenarios.return_value = []
+        self.backend.storage.find_users_by_groups.return_value = []
+        self._existing(usergroup=["4"], host=["5"])
+        self.backend.zapi.host.get.side_effect = [[{"hostid": "5"}], [{"host": "b"}]]
+        self.backend.zapi.host.create.return_value = {"hostids": ["7"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["8"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["9"]}
+
+        results = self.backend.new_many(["a", "b"])
+
+        self.assertEqual([{"name": "a", "created": True},
+                          {"name": "b", "error": "instance b is still being removed, try again later"}],
+                         results)
+        self.backend.storage.remove_healthchecks.assert_called_with([removed])
+        hcs = self.backend.storage.add_healthchecks.call_args[0][0]
+        self.assertEqual(["a"], [h.name for h in hcs])
+        self.backend.storage.find_healthchecks_by_names.assert_called_with(["a", "b"], with_removed=True)
+
+    def test_new_many_failure(self):
+        self.backend.storage.find_healthchecks_by_names.return_value = []
+        self.backend.zapi.host.get.return_value = []
+        self.backend.zapi.host.create.side_effect = Exception("zabbix is down")
+
+        results = self.backend.new_many(["a", "b"])
+
+        self.assertEqual([{"name": "a", "error": "zabbix is down"},
+                          {"name": "b", "error": "zabbix is down"}], results)
+        self.assertFalse(self.backend.storage.add_healthchecks.called)
+
+    def test_new_many_failure_deletes_created_objects(self):
+        from healthcheck.backends.client import ZabbixAPIException
+        self.backend.storage.find_healthchecks_by_names.return_value = []
+        self.backend.zapi.host.get.return_value = []
+        self.backend.zapi.host.create.return_value = {"hostids": ["1", "2"]}
+        self.backend.zapi.usergroup.create.side_effect = ZabbixAPIException(
+            "Error -32602: Invalid params., User group \"b\" already exists.", -32602)
+
+        results = self.backend.new_many(["a", "b"])
+
+        error = 'Error -32602: Invalid params., User group "b" already exists.'
+        self.assertEqual([{"name": "a", "error": error}, {"name": "b", "error": error}], results)
+        self.backend.zapi.host.delete.assert_called_once_with("1", "2")
+        self.assertFalse(self.backend.zapi.usergroup.delete.called)
+        self.assertFalse(self.backend.zapi.action.create.called)
+
+    def test_new_many_storage_failure_deletes_created_objects(self):
+        self.backend.storage.find_healthchecks_by_names.return_value = []
+        self.backend.zapi.host.get.return_value = []
+        self.backend.zapi.host.create.return_value = {"hostids": ["1", "2"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["3", "4"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5", "6"]}
+        self.backend.storage.add_healthchecks.side_effect = Exception("mongodb is down")
+
+        results = self.backend.new_many(["a", "b"])
+
+        self.assertEqual("mongodb is down", results[0]["error"])
+        self.backend.zapi.action.delete.assert_called_once_with("5", "6")
+        self.backend.zapi.usergroup.delete.assert_called_once_with("3", "4")
+        self.backend.zapi.host.delete.assert_called_once_with("1", "2")
+
+    def test_new_many_packed(self):
+        self.backend.instances_per_host = 5
+        self.backend.storage.find_healthchecks_by_names.return_value = []
+        self.backend.zapi.host.get.return_value = []
+        self.backend.new = mock.Mock(side_effect=[None, Exception("failed")])
+
+        results = self.backend.new_many(["a", "b"])
+
+        self.assertEqual([{"name": "a", "created": True}, {"name": "b", "error": "failed"}], results)
+        self.assertFalse(self.backend.zapi.host.create.called)
+
+    def test_merge_actions(self):
+        self.backend.storage.find_healthchecks.return_value = [
+            HealthCheck("a", host_id="h1", group_id="g1"),
+            HealthCheck("b", host_id="h2", group_id="g2", action_id="a2"),
+        ]
+        self.backend.storage.find_items_by_groups.return_value = [
+            Item("http://a.com", group_id="g1", action_id="7"),
+            Item("http://b.com", group_id="g1", action_id="8"),
+            Item("http://c.com", group_id="g2"),
+        ]
+        self.backend.zapi.action.create.return_value = {"actionids": ["a1"]}
+
+        removed = self.backend.merge_actions()
+
+        self.assertEqual(2, removed)
+        self.backend.zapi.action.create.assert_called_once_with(
+            self.backend._action_params("a", "h1", "g1"))
+        self.backend.storage.set_healthchecks_actions.assert_called_once_with(
+            [(self.backend.storage.find_healthchecks.return_value[0], "a1")])
+        self.backend.storage.find_items_by_groups.assert_called_once_with(["g1", "g2"])
+        self.backend.zapi.action.delete.assert_called_once_with("7", "8")
+        self.backend.storage.unset_items_actions.assert_called_once_with(["g1"])
+        self.backend.zapi.batch.assert_called_with(60.0)
+
     def test_add_watcher(self):
         email = "andrews@corp.globo.com"
         name = "hc_name"
@@ -278,7 +845,7 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
     def test_add_action(self):
         self.backend.zapi.action.create.return_value = {"actionids": ["1"]}
 
-        self.backend._add_action("url", "8", "14")
+        self.backend._add_action("hc_name", "8", "14")
 
         self.backend.zapi.action.create.assert_called_with(
             operations=[
@@ -296,7 +863,7 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
                 }
             ],
             status=0,
-            name='action for url url',
+            name='action for hc_name',
             esc_period=3600,
             def_shortdata=("hcaas {HOST.NAME} #{EVENT.ID} {TRIGGER.STATUS}: "
                            "{ITEM.VALUE3}"),
@@ -305,21 +872,32 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
             r_shortdata="hcaas {HOST.NAME} #{EVENT.ID} {TRIGGER.STATUS}",
             r_longdata=("{TRIGGER.NAME}: {TRIGGER.STATUS}\r\n"
                         "HTTP status code: {ITEM.VALUE1}"),
-            evaltype=0,
+            evaltype=3,
+            formula="A and B and (C or D)",
             eventsource=0,
             conditions=[
                 {
                     'operator': 7,
                     'conditiontype': 16,
-                    'value': ''
+                    'value': '',
+                    'formulaid': 'A',
                 },
                 {
                     'conditiontype': 5,
-                    'value': '1'
+                    'value': '1',
+                    'formulaid': 'B',
+                },
+                {
+                    'conditiontype': 1,
+                    'operator': 0,
+                    'value': '8',
+                    'formulaid': 'C',
                 },
                 {
-                    'conditiontype': 2,
-                    'value': '8'
+                    'conditiontype': 3,
+                    'operator': 2,
+                    'value': '[hc_name]',
+                    'formulaid': 'D',
                 }
             ],
             recovery_msg=1
@@ -362,7 +940,7 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
     def test_add_group(self):
         name = "hc_name"
         group = "mygroup"
-        hmock = mock.Mock(group_id="someid", host_id="somehostid", host_groups=[])
+        hmock = HealthCheck("hc_name", group_id="someid", host_id="somehostid", host_groups=[])
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
         self.backend.zapi.hostgroup.get.return_value = [{"groupid": 1}]
 
@@ -370,6 +948,8 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
 
         self.backend.storage.find_healthcheck_by_name.assert_called_with(name)
         self.backend.zapi.hostgroup.get.assert_called_with(
+            output=["groupid"],
+            limit=1,
             filter={"name": [group]},
         )
         self.backend.zapi.usergroup.update.assert_called_with(
@@ -383,7 +963,7 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         self.assertTrue(self.backend.storage.add_group_to_instance.called)
 
     def test_remove_group(self):
-        hmock = mock.Mock(group_id="someid", host_id="somehostid", host_groups=[1, 2])
+        hmock = HealthCheck("healthcheck", group_id="someid", host_id="somehostid", host_groups=[1, 2])
         group = "mygroup"
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
         self.backend.zapi.hostgroup.get.return_value = [{"groupid": 2}]
@@ -406,6 +986,7 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
 
         groups = self.backend.list_groups("healthcheck")
         self.backend.zapi.hostgroup.get.assert_called_with(
+                output=["name"],
                 groupids=[1, 2]
         )
         self.assertEqual(groups, ["mygroup1", "mygroup2"])
@@ -414,16 +995,78 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         self.backend.zapi.hostgroup.get.return_value = [{"name": "mygroup1"}, {"name": "mygroup2"}]
 
         groups = self.backend.list_service_groups()
-        self.backend.zapi.hostgroup.get.assert_called_with()
+        self.backend.zapi.hostgroup.get.assert_called_with(output=["name"])
         self.assertEqual(groups, ["mygroup1", "mygroup2"])
 
     def test_list_service_groups_keyword(self):
         self.backend.zapi.hostgroup.get.return_value = [{"name": "mygroup1"}, {"name": "mygroup2"}]
 
         groups = self.backend.list_service_groups("my")
-        self.backend.zapi.hostgroup.get.assert_called_with(search={'name': ['my']}, startSearch=True)
+        self.backend.zapi.hostgroup.get.assert_called_with(output=["name"], search={'name': ['my']}, startSearch=True)
         self.assertEqual(groups, ["mygroup1", "mygroup2"])
 
+    def test_list_groups_saves_snapshot(self):
+        self.backend.storage.find_healthcheck_by_name.return_value = HealthCheck("hc", host_groups=["1"])
+        self.backend.zapi.hostgroup.get.return_value = [{"name": "mygroup1"}]
+
+        self.backend.list_groups("hc")
+        self.backend.list_groups("hc")
+
+        self.backend.storage.save_snapshot.assert_called_once_with(
+            "list_groups:hc", ["mygroup1"], mock.ANY)
+        self.assertIsNone(self.backend.snapshot_updated_at)
+
+    def test_list_service_groups_search_skips_snapshot(self):
+        self.backend.zapi.hostgroup.get.return_value = [{"name": "mygroup1"}]
+
+        self.backend.list_service_groups("my")
+
+        self.assertFalse(self.backend.storage.save_snapshot.called)
+        self.assertEqual({}, dict(backends._snapshots))
+
+    def test_snapshots_keep_most_recent_keys(self):
+        self.backend.zapi.hostgroup.get.return_value = [{"name": "mygroup1"}]
+        self.backend.storage.find_healthcheck_by_name.side_effect = lambda name: HealthCheck(name, host_groups=["1"])
+
+        with mock.patch("healthcheck.backends.SNAPSHOT_ENTRIES", 2):
+            self.backend.list_groups("a")
+            self.backend.list_groups("b")
+            self.backend.list_groups("a")
+            self.backend.list_groups("c")
+
+        self.assertEqual(["list_groups:a", "list_groups:c"], list(backends._snapshots))
+
+    def test_list_groups_serves_snapshot_when_breaker_is_open(self):
+        self.backend.storage.find_healthcheck_by_name.return_value = HealthCheck("hc", host_groups=["1"])
+        self.backend.zapi.hostgroup.get.side_effect = CircuitOpenError("zabbix is unavailable", 10)
+        updated_at = datetime.datetime(2018, 1, 1)
+        self.backend.storage.find_snapshot.return_value = {"value": ["mygroup1"],
+                                                           "updated_at": updated_at}
+
+        self.assertEqual(["mygroup1"], self.backend.list_groups("hc"))
+
+        self.backend.storage.find_snapshot.assert_called_with("list_groups:hc")
+        self.assertEqual(updated_at, self.backend.snapshot_updated_at)
+
+    def test_list_service_groups_without_snapshot_when_breaker_is_open(self):
+        self.backend.zapi.hostgroup.get.side_effect = CircuitOpenError("zabbix is unavailable", 10)
+        self.backend.storage.find_snapshot.return_value = None
+
+        with self.assertRaises(CircuitOpenError):
+            self.backend.list_service_groups()
+
+    def test_list_urls_serves_local_snapshot_when_breaker_is_open(self):
+        self.backend.storage.find_healthcheck_by_name.return_value = HealthCheck("hc", group_id=13)
+        self.backend.storage.find_items_by_group.return_value = [Item("http://a.com", trigger_id="80")]
+        self.backend.zapi.trigger.get.return_value = [{"triggerid": "80", "comments": "call ops"}]
+        self.backend.list_urls("hc")
+        self.backend.zapi.trigger.get.side_effect = CircuitOpenError("zabbix is unavailable", 10)
+
+        self.assertEqual([["http://a.com", "call ops"]], self.backend.list_urls("hc"))
+
+        self.assertFalse(self.backend.storage.find_snapshot.called)
+        self.assertIsNotNone(self.backend.snapshot_updated_at)
+
     def test_new(self):
         name = "blah"
 
@@ -431,18 +1074,449 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         self.backend._create_user_group = mock.Mock()
 
         old_add_host = self.backend._add_host
-        self.backend._add_host = mock.Mock()
+        self.backend._add_host = mock.Mock(return_value="3")
+        self.backend._create_user_group.return_value = "4"
+        self.backend.zapi.action.create.return_value = {"actionids": ["5"]}
 
         self.backend.new(name)
 
+        _, kwargs = self.backend.zapi.action.create.call_args
+        self.assertEqual("action for blah", kwargs["name"])
+        self.assertIn({"conditiontype": 1, "operator": 0, "value": "3", "formulaid": "C"}, kwargs["conditions"])
+        self.assertEqual([{"usrgrpid": "4"}], kwargs["operations"][0]["opmessage_grp"])
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual("5", hc.action_id)
+
         self.backend._create_user_group.assert_called_with(name, "2")
         self.backend._create_user_group = old_create_user_group
 
-        self.backend._add_host.assert_called_with(name, "2")
+        self.backend._add_host.assert_called_with(name, "2", None, None)
         self.backend._add_host = old_add_host
 
         self.assertTrue(self.backend.storage.add_healthcheck.called)
 
+    @mock.patch("threading.Thread")
+    def test_new_from_pool(self, thread):
+        self.backend.pool_size = 5
+        self.backend.storage.claim_pool_entry.return_value = {
+            "_id": "e1", "host_id": "3", "group_id": "4", "action_id": "5", "proxy_id": "10"}
+
+        self.backend.new("blah")
+
+        self.backend.storage.claim_pool_entry.assert_called_with("blah")
+        self.backend.zapi.host.update.assert_called_with(hostid="3", host="blah")
+        self.assertFalse(self.backend.zapi.usergroup.update.called)
+        self.assertFalse(self.backend.zapi.action.update.called)
+        self.assertFalse(self.backend.zapi.host.create.called)
+        self.assertFalse(self.backend.zapi.usergroup.create.called)
+        self.assertFalse(self.backend.zapi.action.create.called)
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual(("3", "4", "10", "5"), (hc.host_id, hc.group_id, hc.proxy_id, hc.action_id))
+        self.backend.storage.remove_pool_entry.assert_called_with(
+            self.backend.storage.claim_pool_entry.return_value)
+        self.assertTrue(thread.return_value.start.called)
+
+    @mock.patch("threading.Thread")
+    def test_new_from_pool_with_shared_host(self, thread):
+        self.backend.pool_size = 5
+        self.backend.shared_host = "hcaas-shared"
+        self.backend.storage.claim_pool_entry.return_value = {
+            "_id": "e1", "host_id": "3", "group_id": "4", "action_id": "5"}
+
+        self.backend.new("blah")
+
+        params = self.backend._action_params("blah", "3", "4")
+        self.backend.zapi.action.update.assert_called_with(
+            actionid="5", name="action for blah", evaltype=3, formula=params["formula"],
+            conditions=params["conditions"])
+        self.assertFalse(self.backend.zapi.action.create.called)
+
+    @mock.patch("threading.Thread")
+    def test_new_from_pool_entry_without_action(self, thread):
+        self.backend.pool_size = 5
+        self.backend.storage.claim_pool_entry.return_value = {
+            "_id": "e1", "host_id": "3", "group_id": "4"}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5"]}
+
+        self.backend.new("blah")
+
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual("5", hc.action_id)
+        self.assertFalse(self.backend.zapi.usergroup.create.called)
+
+    @mock.patch("threading.Thread")
+    def test_refill_pool_skipped_while_filling(self, thread):
+        with backends._pool_fill:
+            self.backend._refill_pool()
+
+        self.assertFalse(thread.called)
+
+    @mock.patch("threading.Thread")
+    def test_new_with_empty_pool(self, thread):
+        self.backend.pool_size = 5
+        self.backend.storage.claim_pool_entry.return_value = None
+        self.backend.zapi.host.create.return_value = {"hostids": ["3"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["4"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5"]}
+
+        self.backend.new("blah")
+
+        self.assertTrue(self.backend.zapi.host.create.called)
+        self.assertFalse(self.backend.zapi.host.update.called)
+        self.assertFalse(self.backend.storage.remove_pool_entry.called)
+        self.assertTrue(thread.return_value.start.called)
+
+    def test_fill_pool(self):
+        self.backend.pool_size = 3
+        self.backend.storage.count_pool_entries.return_value = 1
+        self.backend.storage.add_pool_entries.return_value = [{"_id": "e1"}, {"_id": "e2"}]
+        self.backend.zapi.host.create.return_value = {"hostids": ["3", "4"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["5", "6"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["7", "8"]}
+
+        self.assertEqual(2, self.backend.fill_pool())
+
+        names, proxies = self.backend.storage.add_pool_entries.call_args[0]
+        self.assertEqual(2, len(names))
+        self.assertTrue(names[0].startswith("hcaas-pool-"))
+        self.assertEqual([None, None], proxies)
+        hosts = self.backend.zapi.host.create.call_args[0]
+        self.assertEqual(names, [h["host"] for h in hosts])
+        self.backend.zapi.usergroup.create.assert_called_with(
+            {"name": names[0], "rights": {"permission": 2, "id": "2"}},
+            {"name": names[1], "rights": {"permission": 2, "id": "2"}})
+        actions = self.backend.zapi.action.create.call_args[0]
+        self.assertEqual([self.backend._action_params(names[0], "3", "5"),
+                          self.backend._action_params(names[1], "4", "6")], list(actions))
+        self.backend.storage.set_pool_entries_ready.assert_called_with(
+            [({"_id": "e1"}, "3", "5", "7"), ({"_id": "e2"}, "4", "6", "8")])
+        self.backend.storage.acquire_lock.assert_called_with("pool_fill", 600)
+        self.backend.storage.release_lock.assert_called_with("pool_fill")
+
+    def test_fill_pool_full(self):
+        self.backend.pool_size = 3
+        self.backend.storage.count_pool_entries.return_value = 3
+        self.assertEqual(0, self.backend.fill_pool())
+        self.assertFalse(self.backend.zapi.host.create.called)
+        self.backend.storage.release_lock.assert_called_with("pool_fill")
+
+    def test_fill_pool_running_elsewhere(self):
+        self.backend.pool_size = 3
+        self.backend.storage.acquire_lock.return_value = False
+
+        self.assertEqual(0, self.backend.fill_pool())
+
+        self.assertFalse(self.backend.storage.count_pool_entries.called)
+        self.assertFalse(self.backend.storage.release_lock.called)
+
+    def test_fill_pool_running_in_process(self):
+        self.backend.pool_size = 3
+
+        with backends._pool_fill:
+            self.assertEqual(0, self.backend.fill_pool())
+
+        self.assertFalse(self.backend.storage.acquire_lock.called)
+
+    def test_reclaim_pool(self):
+        entries = [
+            {"_id": "e1", "name": "hcaas-pool-1", "state": "creating"},
+            {"_id": "e2", "name": "hcaas-pool-2", "state": "claimed", "instance": "a",
+             "host_id": "3", "group_id": "4", "action_id": "7"},
+            {"_id": "e3", "name": "hcaas-pool-3", "state": "claimed", "instance": "b",
+             "host_id": "5", "group_id": "6", "action_id": "8"},
+        ]
+        self.backend.storage.find_stale_pool_entries.return_value = entries
+        self.backend.storage.find_healthchecks_by_names.return_value = [HealthCheck("b", host_id="5")]
+        self.backend.zapi.host.get.return_value = [{"hostid": "1"}]
+        self.backend.zapi.usergroup.get.return_value = [{"usrgrpid": "2"}]
+        self.backend.zapi.action.get.return_value = [{"actionid": "9"}]
+
+        self.assertEqual(3, self.backend.reclaim_pool())
+
+        self.backend.storage.find_stale_pool_entries.assert_called_with(600)
+        self.backend.storage.find_healthchecks_by_names.assert_called_once_with(["a", "b"])
+        self.backend.zapi.host.get.assert_called_with(filter={"host": ["hcaas-pool-1"]}, output=["hostid"])
+        self.backend.zapi.host.delete.assert_called_with("3", "1")
+        self.backend.zapi.usergroup.delete.assert_called_with("4", "2")
+        self.backend.zapi.action.get.assert_called_with(filter={"name": ["action for hcaas-pool-1"]},
+                                                        output=["actionid"])
+        self.backend.zapi.action.delete.assert_called_with("7", "9")
+        self.backend.storage.remove_pool_entries.assert_called_with(entries)
+
+    def test_new_with_proxies(self):
+        self.backend.proxies = ["10", "11", "12"]
+        self.backend.storage.find_proxy_loads.return_value = {"10": 5, "11": 2}
+        self.backend.zapi.host.create.return_value = {"hostids": ["3"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["4"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5"]}
+
+        self.backend.new("blah")
+
+        self.backend.storage.find_proxy_loads.assert_called_with(["10", "11", "12"])
+        _, kwargs = self.backend.zapi.host.create.call_args
+        self.assertEqual("12", kwargs["proxy_hostid"])
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual("12", hc.proxy_id)
+
+    def test_new_discovery(self):
+        self.backend.provisioning = "discovery"
+        self.backend.discovery_template_id = "20"
+        self.backend.zapi.host.create.return_value = {"hostids": ["3"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["4"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5"]}
+
+        self.backend.new("blah")
+
+        _, kwargs = self.backend.zapi.host.create.call_args
+        self.assertEqual([{"templateid": "20"}], kwargs["templates"])
+        self.assertEqual([{"macro": "{$HCAAS_INSTANCE}", "value": "blah"}], kwargs["macros"])
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual("discovery", hc.provisioning)
+
+    def test_add_url_discovery(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, provisioning="discovery")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+
+        self.backend.add_url("hc_name", "http://mysite.com", "WORKING", "call ops")
+
+        self.assertFalse(self.backend.zapi.httptest.create.called)
+        self.assertFalse(self.backend.zapi.trigger.create.called)
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual("http://mysite.com", item.url)
+        self.assertEqual(13, item.group_id)
+        self.assertEqual("WORKING", item.expected_string)
+        self.assertEqual("call ops", item.comment)
+        self.assertEqual(60, item.interval)
+
+    def test_remove_url_discovery(self):
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, provisioning="discovery")
+        item = Item("http://mysite.com", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_item_by_url.return_value = item
+
+        self.backend.remove_url("hc_name", "http://mysite.com")
+
+        self.assertFalse(self.backend.zapi.httptest.delete.called)
+        self.backend.storage.remove_item.assert_called_with(item)
+
+    def test_list_urls_discovery(self):
+        hc = HealthCheck("hc_name", group_id=13, provisioning="discovery")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_items_by_group.return_value = [
+            Item("http://a.com", comment="call ops"),
+            Item("http://b.com", comment=None),
+        ]
+
+        urls = self.backend.list_urls("hc_name")
+
+        self.assertEqual([["http://a.com", "call ops"], ["http://b.com", ""]], urls)
+        self.assertFalse(self.backend.zapi.trigger.get.called)
+
+    def test_discovery(self):
+        hc = HealthCheck("hc_name", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_items_by_group.return_value = [
+            Item("http://a.com", expected_string="WORKING", comment="call ops", interval=300),
+            Item("http://b.com"),
+        ]
+
+        data = self.backend.discovery("hc_name")
+
+        self.backend.storage.find_items_by_group.assert_called_with(13)
+        self.assertEqual([
+            {
+                "{#URL}": "http://a.com",
+                "{#NAME}": "hc for http://a.com",
+                "{#EXPECTED_STRING}": "WORKING",
+                "{#COMMENT}": "call ops",
+                "{#INTERVAL}": self.backend._check_delay("http://a.com", 300),
+            },
+            {
+                "{#URL}": "http://b.com",
+                "{#NAME}": "hc for http://b.com",
+                "{#EXPECTED_STRING}": "",
+                "{#COMMENT}": "",
+                "{#INTERVAL}": self.backend._check_delay("http://b.com", 60),
+            },
+        ], data)
+
+    def test_new_packed(self):
+        self.backend.instances_per_host = 50
+        self.backend.storage.claim_packed_host.return_value = {
+            "host_id": "30", "name": "hcaas-pack-1", "proxy_id": "10", "instances": 7}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["4"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5"]}
+
+        self.backend.new("blah")
+
+        self.backend.storage.claim_packed_host.assert_called_with(50)
+        self.assertFalse(self.backend.zapi.host.create.called)
+        _, kwargs = self.backend.zapi.action.create.call_args
+        self.assertEqual("A and B and C", kwargs["formula"])
+        self.assertEqual({"conditiontype": 3, "operator": 2, "value": "[blah]", "formulaid": "C"},
+                         kwargs["conditions"][-1])
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual(("30", "hcaas-pack-1", True, "10"),
+                         (hc.host_id, hc.host_name, hc.packed, hc.proxy_id))
+
+    def test_new_packed_creates_host_when_all_full(self):
+        self.backend.instances_per_host = 50
+        self.backend.storage.claim_packed_host.return_value = None
+        self.backend.storage.add_packed_host.side_effect = lambda h, n, p: {
+            "host_id": h, "name": n, "proxy_id": p, "instances": 1}
+        self.backend.zapi.host.create.return_value = {"hostids": ["31"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["4"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5"]}
+
+        self.backend.new("blah")
+
+        _, kwargs = self.backend.zapi.host.create.call_args
+        self.assertTrue(kwargs["host"].startswith("hcaas-pack-"))
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual("31", hc.host_id)
+        self.assertEqual(kwargs["host"], hc.host_name)
+
+    def test_add_url_packed(self):
+        url = "http://mysite.com"
+        hc = HealthCheck("blah", host_id="30", host_name="hcaas-pack-1", group_id=13, packed=True)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["70"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["80"]}
+
+        self.backend.add_url("blah", url)
+
+        _, kwargs = self.backend.zapi.httptest.create.call_args
+        self.assertEqual("blah: hc for http://mysite.com", kwargs["name"])
+        self.assertEqual("30", kwargs["hostid"])
+        _, kwargs = self.backend.zapi.trigger.create.call_args
+        self.assertEqual("trigger for url http://mysite.com [blah]", kwargs["description"])
+        self.assertIn("{hcaas-pack-1:web.test.fail[blah: hc for http://mysite.com].last()}",
+                      kwargs["expression"])
+
+    def test_add_url_packed_long_urls_sharing_a_prefix(self):
+        hc = HealthCheck("myapp-production", host_id="30", host_name="hcaas-pack-1",
+                         group_id=13, packed=True)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["70"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["80"]}
+
+        self.backend.add_url("myapp-production", "https://myapp.example.com/healthcheck/database")
+        self.backend.add_url("myapp-production", "https://myapp.example.com/healthcheck/cache")
+
+        names = [kwargs["name"] for _, kwargs in self.backend.zapi.httptest.create.call_args_list]
+        self.assertNotEqual(names[0], names[1])
+        for name in names:
+            self.assertEqual(64, len(name))
+            self.assertTrue(name.startswith("myapp-production: hc for https://myapp.example.com/"))
+        expressions = [kwargs["expression"] for _, kwargs in self.backend.zapi.trigger.create.call_args_list]
+        for name, expression in zip(names, expressions):
+            self.assertIn("web.test.fail[{}]".format(name), expression)
+
+    def test_add_group_packed(self):
+        hc = HealthCheck("blah", group_id="someid", host_id="30", host_groups=[], packed=True)
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.zapi.hostgroup.get.return_value = [{"groupid": 1}]
+
+        self.backend.add_group("blah", "mygroup")
+
+        self.assertTrue(self.backend.zapi.usergroup.update.called)
+        self.assertFalse(self.backend.zapi.host.update.called)
+        self.backend.storage.add_group_to_instance.assert_called_with(hc, 1)
+
+    def test_rebalance_proxies_moves_packed_hosts_together(self):
+        self.backend.proxies = ["10", "11"]
+        self.backend.storage.find_healthchecks.return_value = [
+            HealthCheck("a", host_id="p1", group_id="g1", proxy_id="10", packed=True),
+            HealthCheck("b", host_id="p1", group_id="g2", proxy_id="10", packed=True),
+            HealthCheck("c", host_id="h3", group_id="g3", proxy_id="10"),
+            HealthCheck("d", host_id="h4", group_id="g4", proxy_id="11"),
+        ]
+        self.backend.storage.count_items_by_group.return_value = {"g1": 2, "g2": 2, "g3": 5, "g4": 1}
+
+        moves = self.backend.rebalance_proxies()
+
+        self.assertItemsEqual([("a", "10", "11"), ("b", "10", "11")], moves)
+        self.backend.zapi.host.massupdate.assert_called_once_with(
+            hosts=[{"hostid": "p1"}], proxy_hostid="11")
+        self.backend.storage.set_packed_host_proxy.assert_called_once_with("p1", "11")
+
+    def test_choose_proxy_without_proxies(self):
+        self.backend.proxies = []
+        self.assertIsNone(self.backend._choose_proxy())
+        self.assertFalse(self.backend.storage.find_proxy_loads.called)
+
+    def test_add_host_with_proxy(self):
+        self.backend.zapi.host.create.return_value = {"hostids": [2]}
+
+        self.backend._add_host("host name", "123", "10")
+
+        _, kwargs = self.backend.zapi.host.create.call_args
+        self.assertEqual("10", kwargs["proxy_hostid"])
+
+    def test_add_url_increments_proxy_load(self):
+        self.backend.zapi.httptest.create.return_value = {"httptestids": [1]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": [1]}
+        self.backend.zapi.action.create.return_value = {"actionids": [1]}
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, proxy_id="10")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+
+        self.backend.add_url("hc_name", "http://mysite.com")
+
+        self.backend.storage.increment_proxy_load.assert_called_with("10")
+
+    def test_remove_url_decrements_proxy_load(self):
+        item = Item("http://mysite.com", item_id=1, trigger_id=1, action_id=8)
+        hc = HealthCheck("hc_name", host_id="1", group_id=13, proxy_id="10")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.storage.find_item_by_url.return_value = item
+
+        self.backend.remove_url("hc_name", "http://mysite.com")
+
+        self.backend.storage.increment_proxy_load.assert_called_with("10", -1)
+
+    def test_rebalance_proxies(self):
+        self.backend.proxies = ["10", "11"]
+        self.backend.storage.find_healthchecks.return_value = [
+            HealthCheck("a", host_id="h1", group_id="g1", proxy_id="10"),
+            HealthCheck("b", host_id="h2", group_id="g2", proxy_id="10"),
+            HealthCheck("c", host_id="h3", group_id="g3", proxy_id="99"),
+            HealthCheck("d", host_id="h4", group_id="g4"),
+        ]
+        self.backend.storage.count_items_by_group.return_value = {
+            "g1": 6, "g2": 4, "g3": 1, "g4": 2,
+        }
+
+        moves = self.backend.rebalance_proxies()
+
+        self.assertItemsEqual(
+            [("b", "10", "11"), ("c", "99", "11"), ("d", None, "11")],
+            moves,
+        )
+        self.backend.zapi.host.massupdate.assert_called_once_with(
+            hosts=[{"hostid": "h2"}, {"hostid": "h3"}, {"hostid": "h4"}],
+            proxy_hostid="11",
+        )
+        self.backend.storage.set_proxy_load.assert_any_call("10", 6)
+        self.backend.storage.set_proxy_load.assert_any_call("11", 7)
+
+    def test_rebalance_proxies_balanced(self):
+        self.backend.proxies = ["10", "11"]
+        self.backend.storage.find_healthchecks.return_value = [
+            HealthCheck("a", host_id="h1", group_id="g1", proxy_id="10"),
+            HealthCheck("b", host_id="h2", group_id="g2", proxy_id="11"),
+        ]
+        self.backend.storage.count_items_by_group.return_value = {"g1": 3, "g2": 2}
+
+        moves = self.backend.rebalance_proxies()
+
+        self.assertEqual([], moves)
+        self.assertFalse(self.backend.zapi.host.massupdate.called)
+
+    def test_rebalance_proxies_without_proxies(self):
+        self.backend.proxies = []
+        self.assertEqual([], self.backend.rebalance_proxies())
+        self.assertFalse(self.backend.storage.find_healthchecks.called)
+
     def test_remove_user_group(self):
         self.backend._remove_user_group("id")
         self.backend.zapi.usergroup.delete.assert_called_with("id")
@@ -484,113 +1558,122 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         with self.assertRaises(WatcherNotInInstanceError):
             self.backend.remove_watcher("healthcheck", user.email)
 
-    def test_remove(self):
-        name = "blah"
-        id = "someid"
-        url = 'http://test.com/healthcheck'
-
-        old_remove_url = self.backend.remove_url
-        self.backend.remove_url = mock.Mock()
-        old_remove_watcher = self.backend.remove_watcher
-        self.backend.remove_watcher = mock.Mock()
-        self.backend.storage.find_urls_by_healthcheck_name.return_value = [url]
-
-        hmock = mock.Mock(group_id=id, host_id=id)
-        self.backend.storage.find_healthcheck_by_name.return_value = hmock
-        watchers = ['test@example.com']
-        self.backend.storage.find_watchers_by_healthcheck_name.return_value = watchers
-        user = User("123", "email@email.com", id)
-        self.backend.storage.find_user_by_email.return_value = user
-
-        self.backend.remove(name)
-
-        self.backend.storage.find_urls_by_healthcheck_name.assert_called_with(name)
-        self.backend.zapi.usergroup.delete.assert_called_with(id)
-        self.backend.zapi.host.delete.assert_called_with(id)
-        self.backend.storage.remove_healthcheck.assert_called_with(hmock)
-        assert self.backend.remove_url.called
-        assert self.backend.remove_watcher.called
-
-        self.backend.remove_url = old_remove_url
-        self.backend.remove_watcher = old_remove_watcher
-
-    def test_remove_with_urls(self):
-        name = "blah"
-        url = "http://mysite.com"
-        item_id = 1
-        trigger_id = 2
-        action_id = 3
-        group_id = "4"
-        host_id = "5"
-        user_id = "6"
-        item = Item(
-            url,
-            item_id=item_id,
-            trigger_id=trigger_id,
-            action_id=action_id
-        )
-
-        self.backend.storage.find_item_by_url.return_value = item
-        self.backend.storage.find_urls_by_healthcheck_name.return_value = [url]
-        hc = HealthCheck(name, group_id=group_id, host_id=host_id)
+    @mock.patch("threading.Thread")
+    def test_remove(self, thread):
+        hc = HealthCheck("blah", group_id="4", host_id="5")
         self.backend.storage.find_healthcheck_by_name.return_value = hc
-        watchers = ['test@example.com']
-        self.backend.storage.find_watchers_by_healthcheck_name.return_value = watchers
-        user = User(user_id, "email@email.com", group_id)
-        self.backend.storage.find_user_by_email.return_value = user
-        self.backend.zapi.trigger.get.return_value = [{"comments": "xxx"}]
-
-        self.backend.remove(name)
-
-        self.backend.zapi.usergroup.delete.assert_called_with(group_id)
-        self.backend.zapi.host.delete.assert_called_with(host_id)
-        self.backend.zapi.action.delete.assert_called_with(action_id)
-        self.backend.zapi.httptest.delete.assert_called_with(item_id)
-        self.backend.zapi.user.delete.assert_called_with(user_id)
-        self.backend.storage.remove_healthcheck.assert_called_with(hc)
-        self.backend.storage.remove_item.assert_called_with(item)
-        self.backend.storage.find_healthcheck_by_name.assert_called_with(name)
-        self.backend.storage.find_urls_by_healthcheck_name.assert_called_with(name)
-        self.backend.storage.find_item_by_url.assert_called_with(url)
 
-    def test_remove_with_urls_more_than_one_group(self):
-        name = "blah"
-        url = "http://mysite.com"
-        item_id = 1
-        trigger_id = 2
-        action_id = 3
-        group_id = "4"
-        another_group_id = "4-2"
-        host_id = "5"
-        user_id = "6"
-        item = Item(
-            url,
-            item_id=item_id,
-            trigger_id=trigger_id,
-            action_id=action_id
-        )
+        self.backend.remove("blah")
+
+        self.backend.storage.tombstone_healthcheck.assert_called_with(hc)
+        self.assertTrue(thread.return_value.start.called)
+        self.assertFalse(self.backend.zapi.host.delete.called)
+
+    def _existing(self, **ids):
+        for obj, id_field in [("action", "actionid"), ("trigger", "triggerid"),
+                              ("httptest", "httptestid"), ("user", "userid"),
+                              ("usergroup", "usrgrpid"), ("host", "hostid")]:
+            getattr(self.backend.zapi, obj).get.return_value = [
+                {id_field: i} for i in ids.get(obj, [])]
+
+    def test_collect_removed(self):
+        healthchecks = [
+            HealthCheck("a", _id=1, group_id="4", host_id="5", action_id="9", proxy_id="10"),
+            HealthCheck("b", _id=2, group_id="6", host_id="30", action_id="8", packed=True),
+        ]
+        self.backend.storage.claim_removed_healthchecks.return_value = healthchecks
+        self.backend.storage.find_items_by_groups.return_value = [
+            Item("http://a.com", group_id="4", item_id="70", trigger_id="80", action_id="7"),
+            Item("http://b.com", group_id="6", item_id="71", trigger_id="81"),
+            Item("http://c.com", group_id="6", item_id="72", trigger_id="82", shared=True),
+        ]
+        self.backend.storage.find_scenarios.return_value = [
+            {"url": "http://c.com", "expected_string": None, "item_id": "72", "refs": 1},
+        ]
+        solo = User("u1", "a@a.com", "4", "6")
+        self.backend.storage.find_users_by_groups.return_value = [
+            solo, User("u2", "b@a.com", "4", "12")]
+        self._existing(action=["9", "8"], trigger=["82"], httptest=["71", "72"],
+                       user=["u1"], usergroup=["4", "6"], host=["5"])
+
+        self.assertEqual(2, self.backend.collect_removed())
+
+        self.backend.storage.claim_removed_healthchecks.assert_called_with(100, 300)
+        self.backend.storage.find_items_by_groups.assert_called_with(["4", "6"])
+        self.backend.zapi.action.get.assert_called_with(actionids=["9", "8", "7"], output=["actionid"])
+        self.backend.zapi.action.delete.assert_called_with("9", "8")
+        self.backend.zapi.trigger.delete.assert_called_with("82")
+        self.backend.zapi.httptest.delete.assert_called_with("71", "72")
+        self.backend.zapi.user.delete.assert_called_with("u1")
+        self.backend.zapi.usergroup.delete.assert_called_with("4", "6")
+        self.backend.zapi.host.get.assert_called_with(hostids=["5"], output=["hostid"])
+        self.backend.zapi.host.delete.assert_called_with("5")
+        self.backend.storage.release_scenarios.assert_called_with({("http://c.com", None, 60): 1})
+        self.backend.storage.remove_users.assert_called_with([solo])
+        self.backend.storage.remove_groups_from_users.assert_called_with(["4", "6"])
+        self.backend.storage.release_packed_host.assert_called_with("30")
+        self.backend.storage.increment_proxy_load.assert_called_with("10", -1)
+        self.backend.storage.remove_items_by_groups.assert_called_with(["4", "6"])
+        self.backend.storage.remove_healthchecks.assert_called_with(healthchecks)
+
+    def test_collect_removed_nothing_to_collect(self):
+        self.backend.storage.claim_removed_healthchecks.return_value = []
+        self.assertEqual(0, self.backend.collect_removed())
+        self.assertFalse(self.backend.storage.find_items_by_groups.called)
+
+    def test_collect_removed_failure_defers(self):
+        hc = HealthCheck("a", _id=1, group_id="4", host_id="5", attempts=2)
+        self.backend.storage.claim_removed_healthchecks.return_value = [hc]
+        self.backend.storage.find_items_by_groups.return_value = []
+        self.backend.storage.find_scenarios.return_value = []
+        self.backend.storage.find_users_by_groups.return_value = []
+        self._existing(usergroup=["4"], host=["5"])
+        self.backend.zapi.host.delete.side_effect = Exception("zabbix is down")
+
+        with self.assertRaises(Exception):
+            self.backend.collect_removed()
+
+        self.backend.storage.defer_removal.assert_called_with(hc, 120)
+        self.assertFalse(self.backend.storage.remove_healthchecks.called)
+
+    def test_collect_removed_skips_deleted_objects(self):
+        hc = HealthCheck("a", _id=1, group_id="4", host_id="5")
+        self.backend.storage.claim_removed_healthchecks.return_value = [hc]
+        self.backend.storage.find_items_by_groups.return_value = []
+        self.backend.storage.find_scenarios.return_value = []
+        self.backend.storage.find_users_by_groups.return_value = []
+        self._existing(host=["5"])
+
+        self.backend.collect_removed()
+
+        self.assertFalse(self.backend.zapi.usergroup.delete.called)
+        self.backend.zapi.host.delete.assert_called_with("5")
+        self.backend.storage.remove_healthchecks.assert_called_with([hc])
+
+    def test_new_collects_removed_instance_with_same_name(self):
+        removed = HealthCheck("blah", _id=1, group_id="4", host_id="5")
+        self.backend.storage.find_removed_healthcheck.return_value = {"name": "blah"}
+        self.backend.storage.claim_removed_healthchecks.return_value = [removed]
+        self.backend.storage.find_items_by_groups.return_value = []
+        self.backend.storage.find_scenarios.return_value = []
+        self.backend.storage.find_users_by_groups.return_value = []
+        self._existing(usergroup=["4"], host=["5"])
+        self.backend.zapi.host.create.return_value = {"hostids": ["7"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["8"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["9"]}
+
+        self.backend.new("blah")
+
+        self.backend.storage.claim_removed_healthchecks.assert_called_with(1, 300, "blah")
+        self.backend.zapi.host.delete.assert_called_with("5")
+        self.backend.storage.remove_healthchecks.assert_called_with([removed])
+        self.assertTrue(self.backend.storage.add_healthcheck.called)
 
-        self.backend.storage.find_item_by_url.return_value = item
-        self.backend.storage.find_urls_by_healthcheck_name.return_value = [url]
-        hc = HealthCheck(name, group_id=group_id, host_id=host_id)
-        self.backend.storage.find_healthcheck_by_name.return_value = hc
-        watchers = ['test@example.com']
-        self.backend.storage.find_watchers_by_healthcheck_name.return_value = watchers
-        user = User(user_id, "email@email.com", group_id, another_group_id)
-        self.backend.storage.find_user_by_email.return_value = user
-        self.backend.storage.find_users_by_group.return_value = [user]
-        self.backend.zapi.trigger.get.return_value = [{"comments": "xxx"}]
+    def test_new_removed_instance_still_collecting(self):
+        self.backend.storage.find_removed_healthcheck.return_value = {"name": "blah"}
+        self.backend.storage.claim_removed_healthchecks.return_value = []
 
-        self.backend.remove(name)
+        with self.assertRaises(RemovalPendingError):
+            self.backend.new("blah")
 
-        self.backend.zapi.usergroup.delete.assert_called_with(group_id)
-        self.backend.zapi.host.delete.assert_called_with(host_id)
-        self.backend.zapi.action.delete.assert_called_with(action_id)
-        self.backend.zapi.httptest.delete.assert_called_with(item_id)
-        self.backend.zapi.usergroup.update.assert_called_with(usrgrpid=group_id, userids=[])
-        self.backend.storage.remove_healthcheck.assert_called_with(hc)
-        self.backend.storage.remove_item.assert_called_with(item)
-        self.backend.storage.find_healthcheck_by_name.assert_called_with(name)
-        self.backend.storage.find_urls_by_healthcheck_name.assert_called_with(name)
-        self.backend.storage.find_item_by_url.assert_called_with(url)
-        self.backend.storage.find_users_by_group.assert_called_with(group_id)
+        self.assertFalse(self.backend.zapi.host.create.called)
@@ -0,0 +1,57 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+An in-memory mongodb, on mongomock, counting the commands sent to each
+collection, to stand in for the connection of MongoStorage:
+
+    mongo = FakeMongo()
+    with mock.patch.object(MongoStorage, "conn", lambda self: mongo):
+        ...
+    mongo.calls  # Counter({"healthchecks.find_one": 3, ...})
+"""
+
+import collections
+
+import mongomock
+
+
+class FakeMongo(object):
+
+    def __init__(self):
+        self.client = mongomock.MongoClient()
+        self.calls = collections.Counter()
+
+    def __getitem__(self, name):
+        return _Database(self.client[name], self.calls)
+
+
+class _Database(object):
+
+    def __init__(self, db, calls):
+        self._db = db
+        self._calls = calls
+
+    def __getattr__(self, name):
+        return _Collection(self._db[name], self._calls)
+
+    def __getitem__(self, name):
+        return _Collection(self._db[name], self._calls)
+
+
+class _Collection(object):
+
+    def __init__(self, collection, calls):
+        self._collection = collection
+        self._calls = calls
+
+    def __getattr__(self, method):
+        attr = getattr(self._collection, method)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._calls["{}.{}".format(self._collection.name, method)] += 1
+            return attr(*args, **kwargs)
+        return call
@@ -0,0 +1,328 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+An in-process fake of the zabbix JSON-RPC api, keeping the objects used by
+the backend in memory, for benchmarks and fault injection tests:
+
+    zabbix = FakeZabbix(latency=lognormal(0.02, 0.5), error_rate=0.01, capacity=8)
+    url = zabbix.start()
+    ...
+    zabbix.stop()
+"""
+
+import collections
+import copy
+import gzip
+import io
+import json
+import math
+import random
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+# id field, unique name field, parent field of each object
+OBJECTS = {
+    "host": ("hostid", "host", None),
+    "hostgroup": ("groupid", "name", None),
+    "usergroup": ("usrgrpid", "name", None),
+    "user": ("userid", "alias", None),
+    "httptest": ("httptestid", "name", "hostid"),
+    "trigger": ("triggerid", None, None),
+    "action": ("actionid", "name", None),
+    "proxy": ("proxyid", "host", None),
+}
+
+DEFAULTS = {
+    "host": {"status": "0", "proxy_hostid": "0"},
+    "trigger": {"comments": "", "priority": "0", "status": "0"},
+    "httptest": {"delay": "60", "status": "0"},
+}
+
+INVALID_PARAMS = -32602
+INVALID_METHOD = -32601
+
+
+def lognormal(median, sigma):
+    """
+    Returns a latency distribution with the given median, in seconds,
+    and a long tail growing with ``sigma``.
+    """
+    return lambda rand: rand.lognormvariate(math.log(median), sigma)
+
+
+class FakeZabbix(object):
+    """
+    A zabbix api answering calls from memory.
+
+    ``latency`` is the seconds a call takes, a number or a function of a
+    ``random.Random``. ``error_rate`` is the share of calls answered with
+    an HTTP 500. At most ``capacity`` calls are processed at once, the
+    others queue, and calls start at most ``max_rate`` times per second.
+    ``calls`` counts the calls by method.
+    """
+
+    def __init__(self, latency=0, error_rate=0, capacity=None, max_rate=None, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_rate = max_rate
+        self.random = random.Random(seed)
+        self.slots = threading.BoundedSemaphore(capacity) if capacity else None
+        self.lock = threading.Lock()
+        self.next_start = 0
+        self.objects = dict((obj, collections.OrderedDict()) for obj in OBJECTS)
+        self.last_id = 10000
+        self.tokens = set()
+        self.calls = collections.Counter()
+        self.server = None
+
+    def start(self):
+        """
+        Serves the api on a local port and returns the url to give to the
+        client.
+        """
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.server.zabbix = self
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add(self, obj, **fields):
+        """
+        Creates an object directly, for seeding, and returns its id.
+        """
+        with self.lock:
+            return self._create(obj, [fields])[0]
+
+    def find(self, obj, **fields):
+        """
+        Returns copies of the objects having all of ``fields``.
+        """
+        with self.lock:
+            return [copy.deepcopy(o) for o in self.objects[obj].values()
+                    if all(o.get(k) == v for k, v in fields.items())]
+
+    def expire_sessions(self):
+        with self.lock:
+            self.tokens.clear()
+
+    def handle(self, request):
+        """
+        Answers a decoded JSON-RPC request, returning the HTTP status and
+        the response.
+        """
+        method = request.get("method", "")
+        with self.lock:
+            self.calls[method] += 1
+        if self.slots:
+            self.slots.acquire()
+        try:
+            self._throttle()
+            latency = self.latency(self.random) if callable(self.latency) else self.latency
+            if latency:
+                time.sleep(latency)
+            if self.error_rate and self.random.random() < self.error_rate:
+                return 500, {"error": "injected failure"}
+            response = {"jsonrpc": "2.0", "id": request.get("id")}
+            try:
+                with self.lock:
+                    response["result"] = self._call(method, request.get("params"),
+                                                    request.get("auth"))
+            except _Error as e:
+                response["error"] = {"code": e.args[0], "message": e.args[1], "data": e.args[2]}
+            return 200, response
+        finally:
+            if self.slots:
+                self.slots.release()
+
+    def _throttle(self):
+        if not self.max_rate:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + 1.0 / self.max_rate
+        if start > now:
+            time.sleep(start - now)
+
+    def _call(self, method, params, auth):
+        if method == "apiinfo.version":
+            return "3.0.0"
+        if method == "user.login":
+            token = "{:032x}".format(self.random.getrandbits(128))
+            self.tokens.add(token)
+            return token
+        if auth not in self.tokens:
+            raise _Error(INVALID_PARAMS, "Invalid params.", "Session terminated, re-login, please.")
+        obj, _, action = method.partition(".")
+        handler = getattr(self, "_" + action, None)
+        if obj not in OBJECTS or action not in ("create", "update", "delete", "get", "massupdate"):
+            raise _Error(INVALID_METHOD, "Method not found.", "Incorrect method \"{}\".".format(method))
+        id_field = OBJECTS[obj][0]
+        if action == "get":
+            return self._get(obj, params or {})
+        if action == "massupdate":
+            return {id_field + "s": self._massupdate(obj, params)}
+        if not isinstance(params, list):
+            params = [params]
+        return {id_field + "s": handler(obj, params)}
+
+    def _create(self, obj, params):
+        id_field, name_field, parent_field = OBJECTS[obj]
+        names = set(self._key(obj, o) for o in self.objects[obj].values())
+        created = []
+        for fields in params:
+            key = self._key(obj, fields)
+            if name_field and key in names:
+                raise _Error(INVALID_PARAMS, "Invalid params.",
+                             "{} \"{}\" already exists.".format(obj, fields.get(name_field)))
+            names.add(key)
+            created.append(fields)
+        ids = []
+        for fields in created:
+            self.last_id += 1
+            new = dict(DEFAULTS.get(obj, {}), **_stored(fields))
+            new[id_field] = str(self.last_id)
+            for no, step in enumerate(new.get("steps", []), 1):
+                self.last_id += 1
+                step.setdefault("no", no)
+                step["httpstepid"] = str(self.last_id)
+            self.objects[obj][new[id_field]] = new
+            ids.append(new[id_field])
+        return ids
+
+    def _update(self, obj, params):
+        id_field = OBJECTS[obj][0]
+        for fields in params:
+            self._existing(obj, [fields.get(id_field)])
+        for fields in params:
+            self.objects[obj][fields[id_field]].update(_stored(fields))
+        return [fields[id_field] for fields in params]
+
+    def _massupdate(self, obj, params):
+        id_field = OBJECTS[obj][0]
+        ids = [o[id_field] for o in params.pop(obj + "s")]
+        self._existing(obj, ids)
+        for object_id in ids:
+            self.objects[obj][object_id].update(copy.deepcopy(params))
+        return ids
+
+    def _delete(self, obj, ids):
+        self._existing(obj, ids)
+        for object_id in ids:
+            del self.objects[obj][object_id]
+        if obj == "host":
+            for httptest_id, httptest in list(self.objects["httptest"].items()):
+                if httptest["hostid"] in ids:
+                    del self.objects["httptest"][httptest_id]
+        return ids
+
+    def _existing(self, obj, ids):
+        for object_id in ids:
+            if object_id not in self.objects[obj]:
+                raise _Error(INVALID_PARAMS, "Invalid params.",
+                             "No permissions to referred object or it does not exist!")
+
+    def _get(self, obj, params):
+        id_field, _, parent_field = OBJECTS[obj]
+        found = list(self.objects[obj].values())
+        if id_field + "s" in params:
+            ids = set(str(i) for i in _list(params[id_field + "s"]))
+            found = [o for o in found if o[id_field] in ids]
+        if parent_field and parent_field + "s" in params:
+            ids = set(str(i) for i in _list(params[parent_field + "s"]))
+            found = [o for o in found if o[parent_field] in ids]
+        for field, values in (params.get("filter") or {}).items():
+            values = _list(values)
+            found = [o for o in found if o.get(field) in values]
+        for field, values in (params.get("search") or {}).items():
+            values = _list(values)
+            if params.get("startSearch"):
+                found = [o for o in found if any(o.get(field, "").startswith(v) for v in values)]
+            else:
+                found = [o for o in found if any(v in o.get(field, "") for v in values)]
+        if params.get("limit"):
+            found = found[:int(params["limit"])]
+        result = []
+        for o in found:
+            item = _output(o, params.get("output", "extend"))
+            if "selectSteps" in params:
+                item["steps"] = [_output(s, params["selectSteps"]) for s in o.get("steps", [])]
+            result.append(item)
+        return result
+
+    def _key(self, obj, fields):
+        _, name_field, parent_field = OBJECTS[obj]
+        return (fields.get(parent_field) if parent_field else None, fields.get(name_field))
+
+
+def _stored(fields):
+    # zabbix keeps null strings, like the comments of a trigger, as empty
+    return dict((k, "" if v is None else copy.deepcopy(v)) for k, v in fields.items())
+
+
+def _list(value):
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def _output(obj, output):
+    if output == "extend":
+        return copy.deepcopy(obj)
+    return dict((f, copy.deepcopy(obj[f])) for f in output if f in obj)
+
+
+class _Error(Exception):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        try:
+            request = json.loads(body.decode("utf-8"))
+        except ValueError:
+            status, response = 200, {"jsonrpc": "2.0", "id": None,
+                                     "error": {"code": -32700, "message": "Parse error."}}
+        else:
+            status, response = self.server.zabbix.handle(request)
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+                f.write(data)
+            data = buf.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # keep-alive connections of dropped clients are reset at exit
+        pass
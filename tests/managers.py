@@ -2,20 +2,38 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from healthcheck.storage import ItemNotFoundError
+from healthcheck.backends import InvalidCloneError, InvalidIntervalError
+from healthcheck.storage import ItemNotFoundError, HealthCheckNotFoundError
 
 
 class FakeManager(object):
     def __init__(self):
         self.healthchecks = {}
 
-    def add_url(self, name, url, expected_string=None, comment=""):
+    def add_url(self, name, url, expected_string=None, comment="", interval=None):
         item = {"url": url, "expected_string": expected_string, "comment": comment}
+        if interval is not None:
+            if int(interval) < 30:
+                raise InvalidIntervalError("interval must be at least 30 seconds")
+            item["interval"] = interval
         self.healthchecks[name]["urls"].append(item)
 
     def list_urls(self, name):
         return [[item['url'], item['comment']] for item in self.healthchecks[name]['urls']]
 
+    def discovery(self, name):
+        if name not in self.healthchecks:
+            raise HealthCheckNotFoundError()
+        return [{"{#URL}": item["url"]} for item in self.healthchecks[name]["urls"]]
+
+    def failed_url(self, name, scenario, step):
+        if name not in self.healthchecks:
+            raise HealthCheckNotFoundError()
+        urls = self.healthchecks[name]["urls"]
+        if scenario == "0a1b2c3d" and 0 < int(step) <= len(urls):
+            return urls[int(step) - 1]["url"]
+        return None
+
     def remove_url(self, name, url):
         index = -1
         for i, u in enumerate(self.healthchecks[name]["urls"]):
@@ -27,9 +45,27 @@ class FakeManager(object):
         else:
             raise ItemNotFoundError
 
+    def clone(self, name, source):
+        if name not in self.healthchecks or source not in self.healthchecks:
+            raise HealthCheckNotFoundError()
+        if name == source:
+            raise InvalidCloneError("can't clone an instance into itself")
+        for key in ("urls", "users", "host_groups"):
+            self.healthchecks[name][key].extend(self.healthchecks[source][key])
+
     def new(self, name):
         self.healthchecks[name] = {"urls": [], "users": [], "host_groups": []}
 
+    def new_many(self, names):
+        results = []
+        for name in names:
+            if name in self.healthchecks:
+                results.append({"name": name, "error": "instance already exists"})
+            else:
+                self.new(name)
+                results.append({"name": name, "created": True})
+        return results
+
     def add_watcher(self, name, email, password=None):
         self.healthchecks[name]["users"].append(email)
 
@@ -0,0 +1,107 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Round-trip budgets: counts the zabbix calls and mongodb commands of a
+backend operation, run against the fake zabbix and mongodb, and checks
+them against a declared budget.
+"""
+
+import os
+import unittest
+
+import mock
+
+from healthcheck import backends
+from healthcheck.backends import client
+from healthcheck.storage import MongoStorage
+
+from .fakemongo import FakeMongo
+from .fakezabbix import FakeZabbix
+
+
+class RoundTrips(object):
+    """
+    The zabbix calls and mongodb commands, by method, sent while
+    counting.
+    """
+
+    def __init__(self, zabbix, mongo):
+        self.zabbix = zabbix
+        self.mongo = mongo
+
+    def __enter__(self):
+        self.zabbix_before = self.zabbix.calls.copy()
+        self.mongo_before = self.mongo.calls.copy()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.zabbix_calls = self.zabbix.calls - self.zabbix_before
+        self.mongo_calls = self.mongo.calls - self.mongo_before
+
+    def totals(self):
+        return sum(self.zabbix_calls.values()), sum(self.mongo_calls.values())
+
+
+class RoundTripsTestCase(unittest.TestCase):
+    """
+    Runs a zabbix backend with a real MongoStorage against the fake
+    zabbix and mongodb. Work the backend does in background threads is
+    run inline, so it is counted with the operation starting it.
+    """
+
+    env = {}
+
+    def setUp(self):
+        client._tokens.clear()
+        backends._snapshots.clear()
+        self.zabbix = FakeZabbix()
+        url = self.zabbix.start()
+        self.addCleanup(self.zabbix.stop)
+        self.host_group_id = self.zabbix.add("hostgroup", name="hcaas")
+        self.mongo = FakeMongo()
+        env = {
+            "ZABBIX_URL": url,
+            "ZABBIX_USER": "user",
+            "ZABBIX_PASSWORD": "pass",
+            "ZABBIX_HOST": "hcaas",
+            "ZABBIX_HOST_GROUP": self.host_group_id,
+        }
+        env.update(self.env)
+        # the snapshots index is created once per process
+        patches = [mock.patch.dict(os.environ, env),
+                   mock.patch.object(MongoStorage, "conn", lambda storage: self.mongo),
+                   mock.patch.object(MongoStorage, "snapshots_indexed", True)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.backend = backends.Zabbix()
+        self.backend._in_background = lambda target, error: target()
+
+    def round_trips(self):
+        return RoundTrips(self.zabbix, self.mongo)
+
+    def assertBudget(self, grow, operation, zabbix, mongo, sizes=(1, 4)):
+        """
+        Calls ``grow(size)`` to build the state, then ``operation()``, for
+        each of ``sizes``, checking the zabbix calls and mongodb commands
+        of the operation against ``zabbix`` and ``mongo``. A number is a
+        constant budget: the calls must not exceed it nor change with the
+        size. A function gives the budget for a size.
+        """
+        spent = {}
+        for size in sizes:
+            grow(size)
+            with self.round_trips() as trips:
+                operation()
+            for budget, count, calls, backend in zip((zabbix, mongo), trips.totals(),
+                                                     (trips.zabbix_calls, trips.mongo_calls),
+                                                     ("zabbix", "mongodb")):
+                allowed = budget(size) if callable(budget) else budget
+                self.assertLessEqual(count, allowed, "{} {} calls at size {}, budget is {}: {}".format(
+                    count, backend, size, allowed, dict(calls)))
+                if not callable(budget):
+                    first = spent.setdefault(backend, (size, count))
+                    self.assertEqual(first[1], count, "{} {} calls at size {} but {} at size {}: {}".format(
+                        count, backend, size, first[1], first[0], dict(calls)))
@@ -2,13 +2,17 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import unittest
 import json
 import mock
+import gzip
 import inspect
+import io
 import os
 
 from healthcheck import api, backends
+from healthcheck.backends.breaker import CircuitOpenError
 from . import managers
 
 
@@ -60,6 +64,25 @@ class APITestCase(unittest.TestCase):
             self.manager.healthchecks["hc"]["urls"]
         )
 
+    def test_add_url_interval(self):
+        resp = self.api.post(
+            "/resources/hc/url",
+            data=json.dumps({"url": "http://blabla.com", "interval": 120})
+        )
+        self.assertEqual(201, resp.status_code)
+        self.assertIn(
+            {"url": "http://blabla.com", "expected_string": None, "comment": "", "interval": 120},
+            self.manager.healthchecks["hc"]["urls"]
+        )
+
+    def test_add_url_invalid_interval(self):
+        resp = self.api.post(
+            "/resources/hc/url",
+            data=json.dumps({"url": "http://blabla.com", "interval": 5})
+        )
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("interval must be at least 30 seconds", resp.data)
+
     def test_add_url_bad_request(self):
         resp = self.api.post(
             "/resources/hc/url",
@@ -85,6 +108,56 @@ class APITestCase(unittest.TestCase):
             resp.data
         )
 
+    def test_discovery(self):
+        self.manager.add_url("hc", "http://bla.com")
+        resp = self.api.get("/resources/hc/discovery")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.content_type)
+        self.assertEqual({"data": [{"{#URL}": "http://bla.com"}]}, json.loads(resp.data))
+
+    def test_discovery_instance_not_found(self):
+        resp = self.api.get("/resources/doesnotexist/discovery")
+        self.assertEqual(404, resp.status_code)
+
+    def test_clone(self):
+        self.manager.new("prod")
+        self.addCleanup(self.manager.remove, "prod")
+        self.manager.add_url("prod", "http://bla.com")
+        self.manager.add_watcher("prod", "w@bla.com")
+        resp = self.api.post("/resources/hc/clone", data=json.dumps({"source": "prod"}))
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual([["http://bla.com", ""]], self.manager.list_urls("hc"))
+        self.assertEqual(["w@bla.com"], self.manager.list_watchers("hc"))
+
+    def test_clone_no_source(self):
+        resp = self.api.post("/resources/hc/clone", data=json.dumps({}))
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("source is required", resp.data)
+
+    def test_clone_source_not_found(self):
+        resp = self.api.post("/resources/hc/clone", data=json.dumps({"source": "doesnotexist"}))
+        self.assertEqual(404, resp.status_code)
+
+    def test_clone_into_itself(self):
+        resp = self.api.post("/resources/hc/clone", data=json.dumps({"source": "hc"}))
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("can't clone an instance into itself", resp.data)
+
+    def test_new_many(self):
+        self.addCleanup(self.manager.remove, "bulk")
+        resp = self.api.post("/resources/bulk", data=json.dumps({"names": ["bulk", "hc"]}))
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.content_type)
+        self.assertEqual([{"name": "bulk", "created": True},
+                          {"name": "hc", "error": "instance already exists"}],
+                         json.loads(resp.data))
+        self.assertIn("bulk", self.manager.healthchecks)
+
+    def test_new_many_no_names(self):
+        resp = self.api.post("/resources/bulk", data=json.dumps({"names": []}))
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("names are required", resp.data)
+
     def test_remove_url(self):
         self.manager.add_url("hc", "http://bla.com/")
         resp = self.api.delete("/resources/hc/url",
@@ -164,6 +237,13 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(201, resp.status_code)
         self.assertIn("other", self.manager.healthchecks)
 
+    def test_new_removal_pending(self):
+        error = backends.RemovalPendingError("instance other is still being removed, try again later")
+        with mock.patch.object(self.manager, "new", side_effect=error):
+            resp = self.api.post("/resources", data={"name": "other"})
+        self.assertEqual(409, resp.status_code)
+        self.assertEqual("instance other is still being removed, try again later", resp.data)
+
     def test_bind_unit(self):
         resp = self.api.post("/resources/name/bind")
         self.assertEqual(201, resp.status_code)
@@ -204,12 +284,44 @@ class APITestCase(unittest.TestCase):
             self.manager.healthchecks["hc"]["users"]
         )
 
+    def test_failed_url(self):
+        self.manager.add_url("hc", "http://a.com")
+        self.manager.add_url("hc", "http://b.com")
+
+        resp = self.api.get("/resources/hc/failed-url/0a1b2c3d/2")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(b"http://b.com", resp.data)
+        self.assertEqual(404, self.api.get("/resources/hc/failed-url/0a1b2c3d/3").status_code)
+        self.assertEqual(404, self.api.get("/resources/missing/failed-url/0a1b2c3d/1").status_code)
+
     def test_plugin(self):
         resp = self.api.get("/plugin")
         self.assertEqual(200, resp.status_code)
         from healthcheck import plugin
         expected_source = inspect.getsource(plugin)
         self.assertEqual(expected_source, resp.data)
+        self.assertEqual("public, max-age=300", resp.headers["Cache-Control"])
+        self.assertEqual("Accept-Encoding", resp.headers["Vary"])
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_plugin_gzip(self):
+        resp = self.api.get("/plugin", headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("gzip", resp.headers["Content-Encoding"])
+        from healthcheck import plugin
+        expected_source = inspect.getsource(plugin)
+        self.assertEqual(expected_source, gzip.GzipFile(fileobj=io.BytesIO(resp.data)).read())
+        identity = self.api.get("/plugin")
+        self.assertNotEqual(identity.headers["ETag"], resp.headers["ETag"])
+
+    def test_plugin_not_modified(self):
+        etag = self.api.get("/plugin").headers["ETag"]
+        resp = self.api.get("/plugin", headers={"If-None-Match": etag})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b"", resp.data)
+        self.assertEqual(etag, resp.headers["ETag"])
+        resp = self.api.get("/plugin", headers={"If-None-Match": etag, "Accept-Encoding": "gzip"})
+        self.assertEqual(200, resp.status_code)
 
     def test_add_group(self):
         resp = self.api.post(
@@ -266,6 +378,27 @@ class APITestCase(unittest.TestCase):
             resp.data
         )
 
+    def test_list_groups_from_snapshot(self):
+        self.manager.snapshot_updated_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=90)
+        try:
+            resp = self.api.get("/resources/hc/groups")
+        finally:
+            del self.manager.snapshot_updated_at
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('110 - "Response is Stale"', resp.headers["Warning"])
+        self.assertIn(int(resp.headers["Age"]), [90, 91])
+
+    def test_list_groups_is_fresh(self):
+        resp = self.api.get("/resources/hc/groups")
+        self.assertNotIn("Warning", resp.headers)
+
+    @mock.patch.object(managers.FakeManager, "list_urls")
+    def test_zabbix_unavailable(self, list_urls_mock):
+        list_urls_mock.side_effect = CircuitOpenError("zabbix is unavailable", 12.5)
+        resp = self.api.get("/resources/hc/url")
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual("13", resp.headers["Retry-After"])
+
     def test_remove_group(self):
         self.manager.add_group("hc", "mygroup")
         resp = self.api.delete("/resources/hc/groups",
@@ -283,7 +416,7 @@ class GetManagerTestCase(unittest.TestCase):
     def setUpClass(cls):
         reload(api)
 
-    @mock.patch("pyzabbix.ZabbixAPI")
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
     def test_get_manager(self, zabbix_mock):
         os.environ["ZABBIX_URL"] = ""
         os.environ["ZABBIX_USER"] = ""
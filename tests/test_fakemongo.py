@@ -0,0 +1,24 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from healthcheck.storage import HealthCheck, MongoStorage
+
+from .fakemongo import FakeMongo
+
+
+class FakeMongoTest(unittest.TestCase):
+
+    def test_counts_commands(self):
+        mongo = FakeMongo()
+        with mock.patch.object(MongoStorage, "conn", lambda self: mongo):
+            storage = MongoStorage()
+
+        storage.add_healthcheck(HealthCheck("hc", group_id="g1"))
+        self.assertEqual("g1", storage.find_healthcheck_by_name("hc").group_id)
+
+        self.assertEqual({"healthchecks.insert": 1, "healthchecks.find_one": 1}, dict(mongo.calls))
@@ -0,0 +1,162 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import threading
+import time
+import unittest
+
+import mock
+
+from healthcheck.backends import client
+from healthcheck.backends.client import ZabbixClient, ZabbixAPIException
+from healthcheck.storage import HealthCheck, Item
+
+from .fakezabbix import FakeZabbix
+
+
+class FakeZabbixTest(unittest.TestCase):
+
+    def setUp(self):
+        client._tokens.clear()
+        self.zabbix = FakeZabbix(seed=1)
+        self.url = self.zabbix.start()
+        self.addCleanup(self.zabbix.stop)
+        self.zapi = ZabbixClient(self.url, retries=0)
+        self.zapi.login("user", "pass")
+
+    def test_create_and_get(self):
+        group_id = self.zabbix.add("hostgroup", name="hcaas")
+        result = self.zapi.host.create({"host": "a", "groups": [{"groupid": group_id}]},
+                                       {"host": "b", "groups": [{"groupid": group_id}]})
+
+        self.assertEqual(2, len(result["hostids"]))
+        hosts = self.zapi.host.get(output=["hostid", "host"], filter={"host": ["b"]})
+        self.assertEqual([{"hostid": result["hostids"][1], "host": "b"}], hosts)
+        self.assertEqual([{"name": "hcaas"}],
+                         self.zapi.hostgroup.get(output=["name"], search={"name": ["hc"]},
+                                                 startSearch=True))
+
+    def test_create_existing(self):
+        self.zabbix.add("usergroup", name="a")
+
+        with self.assertRaises(ZabbixAPIException) as cm:
+            self.zapi.usergroup.create({"name": "b"}, {"name": "a"})
+
+        self.assertEqual(-32602, cm.exception.args[1])
+        self.assertEqual([], self.zabbix.find("usergroup", name="b"))
+
+    def test_httptest_steps(self):
+        host_id = self.zabbix.add("host", host="a")
+        httptest_id = self.zapi.httptest.create(
+            hostid=host_id, name="hc for a", steps=[{"url": "http://a.com", "required": "ok"}],
+        )["httptestids"][0]
+
+        httptests = self.zapi.httptest.get(output=["httptestid"], selectSteps=["required"],
+                                           hostids=[host_id])
+        self.assertEqual([{"httptestid": httptest_id, "steps": [{"required": "ok"}]}], httptests)
+        self.zapi.host.delete(host_id)
+        self.assertEqual([], self.zabbix.find("httptest"))
+
+    def test_update_and_delete(self):
+        trigger_id = self.zabbix.add("trigger", description="a", expression="x")
+
+        self.zapi.trigger.update(triggerid=trigger_id, comments="call ops")
+        self.assertEqual([{"comments": "call ops"}],
+                         self.zapi.trigger.get(output=["comments"], triggerids=[trigger_id]))
+        self.zapi.trigger.delete(trigger_id)
+        with self.assertRaises(ZabbixAPIException):
+            self.zapi.trigger.delete(trigger_id)
+
+    def test_massupdate(self):
+        ids = [self.zabbix.add("host", host="a"), self.zabbix.add("host", host="b")]
+
+        self.zapi.host.massupdate(hosts=[{"hostid": i} for i in ids], proxy_hostid="7")
+
+        self.assertEqual(["7", "7"], [h["proxy_hostid"] for h in self.zabbix.find("host")])
+
+    def test_expired_session(self):
+        self.zabbix.expire_sessions()
+
+        self.assertEqual([], self.zapi.action.get(output=["actionid"]))
+        self.assertEqual(2, self.zabbix.calls["user.login"])
+
+    def test_unknown_method(self):
+        with self.assertRaises(ZabbixAPIException):
+            self.zapi.item.get(output=["itemid"])
+
+    def test_error_rate(self):
+        self.zabbix.error_rate = 1
+
+        with self.assertRaises(ZabbixAPIException) as cm:
+            self.zapi.host.get(output=["hostid"])
+
+        self.assertEqual("HTTP error 500", cm.exception.args[0])
+
+    def test_latency_and_capacity(self):
+        zabbix = FakeZabbix(latency=0.02, capacity=2)
+        url = zabbix.start()
+        self.addCleanup(zabbix.stop)
+        zapi = ZabbixClient(url)
+        zapi.login("user", "pass")
+
+        def get():
+            zapi.host.get(output=["hostid"])
+
+        started = time.time()
+        threads = [threading.Thread(target=get) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # login, then two rounds of two concurrent calls
+        self.assertGreaterEqual(time.time() - started, 0.04)
+        self.assertEqual(4, zabbix.calls["host.get"])
+
+    def test_max_rate(self):
+        self.zabbix.max_rate = 50
+        started = time.time()
+
+        for _ in range(5):
+            self.zapi.host.get(output=["hostid"])
+
+        self.assertGreaterEqual(time.time() - started, 0.07)
+
+
+class BackendTest(unittest.TestCase):
+
+    @mock.patch("healthcheck.storage.MongoStorage")
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
+    def setUp(self, zabbix_mock, mongo_mock):
+        os.environ["ZABBIX_URL"] = "http://zbx.com"
+        os.environ["ZABBIX_USER"] = "user"
+        os.environ["ZABBIX_PASSWORD"] = "pass"
+        os.environ["ZABBIX_HOST"] = "1"
+        self.zabbix = FakeZabbix()
+        os.environ["ZABBIX_HOST_GROUP"] = self.zabbix.add("hostgroup", name="hcaas")
+        url = self.zabbix.start()
+        self.addCleanup(self.zabbix.stop)
+        from healthcheck.backends import Zabbix
+        self.backend = Zabbix()
+        self.backend.zapi = ZabbixClient(url)
+        self.backend.zapi.login("user", "pass")
+        self.backend.storage = mock.Mock()
+        self.backend.storage.find_removed_healthcheck.return_value = None
+
+    def test_new_and_add_url(self):
+        self.backend.new("site")
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+
+        self.backend.add_url("site", "http://site.com", comment="call ops")
+
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.backend.storage.find_items_by_group.return_value = [item]
+        self.assertEqual([["http://site.com", "call ops"]], self.backend.list_urls("site"))
+        self.assertEqual(["site"], [h["host"] for h in self.zabbix.find("host")])
+        self.assertEqual(1, len(self.zabbix.find("httptest", hostid=hc.host_id)))
+        self.assertEqual(1, len(self.zabbix.find("action", name="action for site")))
+        self.assertIsInstance(hc, HealthCheck)
+        self.assertIsInstance(item, Item)
@@ -0,0 +1,66 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from healthcheck import manage
+
+
+class ManageTest(unittest.TestCase):
+
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.manage.get_manager")
+    def test_rebalance_proxies(self, get_manager, stdout):
+        get_manager.return_value.rebalance_proxies.return_value = [
+            ("mysite", "10", "11"),
+        ]
+        manage.main("rebalance-proxies")
+        stdout.write.assert_any_call("mysite: 10 -> 11\n")
+        stdout.write.assert_any_call("1 host(s) moved\n")
+
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.manage.get_manager")
+    def test_merge_actions(self, get_manager, stdout):
+        get_manager.return_value.merge_actions.return_value = 3
+        manage.main("merge-actions")
+        stdout.write.assert_called_with("3 per-url action(s) merged\n")
+
+    @mock.patch("healthcheck.restore.Restore")
+    @mock.patch("healthcheck.manage.get_manager")
+    def test_restore(self, get_manager, restore):
+        manage.main("restore", "100", "2")
+        restore.assert_called_with(get_manager.return_value, 100, 2, mock.ANY)
+        restore.return_value.run.assert_called_with()
+
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.manage.get_manager")
+    def test_fill_pool(self, get_manager, stdout):
+        get_manager.return_value.fill_pool.return_value = 4
+        manage.main("fill-pool")
+        stdout.write.assert_called_with("4 pool entry(ies) created\n")
+
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.manage.get_manager")
+    def test_reclaim_pool(self, get_manager, stdout):
+        get_manager.return_value.reclaim_pool.return_value = 2
+        manage.main("reclaim-pool")
+        stdout.write.assert_called_with("2 pool entry(ies) reclaimed\n")
+
+    @mock.patch("sys.stderr")
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.manage.get_manager")
+    def test_collect_removed(self, get_manager, stdout, stderr):
+        get_manager.return_value.collect_removed.side_effect = [2, Exception("zabbix is down"), 1, 0]
+        manage.main("collect-removed", "50")
+        get_manager.return_value.collect_removed.assert_called_with(50)
+        stderr.write.assert_called_with("ERROR: zabbix is down\n")
+        stdout.write.assert_called_with("3 instance(s) collected\n")
+
+    @mock.patch("sys.stderr")
+    def test_unknown_command(self, stderr):
+        with self.assertRaises(SystemExit) as cm:
+            manage.main("doesnotexist")
+        self.assertEqual(2, cm.exception.code)
@@ -0,0 +1,106 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import flask
+import mock
+
+from prometheus_client import REGISTRY
+
+from healthcheck import metrics
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+
+        @app.route("/resources/<name>/url")
+        def list_urls(name):
+            self.in_flight = sample("hcaas_requests_in_flight")
+            return "[]"
+
+        metrics.install(app)
+        self.app = app.test_client()
+
+    def test_requests(self):
+        before = sample("hcaas_requests_total", method="GET", route="/resources/<name>/url", status="200")
+        in_flight = sample("hcaas_requests_in_flight")
+
+        self.app.get("/resources/a/url")
+        self.app.get("/resources/b/url")
+        self.app.get("/missing")
+
+        after = sample("hcaas_requests_total", method="GET", route="/resources/<name>/url", status="200")
+        self.assertEqual(before + 2, after)
+        self.assertEqual(in_flight + 1, self.in_flight)
+        self.assertEqual(in_flight, sample("hcaas_requests_in_flight"))
+        self.assertGreater(sample("hcaas_requests_total", method="GET", route="unmatched", status="404"), 0)
+        self.assertGreater(sample("hcaas_request_duration_seconds_count", method="GET",
+                                  route="/resources/<name>/url"), 0)
+
+    def test_expose(self):
+        self.app.get("/resources/a/url")
+
+        resp = self.app.get("/metrics")
+
+        self.assertEqual(200, resp.status_code)
+        self.assertIn(b'hcaas_requests_total{method="GET",route="/resources/<name>/url",status="200"}', resp.data)
+
+    def test_expose_requires_auth(self):
+        with mock.patch.dict(os.environ, {"API_USERNAME": "user", "API_PASSWORD": "pass"}):
+            self.assertEqual(401, self.app.get("/metrics").status_code)
+
+    def test_observed_methods(self):
+        @metrics.observed_methods("mongo", exclude=("conn",))
+        class Storage(object):
+            def find(self):
+                return 1
+
+            def fail(self):
+                raise ValueError()
+
+        ok = sample("hcaas_backend_calls_total", backend="mongo", operation="find", outcome="ok")
+        errors = sample("hcaas_backend_calls_total", backend="mongo", operation="fail", outcome="error")
+
+        self.assertEqual(1, Storage().find())
+        with self.assertRaises(ValueError):
+            Storage().fail()
+
+        self.assertEqual(ok + 1, sample("hcaas_backend_calls_total", backend="mongo",
+                                        operation="find", outcome="ok"))
+        self.assertEqual(errors + 1, sample("hcaas_backend_calls_total", backend="mongo",
+                                            operation="fail", outcome="error"))
+
+
+class MultiProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_aggregate_workers(self):
+        script = ("from healthcheck import metrics\n"
+                  "metrics.REQUESTS.labels('GET', '/plugin', '200').inc(3)\n"
+                  "metrics.IN_FLIGHT.inc()\n")
+        env = dict(os.environ, prometheus_multiproc_dir=self.path, PYTHONPATH=os.getcwd())
+        for _ in range(2):
+            subprocess.check_call([sys.executable, "-c", script], env=env)
+
+        with mock.patch.dict(os.environ, {"prometheus_multiproc_dir": self.path}):
+            registry = metrics.registry()
+
+        self.assertEqual(6, registry.get_sample_value(
+            "hcaas_requests_total", {"method": "GET", "route": "/plugin", "status": "200"}))
+        self.assertIsNot(REGISTRY, registry)
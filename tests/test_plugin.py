@@ -7,7 +7,7 @@ import json
 import os
 import unittest
 
-from healthcheck.plugin import (add_url, add_watcher, list_urls, command, main,
+from healthcheck.plugin import (add_url, add_watcher, clone, failed_url, list_urls, command, main,
                                 remove_watcher, remove_url, list_watchers, show_help,
                                 add_group, remove_group, list_groups, list_service_groups)
 
@@ -109,6 +109,28 @@ class PluginTest(unittest.TestCase):
         self.assertEqual(calls, request.add_header.call_args_list)
         urlopen.assert_called_with(request, timeout=30)
 
+    @mock.patch("healthcheck.plugin.urlopen")
+    @mock.patch("healthcheck.plugin.Request")
+    def test_add_url_with_interval_args(self, Request, urlopen):
+        request = mock.Mock()
+        Request.return_value = request
+
+        result = mock.Mock()
+        result.getcode.return_value = 201
+        urlopen.return_value = result
+
+        add_url("service_name", "name", "http://example.com/hc", "", "", "300")
+
+        request.add_data.assert_called_with(json.dumps({'url': 'http://example.com/hc',
+                                                        'interval': 300}))
+
+    @mock.patch("sys.stderr")
+    def test_add_url_with_invalid_interval(self, stderr):
+        with self.assertRaises(SystemExit) as cm:
+            add_url("service_name", "name", "http://example.com/hc", "", "", "often")
+        self.assertEqual(2, cm.exception.code)
+        stderr.write.assert_called_with("ERROR: interval must be a number of seconds\n")
+
     @mock.patch("healthcheck.plugin.urlopen")
     @mock.patch("healthcheck.plugin.Request")
     def test_list_urls(self, Request, urlopen):
@@ -160,6 +182,26 @@ class PluginTest(unittest.TestCase):
         self.assertEqual(calls, request.add_header.call_args_list)
         urlopen.assert_called_with(request, timeout=30)
 
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.plugin.urlopen")
+    @mock.patch("healthcheck.plugin.Request")
+    def test_clone(self, Request, urlopen, stdout):
+        request = mock.Mock()
+        Request.return_value = request
+
+        result = mock.Mock()
+        result.getcode.return_value = 201
+        urlopen.return_value = result
+
+        clone("service_name", "name", "source")
+
+        Request.assert_called_with(
+            self.target + 'services/service_name/proxy/name?callback=/resources/name/clone',
+        )
+        request.add_data.assert_called_with(json.dumps({'source': 'source'}))
+        self.assertEqual(request.get_method(), 'POST')
+        stdout.write.assert_called_with("instance source successfully cloned to name!\n")
+
     @mock.patch("healthcheck.plugin.urlopen")
     @mock.patch("healthcheck.plugin.Request")
     def test_add_watcher(self, Request, urlopen):
@@ -260,6 +302,26 @@ class PluginTest(unittest.TestCase):
         self.assertEqual(calls, request.add_header.call_args_list)
         urlopen.assert_called_with(request, timeout=30)
 
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.plugin.urlopen")
+    @mock.patch("healthcheck.plugin.Request")
+    def test_failed_url(self, Request, urlopen, stdout):
+        request = mock.Mock()
+        Request.return_value = request
+
+        response = mock.Mock()
+        response.read.return_value = b"http://mysite.com/hc"
+        response.getcode.return_value = 200
+        urlopen.return_value = response
+
+        failed_url("service_name", "name", "hc scenario 0a1b2c3d for name", "2")
+
+        Request.assert_called_with(
+            self.target + 'services/service_name/proxy/name?callback=/resources/name/failed-url/0a1b2c3d/2',
+        )
+        self.assertEqual(request.get_method(), 'GET')
+        stdout.write.assert_called_with("http://mysite.com/hc\n")
+
     @mock.patch("healthcheck.plugin.urlopen")
     @mock.patch("healthcheck.plugin.Request")
     def test_add_group(self, Request, urlopen):
@@ -412,6 +474,7 @@ class PluginTest(unittest.TestCase):
         expected_commands = {
             "add-url": add_url,
             "add-watcher": add_watcher,
+            "clone": clone,
             "remove-url": remove_url,
             "remove-watcher": remove_watcher,
         }
@@ -430,6 +493,8 @@ class PluginTest(unittest.TestCase):
             mock.call("  add-group\n"),
             mock.call("  add-url\n"),
             mock.call("  add-watcher\n"),
+            mock.call("  clone\n"),
+            mock.call("  failed-url\n"),
             mock.call("  list-groups\n"),
             mock.call("  list-service-groups\n"),
             mock.call("  list-urls\n"),
@@ -0,0 +1,105 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import marshal
+import os
+import unittest
+
+import flask
+import mock
+
+from healthcheck import profiling
+from healthcheck.storage import MongoStorage
+
+from .fakemongo import FakeMongo
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo = FakeMongo()
+        patch = mock.patch.object(MongoStorage, "conn", lambda storage: self.mongo)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.app = self.make_app()
+
+    def make_app(self, **env):
+        app = flask.Flask(__name__)
+
+        @app.route("/work")
+        def work():
+            return ",".join(str(i) for i in range(1000)), 200, {"X-Work": "done"}
+
+        env.setdefault("API_PROFILE_TOKEN", "secret")
+        with mock.patch.dict(os.environ, env):
+            self.profiler = profiling.install(app)
+        return app.test_client()
+
+    def test_disabled_without_token(self):
+        app = flask.Flask(__name__)
+        wsgi_app = app.wsgi_app
+
+        with mock.patch.dict(os.environ, {"API_PROFILE_TOKEN": ""}):
+            self.assertIsNone(profiling.install(app))
+
+        self.assertEqual(wsgi_app, app.wsgi_app)
+        self.assertEqual(404, app.test_client().get("/profiles").status_code)
+
+    def test_request_without_header_is_not_profiled(self):
+        resp = self.app.get("/work")
+
+        self.assertEqual(200, resp.status_code)
+        self.assertNotIn("X-Profile-Id", resp.headers)
+        self.assertEqual(0, self.mongo.calls["profiles.insert_one"])
+
+    def test_wrong_token(self):
+        resp = self.app.get("/work", headers={"X-Profile": "guess"})
+
+        self.assertNotIn("X-Profile-Id", resp.headers)
+        self.assertEqual(401, self.app.get("/profiles", headers={"X-Profile": "guess"}).status_code)
+        self.assertEqual(401, self.app.get("/profiles").status_code)
+
+    def test_profile_request(self):
+        resp = self.app.get("/work", headers={"X-Profile": "secret"})
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("done", resp.headers["X-Work"])
+        self.assertTrue(resp.data.startswith(b"0,1,2"))
+        profile_id = resp.headers["X-Profile-Id"]
+        profiles = json.loads(self.app.get("/profiles", headers={"X-Profile": "secret"}).data)
+        self.assertEqual([profile_id], [p["id"] for p in profiles])
+        self.assertEqual(("GET", "/work", 200), (profiles[0]["method"], profiles[0]["path"],
+                                                 profiles[0]["status"]))
+
+        resp = self.app.get("/profiles/" + profile_id, headers={"X-Profile": "secret"})
+        self.assertEqual(200, resp.status_code)
+        stats = marshal.loads(resp.data)
+        self.assertIn("work", [func for _, _, func in stats])
+        text = self.app.get("/profiles/{}?format=text".format(profile_id),
+                            headers={"X-Profile": "secret"}).data.decode("utf-8")
+        self.assertIn("function calls", text)
+        self.assertIn("allocations:", text)
+
+    def test_unknown_profile(self):
+        resp = self.app.get("/profiles/missing", headers={"X-Profile": "secret"})
+
+        self.assertEqual(404, resp.status_code)
+
+    def test_sample_rate(self):
+        app = self.make_app(API_PROFILE_SAMPLE_RATE="0.5")
+        self.profiler.random.seed(1)
+
+        ids = [app.get("/work").headers.get("X-Profile-Id") for _ in range(20)]
+
+        self.assertTrue(0 < len([i for i in ids if i]) < 20)
+
+    def test_keep_last_profiles(self):
+        app = self.make_app(API_PROFILE_KEEP="2")
+
+        ids = [app.get("/work", headers={"X-Profile": "secret"}).headers["X-Profile-Id"]
+               for _ in range(3)]
+
+        profiles = json.loads(app.get("/profiles", headers={"X-Profile": "secret"}).data)
+        self.assertEqual(ids[:0:-1], [p["id"] for p in profiles])
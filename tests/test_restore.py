@@ -0,0 +1,169 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import unittest
+
+import mock
+
+from healthcheck.restore import Restore
+from healthcheck.storage import HealthCheck, Item, User
+
+
+class RestoreTest(unittest.TestCase):
+
+    @mock.patch("healthcheck.storage.MongoStorage")
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
+    def setUp(self, zabbix_mock, mongo_mock):
+        os.environ["ZABBIX_URL"] = "http://zbx.com"
+        os.environ["ZABBIX_USER"] = "user"
+        os.environ["ZABBIX_PASSWORD"] = "pass"
+        os.environ["ZABBIX_HOST"] = "1"
+        os.environ["ZABBIX_HOST_GROUP"] = "2"
+        from healthcheck.backends import Zabbix
+        self.manager = Zabbix()
+        self.manager.zapi = mock.Mock()
+        self.manager.zapi.batch.return_value = self.manager.zapi
+        self.manager.storage = storage = mock.Mock()
+        storage.find_healthchecks.return_value = [
+            HealthCheck("a", _id=1, host_id="h1", group_id="g1", host_groups=["2"],
+                        host_name="a"),
+            HealthCheck("b", _id=2, host_id="h2", group_id="g2", host_groups=["2", "3"],
+                        host_name="b", steps_per_scenario=10),
+        ]
+        storage.find_items.return_value = [
+            Item("http://a.com", _id=11, group_id="g1", item_id="i1", trigger_id="t1",
+                 interval=60, action_id="old"),
+            Item("http://b.com", _id=12, group_id="g2", item_id="i2", trigger_id="t2",
+                 interval=60, compact=True),
+            Item("http://c.com", _id=13, group_id="g2", item_id="i2", trigger_id="t2",
+                 interval=60, compact=True),
+        ]
+        storage.find_users.return_value = [User("u1", "w@a.com", "g1", "g2")]
+        storage.find_packed_hosts.return_value = []
+        storage.find_scenarios.return_value = []
+        storage.find_restore_entries.return_value = []
+        self.counter = [100]
+        for obj, key in [("host", "hostids"), ("usergroup", "usrgrpids"),
+                         ("user", "userids"), ("action", "actionids"),
+                         ("httptest", "httptestids"), ("trigger", "triggerids")]:
+            api = getattr(self.manager.zapi, obj)
+            api.get.return_value = []
+            api.create.side_effect = self._create(key)
+        self.out = mock.Mock()
+
+    def _create(self, key):
+        def create(*params):
+            ids = []
+            for _ in params:
+                self.counter[0] += 1
+                ids.append(str(self.counter[0]))
+            return {key: ids}
+        return create
+
+    def entries(self):
+        entries = []
+        for call in self.manager.storage.add_restore_entries.call_args_list:
+            entries.extend(call[0][0])
+        return entries
+
+    def fields(self, collection, doc_id):
+        fields = {}
+        for entry in self.entries():
+            if entry.get("collection") == collection and entry["query"] == {"_id": doc_id}:
+                fields.update(entry["fields"])
+        return fields
+
+    def test_run(self):
+        total = Restore(self.manager, out=self.out).run()
+
+        zapi = self.manager.zapi
+        self.assertEqual(11, total)
+        self.assertEqual(1, zapi.host.create.call_count)
+        hosts = zapi.host.create.call_args[0]
+        self.assertEqual(["a", "b"], [h["host"] for h in hosts])
+        self.assertEqual([{"groupid": "2"}, {"groupid": "3"}], hosts[1]["groups"])
+        groups = zapi.usergroup.create.call_args[0]
+        self.assertEqual([{"permission": 2, "id": "2"}, {"permission": 2, "id": "3"}],
+                         groups[1]["rights"])
+        user = zapi.user.create.call_args[0][0]
+        self.assertEqual([{"usrgrpid": "103"}, {"usrgrpid": "104"}], user["usrgrps"])
+        actions = zapi.action.create.call_args[0]
+        self.assertEqual("101", actions[0]["conditions"][2]["value"])
+        httptests = zapi.httptest.create.call_args[0]
+        self.assertEqual(2, len(httptests))
+        self.assertEqual(["http://b.com", "http://c.com"], [s["url"] for s in httptests[1]["steps"]])
+        triggers = zapi.trigger.create.call_args[0]
+        self.assertIn("web.test.fail[%s]" % httptests[1]["name"], triggers[1]["expression"])
+
+        self.assertEqual({"host_id": "101", "group_id": "103", "action_id": "106"},
+                         self.fields("healthchecks", 1))
+        self.assertEqual({"group_id": "103", "action_id": None, "item_id": "108",
+                          "trigger_id": "110"}, self.fields("items", 11))
+        self.assertEqual({"group_id": "104", "item_id": "109", "trigger_id": "111"},
+                         self.fields("items", 13))
+        self.manager.storage.apply_restore_entries.assert_called_with()
+        self.out.write.assert_any_call(mock.ANY)
+
+    def test_run_warns_about_unrecorded_expected_strings(self):
+        Restore(self.manager, out=self.out).run()
+
+        self.out.write.assert_any_call("warning: 1 url(s) restored without their expected string "
+                                       "and comment, which were kept in zabbix only\n")
+
+    def test_run_keeps_recorded_expected_strings(self):
+        item = self.manager.storage.find_items.return_value[0]
+        item.expected_string, item.comment = "OK", "call ops"
+
+        Restore(self.manager, out=self.out).run()
+
+        httptests = self.manager.zapi.httptest.create.call_args[0]
+        self.assertEqual("OK", httptests[0]["steps"][0]["required"])
+        triggers = self.manager.zapi.trigger.create.call_args[0]
+        self.assertEqual("call ops", triggers[0]["comments"])
+        self.assertEqual([], [c[0][0] for c in self.out.write.call_args_list
+                              if c[0][0].startswith("warning")])
+
+    def test_run_resumes_from_checkpoint(self):
+        self.manager.storage.find_restore_entries.return_value = [
+            {"phase": "hosts", "unit": "1", "new_id": "50"},
+            {"phase": "hosts", "unit": "2", "new_id": "51"},
+        ]
+
+        Restore(self.manager, out=self.out).run()
+
+        self.assertFalse(self.manager.zapi.host.create.called)
+        actions = self.manager.zapi.action.create.call_args[0]
+        self.assertEqual("50", actions[0]["conditions"][2]["value"])
+
+    def test_run_reuses_objects_created_before_a_crash(self):
+        self.manager.zapi.host.get.return_value = [{"hostid": "77", "host": "a"}]
+
+        Restore(self.manager, out=self.out).run()
+
+        hosts = self.manager.zapi.host.create.call_args[0]
+        self.assertEqual(["b"], [h["host"] for h in hosts])
+        self.assertEqual("77", self.fields("healthchecks", 1)["host_id"])
+
+    def test_run_reuses_triggers_created_before_a_crash(self):
+        params = self.manager._trigger_params("a", "http://a.com", None, "hc for http://a.com")
+        self.manager.zapi.trigger.get.return_value = [
+            {"triggerid": "88", "description": params["description"], "expression": params["expression"]},
+            {"triggerid": "89", "description": params["description"], "expression": "{other:x.last()}<>0"},
+        ]
+
+        Restore(self.manager, out=self.out).run()
+
+        triggers = self.manager.zapi.trigger.create.call_args[0]
+        self.assertEqual(1, len(triggers))
+        self.assertNotEqual(params["description"], triggers[0]["description"])
+        self.assertEqual("88", self.fields("items", 11)["trigger_id"])
+        _, kwargs = self.manager.zapi.trigger.get.call_args
+        self.assertTrue(kwargs["expandExpression"])
+
+    def test_run_in_batches(self):
+        Restore(self.manager, batch_size=1, concurrency=2, out=self.out).run()
+
+        self.assertEqual(2, self.manager.zapi.host.create.call_count)
+        self.assertEqual(2, self.manager.zapi.usergroup.create.call_count)
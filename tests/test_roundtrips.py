@@ -0,0 +1,291 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Zabbix calls and mongodb commands each backend operation may send. Most
+operations must not grow with the size of the instance, its urls,
+watchers or groups; maintenance commands are allowed to grow with the
+number of instances. Raising a budget is a deliberate change: update it
+here along with the code that needs it.
+"""
+
+import inspect
+import re
+import unittest
+
+import mock
+
+from healthcheck import api, backends
+
+from .roundtrips import RoundTripsTestCase
+
+
+class InstanceRoundTripsTest(RoundTripsTestCase):
+    """
+    Creates the instance "site", with helpers growing its urls, watchers
+    and groups and the number of instances.
+    """
+
+    def setUp(self):
+        super(InstanceRoundTripsTest, self).setUp()
+        self.backend.new("site")
+        self.urls = {}
+        self.watchers = {}
+        self.groups = []
+        self.instances = []
+        self.counter = 0
+
+    def next_id(self):
+        self.counter += 1
+        return self.counter
+
+    def grow_urls(self, name, size):
+        urls = self.urls.setdefault(name, [])
+        while len(urls) < size:
+            url = "http://{}.com/{}".format(name, self.next_id())
+            self.backend.add_url(name, url, comment="call ops")
+            urls.append(url)
+
+    def grow_watchers(self, name, size):
+        watchers = self.watchers.setdefault(name, [])
+        while len(watchers) < size:
+            email = "w{}@{}.com".format(self.next_id(), name)
+            self.backend.add_watcher(name, email)
+            watchers.append(email)
+
+    def grow_instances(self, size):
+        while len(self.instances) < size:
+            name = "instance-{}".format(self.next_id())
+            self.backend.new(name)
+            self.grow_urls(name, 1)
+            self.instances.append(name)
+
+    def grow_groups(self, name, size):
+        while len(self.groups) < size:
+            group = "group-{}".format(self.next_id())
+            self.zabbix.add("hostgroup", name=group)
+            self.backend.add_group(name, group)
+            self.groups.append(group)
+
+
+class ZabbixRoundTripsTest(InstanceRoundTripsTest):
+
+    def test_add_url(self):
+        self.assertBudget(lambda size: self.grow_urls("site", size),
+                          lambda: self.grow_urls("site", len(self.urls["site"]) + 1),
+                          zabbix=2, mongo=2)
+
+    def test_remove_url(self):
+        self.assertBudget(lambda size: self.grow_urls("site", size + 1),
+                          lambda: self.backend.remove_url("site", self.urls["site"].pop()),
+                          zabbix=1, mongo=3)
+
+    def test_list_urls(self):
+        self.assertBudget(lambda size: self.grow_urls("site", size),
+                          lambda: self.backend.list_urls("site"),
+                          zabbix=1, mongo=3)
+
+    def test_add_watcher(self):
+        self.assertBudget(lambda size: self.grow_watchers("site", size),
+                          lambda: self.grow_watchers("site", len(self.watchers["site"]) + 1),
+                          zabbix=1, mongo=3)
+
+    def test_add_existing_user_as_watcher(self):
+        self.backend.new("other")
+
+        def grow(size):
+            self.grow_watchers("site", size)
+            self.grow_watchers("other", len(self.watchers.get("other", [])) + 1)
+        self.assertBudget(grow, lambda: self.backend.add_watcher("site", self.watchers["other"][-1]),
+                          zabbix=1, mongo=4)
+
+    def test_list_watchers(self):
+        self.assertBudget(lambda size: self.grow_watchers("site", size),
+                          lambda: self.backend.list_watchers("site"),
+                          zabbix=0, mongo=2)
+
+    def test_remove_watcher(self):
+        self.assertBudget(lambda size: self.grow_watchers("site", size + 1),
+                          lambda: self.backend.remove_watcher("site", self.watchers["site"].pop()),
+                          zabbix=1, mongo=3)
+
+    def test_clone(self):
+        def grow(size):
+            self.grow_urls("site", size)
+            self.grow_watchers("site", size)
+            self.backend.new("copy-{}".format(size))
+        self.assertBudget(grow, lambda: self.backend.clone("copy-{}".format(len(self.urls["site"])), "site"),
+                          zabbix=5, mongo=8)
+
+    def test_new(self):
+        self.assertBudget(self.grow_instances,
+                          lambda: self.backend.new("new-{}".format(self.next_id())),
+                          zabbix=3, mongo=2)
+
+    def test_new_many(self):
+        def grow(size):
+            self.names = ["many-{}".format(self.next_id()) for _ in range(size)]
+        self.assertBudget(grow, lambda: self.backend.new_many(self.names), zabbix=4, mongo=2)
+
+    def test_remove(self):
+        def grow(size):
+            name = "gone-{}".format(size)
+            self.backend.new(name)
+            self.grow_urls(name, size)
+            self.grow_watchers(name, size)
+            self.gone = name
+        self.assertBudget(grow, lambda: self.backend.remove(self.gone), zabbix=8, mongo=12)
+
+    def test_collect_removed(self):
+        def grow(size):
+            for _ in range(size):
+                name = "gone-{}".format(self.next_id())
+                self.backend.new(name)
+                self.grow_urls(name, 2)
+                self.grow_watchers(name, 2)
+                self.backend.storage.tombstone_healthcheck(
+                    self.backend.storage.find_healthcheck_by_name(name))
+        self.assertBudget(grow, self.backend.collect_removed, zabbix=8, mongo=10)
+
+    def test_list_service_groups(self):
+        def grow(size):
+            for _ in range(size):
+                self.zabbix.add("hostgroup", name="service-{}".format(self.next_id()))
+        self.assertBudget(grow, lambda: self.backend.list_service_groups("service"),
+                          zabbix=1, mongo=0)
+
+    def test_list_groups(self):
+        self.assertBudget(lambda size: self.grow_groups("site", size),
+                          lambda: self.backend.list_groups("site"),
+                          zabbix=1, mongo=2)
+
+    def test_add_group(self):
+        self.assertBudget(lambda size: self.grow_groups("site", size),
+                          lambda: self.grow_groups("site", len(self.groups) + 1),
+                          zabbix=3, mongo=2)
+
+    def test_remove_group(self):
+        self.assertBudget(lambda size: self.grow_groups("site", size + 1),
+                          lambda: self.backend.remove_group("site", self.groups.pop()),
+                          zabbix=3, mongo=2)
+
+    def grow_legacy_instances(self, size):
+        """
+        Turns the new instances into instances of older versions, with an
+        action per url and none for the instance.
+        """
+        self.grow_instances(size)
+        db = self.backend.storage.db
+        for hc in self.backend.storage.find_healthchecks_by_names(self.instances):
+            if not getattr(hc, "action_id", None):
+                continue
+            self.backend.zapi.action.delete(hc.action_id)
+            db.healthchecks.update_one({"name": hc.name}, {"$unset": {"action_id": ""}})
+            for item in self.backend.storage.find_items_by_group(hc.group_id):
+                action_id = self.zabbix.add("action", name="action for url {}".format(item.url))
+                db.items.update_one({"_id": item._id}, {"$set": {"action_id": action_id}})
+
+    def test_merge_actions(self):
+        self.assertBudget(self.grow_legacy_instances, self.backend.merge_actions,
+                          zabbix=2, mongo=4)
+
+        names = sorted(a["name"] for a in self.zabbix.find("action"))
+        self.assertEqual(sorted("action for {}".format(n) for n in ["site"] + self.instances), names)
+        items = self.backend.storage.find_items()
+        self.assertEqual([], [i.url for i in items if getattr(i, "action_id", None)])
+        for hc in self.backend.storage.find_healthchecks():
+            self.assertEqual([hc.action_id], [a["actionid"] for a in self.zabbix.find(
+                "action", name="action for {}".format(hc.name))])
+
+
+class CompactRoundTripsTest(InstanceRoundTripsTest):
+    env = {"ZABBIX_STEPS_PER_SCENARIO": "4"}
+
+    def scenario_id(self, name):
+        trigger = self.zabbix.find("trigger")[-1]
+        return re.search(r"hc scenario (\w+) for " + name, trigger["description"]).group(1)
+
+    def test_failed_url(self):
+        def grow(size):
+            self.grow_urls("site", size)
+            self.scenario = self.scenario_id("site")
+        self.assertBudget(grow, lambda: self.backend.failed_url("site", self.scenario, 1),
+                          zabbix=1, mongo=2)
+
+    def test_failed_url_from_alert(self):
+        self.backend.add_url("site", "http://site.com/a")
+        self.backend.add_url("site", "http://site.com/b")
+        scenario = self.scenario_id("site")
+        with mock.patch.object(api, "get_manager", lambda: self.backend):
+            resp = api.app.test_client().get("/resources/site/failed-url/{}/2".format(scenario))
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(b"http://site.com/b", resp.data)
+        self.assertIsNone(self.backend.failed_url("site", "ffffffff", 1))
+
+
+class DiscoveryRoundTripsTest(RoundTripsTestCase):
+    env = {"ZABBIX_PROVISIONING": "discovery", "ZABBIX_DISCOVERY_TEMPLATE": "10001"}
+
+    def test_discovery(self):
+        self.backend.new("site")
+
+        def grow(size):
+            for i in range(size):
+                self.backend.add_url("site", "http://site.com/{}/{}".format(size, i))
+        self.assertBudget(grow, lambda: self.backend.discovery("site"), zabbix=0, mongo=2)
+
+
+class PoolRoundTripsTest(RoundTripsTestCase):
+    env = {"ZABBIX_POOL_SIZE": "1"}
+
+    def test_fill_pool(self):
+        def grow(size):
+            self.backend.pool_size += size
+        self.assertBudget(grow, self.backend.fill_pool, zabbix=3, mongo=5)
+
+    def test_fill_pool_once_at_a_time(self):
+        self.backend.pool_size = 3
+        self.backend.storage.acquire_lock("pool_fill", 60)
+        self.assertEqual(0, self.backend.fill_pool())
+        self.backend.storage.release_lock("pool_fill")
+        self.assertEqual(3, self.backend.fill_pool())
+        self.assertEqual(0, self.backend.fill_pool())
+        self.assertEqual(3, len(self.zabbix.find("host")))
+
+    def test_reclaim_pool(self):
+        self.backend.pool_timeout = -1
+
+        def grow(size):
+            self.backend.pool_size = size
+            self.backend.fill_pool()
+            for i in range(size):
+                self.backend.storage.claim_pool_entry("claimed-{}-{}".format(size, i))
+        self.assertBudget(grow, self.backend.reclaim_pool, zabbix=3, mongo=3)
+
+
+class ProxiesRoundTripsTest(RoundTripsTestCase):
+    env = {"ZABBIX_PROXIES": "1,2"}
+
+    def test_rebalance_proxies(self):
+        def grow(size):
+            for i in range(size):
+                name = "instance-{}-{}".format(size, i)
+                self.backend.new(name)
+                self.backend.storage.set_healthcheck_proxy(
+                    self.backend.storage.find_healthcheck_by_name(name), "3")
+        self.assertBudget(grow, self.backend.rebalance_proxies,
+                          zabbix=1, mongo=lambda n: 4 + n)
+
+
+class CoverageTest(unittest.TestCase):
+
+    def test_every_public_method_has_a_budget(self):
+        tested = set()
+        for case in (ZabbixRoundTripsTest, CompactRoundTripsTest, DiscoveryRoundTripsTest,
+                     PoolRoundTripsTest, ProxiesRoundTripsTest):
+            tested.update(name[len("test_"):] for name in dir(case) if name.startswith("test_"))
+        public = [name for name, _ in inspect.getmembers(backends.Zabbix, inspect.ismethod)
+                  if not name.startswith("_")]
+        self.assertEqual([], [name for name in public if name not in tested])
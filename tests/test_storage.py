@@ -2,13 +2,14 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import unittest
 import mock
 import os
 
 from healthcheck.storage import (HealthCheck, HealthCheckNotFoundError, Item,
                                  Jsonable, MongoStorage, User,
-                                 UserNotFoundError, ItemNotFoundError)
+                                 UserNotFoundError, ItemNotFoundError, SNAPSHOT_TTL)
 
 
 class JsonableTest(unittest.TestCase):
@@ -257,3 +258,263 @@ class MongoStorageTest(unittest.TestCase):
         result = self.storage.find_healthcheck_by_name(self.healthcheck.name)
         self.assertEqual(["group3"], result.host_groups)
         self.storage.remove_healthcheck(self.healthcheck)
+
+    def test_find_healthchecks(self):
+        other = HealthCheck("other")
+        self.storage.add_healthcheck(self.healthcheck)
+        self.addCleanup(self.storage.remove_healthcheck, self.healthcheck)
+        self.storage.add_healthcheck(other)
+        self.addCleanup(self.storage.remove_healthcheck, other)
+        names = [hc.name for hc in self.storage.find_healthchecks()]
+        self.assertIn("bla", names)
+        self.assertIn("other", names)
+
+    def test_set_healthcheck_proxy(self):
+        self.storage.add_healthcheck(self.healthcheck)
+        self.addCleanup(self.storage.remove_healthcheck, self.healthcheck)
+        self.storage.set_healthcheck_proxy(self.healthcheck, "10")
+        result = self.storage.find_healthcheck_by_name(self.healthcheck.name)
+        self.assertEqual("10", result.proxy_id)
+
+    def test_count_items_by_group(self):
+        items = [Item("http://a.com", group_id="g1"),
+                 Item("http://b.com", group_id="g1"),
+                 Item("http://c.com", group_id="g2")]
+        for item in items:
+            self.storage.add_item(item)
+            self.addCleanup(self.storage.remove_item, item)
+        counts = self.storage.count_items_by_group()
+        self.assertEqual(2, counts["g1"])
+        self.assertEqual(1, counts["g2"])
+
+    def test_proxy_loads(self):
+        self.addCleanup(self.storage.db.proxies.remove, {})
+        self.storage.increment_proxy_load("10")
+        self.storage.increment_proxy_load("10")
+        self.storage.increment_proxy_load("11", 3)
+        self.storage.increment_proxy_load("11", -1)
+        self.storage.set_proxy_load("12", 7)
+        loads = self.storage.find_proxy_loads(["10", "11", "12", "13"])
+        self.assertEqual({"10": 2, "11": 2, "12": 7}, loads)
+
+    def test_find_items_by_group(self):
+        items = [Item("http://a.com", group_id="g1"),
+                 Item("http://b.com", group_id="g2")]
+        for item in items:
+            self.storage.add_item(item)
+            self.addCleanup(self.storage.remove_item, item)
+        result = self.storage.find_items_by_group("g1")
+        self.assertEqual(["http://a.com"], [i.url for i in result])
+
+    def test_unset_items_actions(self):
+        item = Item("http://a.com", group_id="g1", action_id="7")
+        self.storage.add_item(item)
+        self.addCleanup(self.storage.remove_item, item)
+        self.storage.unset_items_actions(["g1", "g2"])
+        result = self.storage.find_item_by_url("http://a.com")
+        self.assertFalse(hasattr(result, "action_id"))
+
+    def test_set_healthchecks_actions(self):
+        self.storage.add_healthcheck(self.healthcheck)
+        self.addCleanup(self.storage.remove_healthcheck, self.healthcheck)
+        self.storage.set_healthchecks_actions([(self.healthcheck, "9")])
+        result = self.storage.find_healthcheck_by_name(self.healthcheck.name)
+        self.assertEqual("9", result.action_id)
+
+    def test_find_item_by_url_and_group(self):
+        items = [Item(self.url, group_id="g1", item_id="1"),
+                 Item(self.url, group_id="g2", item_id="2")]
+        for item in items:
+            self.storage.add_item(item)
+            self.addCleanup(self.storage.remove_item, item)
+        self.assertEqual("2", self.storage.find_item_by_url(self.url, "g2").item_id)
+        with self.assertRaises(ItemNotFoundError):
+            self.storage.find_item_by_url(self.url, "g3")
+
+    def test_remove_item_by_group(self):
+        items = [Item(self.url, group_id="g1"), Item(self.url, group_id="g2")]
+        for item in items:
+            self.storage.add_item(item)
+        self.addCleanup(self.storage.remove_item, items[1])
+        self.storage.remove_item(items[0])
+        with self.assertRaises(ItemNotFoundError):
+            self.storage.find_item_by_url(self.url, "g1")
+        self.storage.find_item_by_url(self.url, "g2")
+
+    def test_scenario_reference_counting(self):
+        self.addCleanup(self.storage.db.scenarios.remove, {})
+        self.assertIsNone(self.storage.acquire_scenario(self.url, None, 60))
+        self.storage.add_scenario(self.url, None, 60, "70")
+        scenario = self.storage.acquire_scenario(self.url, None, 60)
+        self.assertEqual(("70", 2), (scenario["item_id"], scenario["refs"]))
+        self.assertIsNone(self.storage.acquire_scenario(self.url, "OK", 60))
+        self.assertIsNone(self.storage.acquire_scenario(self.url, None, 120))
+        self.assertIsNone(self.storage.release_scenario(self.url, None, 60))
+        scenario = self.storage.release_scenario(self.url, None, 60)
+        self.assertEqual("70", scenario["item_id"])
+        self.assertIsNone(self.storage.acquire_scenario(self.url, None, 60))
+
+    def test_packed_hosts(self):
+        self.addCleanup(self.storage.db.packed_hosts.remove, {})
+        self.assertIsNone(self.storage.claim_packed_host(2))
+        self.storage.add_packed_host("30", "hcaas-pack-1", "10")
+        host = self.storage.claim_packed_host(2)
+        self.assertEqual(("30", "10", 2), (host["host_id"], host["proxy_id"], host["instances"]))
+        self.assertIsNone(self.storage.claim_packed_host(2))
+        self.storage.release_packed_host("30")
+        self.storage.set_packed_host_proxy("30", "11")
+        host = self.storage.claim_packed_host(2)
+        self.assertEqual(("30", "11"), (host["host_id"], host["proxy_id"]))
+
+    def test_count_items_by_group_ignores_shared_items(self):
+        items = [Item("http://a.com", group_id="g1"),
+                 Item("http://b.com", group_id="g1", shared=True)]
+        for item in items:
+            self.storage.add_item(item)
+            self.addCleanup(self.storage.remove_item, item)
+        self.assertEqual(1, self.storage.count_items_by_group()["g1"])
+
+    def test_apply_restore_entries(self):
+        item = Item("http://a.com", group_id="g1", item_id="i1")
+        self.storage.add_item(item)
+        self.addCleanup(self.storage.remove_item, Item("http://a.com"))
+        self.addCleanup(self.storage.db.restore.drop)
+        _id = self.storage.find_item_by_url("http://a.com")._id
+        self.storage.add_restore_entries([
+            {"phase": "usergroups", "unit": "1", "new_id": "g2"},
+            {"collection": "items", "query": {"_id": _id}, "fields": {"group_id": "g2"}},
+            {"collection": "items", "query": {"_id": _id}, "fields": {"item_id": "i2"}},
+        ])
+        self.assertEqual("g2", self.storage.find_restore_entries()[0]["new_id"])
+        self.storage.apply_restore_entries()
+        item = self.storage.find_item_by_url("http://a.com")
+        self.assertEqual(("g2", "i2"), (item.group_id, item.item_id))
+        self.assertEqual([], self.storage.find_restore_entries())
+
+    def test_add_items(self):
+        items = [Item("http://a.com", group_id="g1"), Item("http://b.com", group_id="g1")]
+        self.storage.add_items(items)
+        for item in items:
+            self.addCleanup(self.storage.remove_item, item)
+        self.assertEqual(["http://a.com", "http://b.com"],
+                         sorted(i.url for i in self.storage.find_items_by_group("g1")))
+
+    def test_add_users_to_group(self):
+        user = User("1", "w@a.com", "g1")
+        self.storage.add_user(user)
+        self.addCleanup(self.storage.remove_user, user)
+        self.storage.add_users_to_group(["1"], "g2")
+        self.storage.add_users_to_group(["1"], "g2")
+        self.assertEqual(("g1", "g2"), self.storage.find_user_by_email("w@a.com").groups_id)
+
+    def test_add_groups_to_instance(self):
+        hc = HealthCheck("clone", host_groups=["2"])
+        self.storage.add_healthcheck(hc)
+        self.addCleanup(self.storage.remove_healthcheck, hc)
+        self.storage.add_groups_to_instance(hc, ["2", "3"])
+        self.assertEqual(["2", "3"], self.storage.find_healthcheck_by_name("clone").host_groups)
+
+    def test_add_healthchecks(self):
+        hcs = [HealthCheck("bulk1", group_id="g1"), HealthCheck("bulk2", group_id="g2")]
+        self.storage.add_healthchecks(hcs)
+        for hc in hcs:
+            self.addCleanup(self.storage.remove_healthcheck, hc)
+        found = self.storage.find_healthchecks_by_names(["bulk1", "bulk2", "other"])
+        self.assertEqual(["bulk1", "bulk2"], sorted(hc.name for hc in found))
+        self.storage.db.healthchecks.update_one({"name": "bulk2"}, {"$set": {"removed": True}})
+        found = self.storage.find_healthchecks_by_names(["bulk1", "bulk2"])
+        self.assertEqual(["bulk1"], [hc.name for hc in found])
+        found = self.storage.find_healthchecks_by_names(["bulk1", "bulk2"], with_removed=True)
+        self.assertEqual(["bulk1", "bulk2"], sorted(hc.name for hc in found))
+
+    def test_pool_entries(self):
+        self.addCleanup(self.storage.db.pool.remove, {})
+        entries = self.storage.add_pool_entries(["hcaas-pool-1", "hcaas-pool-2"], ["10", None])
+        self.assertEqual(2, self.storage.count_pool_entries())
+        self.assertIsNone(self.storage.claim_pool_entry("a"))
+        self.storage.set_pool_entries_ready([(entries[0], "3", "4")])
+        entry = self.storage.claim_pool_entry("a")
+        self.assertEqual(("3", "4", "10", "a"),
+                         (entry["host_id"], entry["group_id"], entry["proxy_id"], entry["instance"]))
+        self.assertEqual(1, self.storage.count_pool_entries())
+        self.assertEqual([], self.storage.find_stale_pool_entries(600))
+        self.assertEqual(2, len(self.storage.find_stale_pool_entries(-1)))
+        self.storage.remove_pool_entry(entry)
+        self.storage.remove_pool_entries([entries[1]])
+        self.assertEqual(0, self.storage.db.pool.count())
+
+    def test_removed_healthchecks(self):
+        hc = HealthCheck("removed", group_id="g1")
+        self.storage.add_healthcheck(hc)
+        self.addCleanup(self.storage.db.healthchecks.remove, {"name": "removed"})
+        self.storage.tombstone_healthcheck(hc)
+        with self.assertRaises(HealthCheckNotFoundError):
+            self.storage.find_healthcheck_by_name("removed")
+        self.assertNotIn("removed", [h.name for h in self.storage.find_healthchecks()])
+        self.assertEqual("removed", self.storage.find_removed_healthcheck("removed")["name"])
+        claimed = self.storage.claim_removed_healthchecks(10, 300)
+        self.assertEqual(["removed"], [h.name for h in claimed])
+        self.assertEqual([], self.storage.claim_removed_healthchecks(10, 300))
+        self.storage.defer_removal(claimed[0], -1)
+        claimed = self.storage.claim_removed_healthchecks(10, 300, "removed")
+        self.assertEqual(1, claimed[0].attempts)
+        self.storage.remove_healthchecks(claimed)
+        self.assertIsNone(self.storage.find_removed_healthcheck("removed"))
+
+    def test_remove_by_groups(self):
+        item = Item("http://a.com", group_id="g1")
+        self.storage.add_item(item)
+        users = [User("1", "a@a.com", "g1"), User("2", "b@a.com", "g1", "g2")]
+        for user in users:
+            self.storage.add_user(user)
+            self.addCleanup(self.storage.remove_user, user)
+        self.assertEqual(1, len(self.storage.find_items_by_groups(["g1", "g3"])))
+        self.assertEqual(2, len(self.storage.find_users_by_groups(["g1"])))
+        self.storage.remove_items_by_groups(["g1"])
+        self.storage.remove_users(users[:1])
+        self.storage.remove_groups_from_users(["g1"])
+        self.assertEqual([], self.storage.find_items_by_group("g1"))
+        self.assertEqual(("g2",), self.storage.find_user_by_email("b@a.com").groups_id)
+        with self.assertRaises(UserNotFoundError):
+            self.storage.find_user_by_email("a@a.com")
+
+    def test_lock(self):
+        self.addCleanup(self.storage.db.locks.remove, {})
+        self.assertTrue(self.storage.acquire_lock("pool_fill", 60))
+        self.assertFalse(self.storage.acquire_lock("pool_fill", 60))
+        self.storage.release_lock("pool_fill")
+        self.assertTrue(self.storage.acquire_lock("pool_fill", -1))
+        self.assertTrue(self.storage.acquire_lock("pool_fill", 60))
+
+    def test_release_scenarios(self):
+        self.addCleanup(self.storage.db.scenarios.remove, {})
+        self.storage.add_scenario("http://a.com", None, 60, "70")
+        self.storage.add_scenario("http://b.com", None, 60, "71")
+        self.storage.acquire_scenario("http://b.com", None, 60)
+        self.storage.release_scenarios({("http://a.com", None, 60): 1, ("http://b.com", None, 60): 1})
+        self.assertEqual(["http://b.com"], [s["url"] for s in self.storage.find_scenarios()])
+        self.assertEqual([], self.storage.find_scenarios(["http://a.com"]))
+
+    def test_snapshot(self):
+        self.addCleanup(self.storage.db.snapshots.remove, {})
+        updated_at = datetime.datetime(2018, 1, 1)
+        self.storage.save_snapshot("list_groups:hc", ["a"], updated_at)
+        self.storage.save_snapshot("list_groups:hc", ["a", "b"], updated_at)
+        snapshot = self.storage.find_snapshot("list_groups:hc")
+        self.assertEqual(["a", "b"], snapshot["value"])
+        self.assertEqual(updated_at, snapshot["updated_at"])
+        self.assertIsNone(self.storage.find_snapshot("list_groups:other"))
+        index = self.storage.db.snapshots.index_information()["updated_at_1"]
+        self.assertEqual(SNAPSHOT_TTL, index["expireAfterSeconds"])
+
+    def test_profiles(self):
+        from bson.objectid import ObjectId
+        self.addCleanup(self.storage.db.profiles.remove, {})
+        ids = [ObjectId() for _ in range(3)]
+        for profile_id in ids:
+            self.storage.add_profile({"_id": profile_id, "path": "/plugin", "stats": b"x"}, 2)
+        self.assertEqual(ids[:0:-1], [p["_id"] for p in self.storage.find_profiles()])
+        self.assertNotIn("stats", self.storage.find_profiles()[0])
+        self.assertEqual(b"x", self.storage.find_profile(str(ids[2]))["stats"])
+        self.assertIsNone(self.storage.find_profile(str(ids[0])))
+        self.assertIsNone(self.storage.find_profile("invalid"))
@@ -0,0 +1,195 @@
+# Copyright 2018 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import logging
+import os
+import time
+import unittest
+
+import flask
+import mock
+
+from healthcheck import timing
+from healthcheck.backends import client
+from healthcheck.backends.client import ZabbixClient
+from healthcheck.storage import MongoStorage
+
+from .fakemongo import FakeMongo
+from .fakezabbix import FakeZabbix
+
+
+class MeasureTest(unittest.TestCase):
+
+    def tearDown(self):
+        timing.stop()
+
+    def test_outside_request(self):
+        with timing.measure("mongo"):
+            pass
+
+        self.assertIsNone(timing.current())
+
+    def test_nested_blocks_count_once(self):
+        current = timing.start()
+
+        with timing.measure("mongo"):
+            with timing.measure("mongo"):
+                with timing.measure("render"):
+                    time.sleep(0.01)
+
+        self.assertEqual(1, current.calls["mongo"])
+        self.assertEqual(1, current.calls["render"])
+        self.assertGreaterEqual(current.durations["mongo"], current.durations["render"])
+        self.assertGreaterEqual(current.durations["render"], 0.01)
+
+    def test_measured_methods(self):
+        @timing.measured_methods("mongo", exclude=("conn",))
+        class Storage(object):
+            def find(self):
+                return self.find_one()
+
+            def find_one(self):
+                return 1
+
+            def _private(self):
+                return 2
+
+            def conn(self):
+                return 3
+
+        current = timing.start()
+
+        self.assertEqual(1, Storage().find())
+        self.assertEqual(2, Storage()._private())
+        self.assertEqual(3, Storage().conn())
+        self.assertEqual(1, current.calls["mongo"])
+
+    def test_header(self):
+        current = timing.Timing(0, queue=0.002)
+        current.add("mongo", 0.003)
+        current.add("mongo", 0.001)
+        current.add("zabbix", 0.04)
+
+        self.assertEqual('queue;dur=2.0, mongo;dur=4.0;desc="2 calls", zabbix;dur=40.0;desc="1 call", '
+                         'render;dur=0.0, app;dur=50.0', current.header(0.05))
+
+    def test_calls_in_order(self):
+        current = timing.start(slow_call=0.01)
+
+        with timing.measure("mongo", "find_healthcheck_by_name"):
+            pass
+        with timing.measure("zabbix", "host.get"):
+            time.sleep(0.02)
+
+        self.assertEqual([("mongo", "find_healthcheck_by_name"), ("zabbix", "host.get")],
+                         [(kind, operation) for kind, operation, _, _ in current.events])
+        kind, operation, duration, stack = current.slowest
+        self.assertEqual(("zabbix", "host.get"), (kind, operation))
+        self.assertIn("test_calls_in_order", stack[-1])
+
+    def test_rate_limit(self):
+        rate_limit = timing.RateLimit(2)
+
+        self.assertEqual([(True, 0), (True, 0), (False, 1), (False, 2)],
+                         [rate_limit.allow() for _ in range(4)])
+        rate_limit.updated_at -= 30
+        self.assertEqual((True, 2), rate_limit.allow())
+
+    def test_request_start(self):
+        now = 1500000000.5
+        self.assertEqual(0.5, timing.request_start("t=1500000000.0", now))
+        self.assertEqual(0.5, timing.request_start("1500000000000", now))
+        self.assertEqual(0.5, timing.request_start("t=1500000000000000", now))
+        self.assertEqual(0, timing.request_start("1500000001", now))
+        self.assertIsNone(timing.request_start("soon", now))
+
+    def test_json_formatter(self):
+        formatter = timing.JsonFormatter()
+        record = logging.LogRecord("healthcheck.timing", logging.INFO, __file__, 1,
+                                   {"status": 200, "route": None}, None, None)
+        self.assertEqual('{"route": null, "status": 200}', formatter.format(record))
+        record = logging.LogRecord("healthcheck.timing", logging.INFO, __file__, 1,
+                                   "%d requests", (2,), None)
+        self.assertEqual("2 requests", formatter.format(record))
+
+
+class InstallTest(unittest.TestCase):
+
+    def setUp(self):
+        client._tokens.clear()
+        self.zabbix = FakeZabbix()
+        url = self.zabbix.start()
+        self.addCleanup(self.zabbix.stop)
+        self.mongo = FakeMongo()
+        patch = mock.patch.object(MongoStorage, "conn", lambda storage: self.mongo)
+        patch.start()
+        self.addCleanup(patch.stop)
+        app = flask.Flask(__name__)
+
+        @app.route("/resources/<name>/url")
+        def list_urls(name):
+            zapi = ZabbixClient(url)
+            zapi.login("user", "pass")
+            zapi.host.get(output=["hostid"])
+            MongoStorage().find_healthchecks()
+            with timing.measure("render"):
+                return "[]"
+
+        self.app = app
+        self.handler = mock.Mock(level=0)
+        timing.logger.addHandler(self.handler)
+        self.addCleanup(timing.logger.removeHandler, self.handler)
+
+    def test_disabled(self):
+        with mock.patch.dict(os.environ, {"API_SERVER_TIMING": "0"}):
+            self.assertFalse(timing.install(self.app))
+
+        resp = self.app.test_client().get("/resources/site/url")
+
+        self.assertNotIn("Server-Timing", resp.headers)
+        self.assertFalse(self.handler.handle.called)
+
+    def test_server_timing(self):
+        with mock.patch.dict(os.environ, {"API_SERVER_TIMING": "1"}):
+            self.assertTrue(timing.install(self.app))
+
+        started = "t={:.3f}".format(time.time() - 0.06)
+        resp = self.app.test_client().get("/resources/site/url",
+                                          headers={"X-Request-Start": started})
+
+        header = resp.headers["Server-Timing"]
+        self.assertRegexpMatches(header, r'^queue;dur=\d+\.\d, mongo;dur=\d+\.\d;desc="1 call", '
+                                         r'zabbix;dur=\d+\.\d;desc="2 calls", render;dur=\d+\.\d, app;dur=\d+\.\d$')
+        record = self.handler.handle.call_args[0][0]
+        fields = json.loads(timing.JsonFormatter().format(record))
+        self.assertEqual("/resources/<name>/url", fields["route"])
+        self.assertEqual(200, fields["status"])
+        self.assertEqual(2, fields["zabbix_calls"])
+        self.assertEqual(1, fields["mongo_calls"])
+        self.assertGreaterEqual(fields["queue_ms"], 50)
+        self.assertIsNone(timing.current())
+
+    def test_slow_request(self):
+        handler = mock.Mock(level=0)
+        timing.slow_logger.addHandler(handler)
+        self.addCleanup(timing.slow_logger.removeHandler, handler)
+        env = {"API_SERVER_TIMING": "0", "API_SLOW_CALL_THRESHOLD": "0.000001", "API_SLOW_LOG_RATE": "1"}
+        with mock.patch.dict(os.environ, env):
+            self.assertTrue(timing.install(self.app))
+
+        resp = self.app.test_client().get("/resources/site/url")
+        self.app.test_client().get("/resources/site/url")
+
+        self.assertNotIn("Server-Timing", resp.headers)
+        self.assertFalse(self.handler.handle.called)
+        self.assertEqual(1, handler.handle.call_count)
+        fields = handler.handle.call_args[0][0].msg
+        self.assertEqual("/resources/<name>/url", fields["route"])
+        self.assertEqual("site", fields["instance"])
+        self.assertEqual(["zabbix", "zabbix", "mongo", "render"], [c["kind"] for c in fields["calls"]])
+        self.assertEqual(["user.login", "host.get", "find_healthchecks"],
+                         [c["operation"] for c in fields["calls"][:3]])
+        self.assertIn("list_urls", fields["slowest"]["stack"])
+        self.assertEqual(0, fields["suppressed"])